@@ -0,0 +1,59 @@
+'''
+darkwing benchmarks - run with `python -m benchmarks [names...]`
+
+Results are written as JSON lines tagged with the git commit.
+'''
+
+import os
+import time
+import subprocess
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+FAKE_BIN = BENCH_DIR / 'fake'
+
+MODULES = ('iopump', 'spec', 'rundir', 'config', 'lifecycle')
+
+def use_fake_tools():
+    # Fake runc/umoci scripts first on $PATH
+    path = os.environ.get('PATH', '')
+    if not path.startswith(str(FAKE_BIN)):
+        os.environ['PATH'] = os.pathsep.join([str(FAKE_BIN), path])
+
+def git_commit():
+    try:
+        proc = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+            capture_output=True, text=True,
+        )
+    except OSError:
+        return None
+    return proc.stdout.strip() or None
+
+def measure(func, repeat=20, warmup=2, setup=None):
+    # Durations (ns) of repeat calls after warmup; setup() untimed
+    samples = []
+    for n in range(warmup + repeat):
+        if setup:
+            setup()
+        start = time.perf_counter_ns()
+        func()
+        elapsed = time.perf_counter_ns() - start
+        if n >= warmup:
+            samples.append(elapsed)
+    return samples
+
+def result(name, samples, **params):
+    samples = sorted(samples)
+    count = len(samples)
+    rec = {
+        'bench': name,
+        'params': params,
+        'count': count,
+        'min_ns': samples[0],
+        'mean_ns': sum(samples) // count,
+        'p50_ns': samples[count // 2],
+        'p90_ns': samples[min(count - 1, count * 9 // 10)],
+        'max_ns': samples[-1],
+    }
+    return rec
@@ -0,0 +1,47 @@
+import sys
+import json
+import argparse
+import importlib
+import traceback
+
+from . import MODULES, git_commit
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument(
+        'names', nargs='*', metavar='name',
+        help=f"benchmarks to run (default all: {', '.join(MODULES)})",
+    )
+    parser.add_argument('--output', '-o', help='JSON lines output file')
+    parser.add_argument(
+        '--quick', action='store_true', help='fewer sizes/iterations'
+    )
+    args = parser.parse_args()
+
+    names = args.names or MODULES
+    for name in names:
+        if name not in MODULES:
+            parser.error(f'Unknown benchmark: {name!r}')
+
+    out = open(args.output, 'a') if args.output else sys.stdout
+    commit = git_commit()
+    failed = False
+    try:
+        for name in names:
+            module = importlib.import_module(f'.bench_{name}', __package__)
+            try:
+                for rec in module.run(quick=args.quick):
+                    rec['commit'] = commit
+                    out.write(json.dumps(rec) + '\n')
+                    out.flush()
+            except Exception:
+                failed = True
+                traceback.print_exc()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,36 @@
+import shutil
+import tempfile
+from pathlib import Path
+
+from darkwing.config import context, container
+from . import measure, result
+
+def run(quick=False):
+    repeat = 20 if quick else 100
+    base = Path(tempfile.mkdtemp(prefix='darkwing-bench-'))
+    configs = base / 'configs'
+
+    try:
+        ctx = context.make_context_config(
+            'bench', rootless=True, configs_dir=configs,
+            storage_dir=base / 'storage',
+        )
+        container.make_container_config('bench', ctx)
+
+        samples = measure(
+            lambda: context.get_context_config(
+                'bench', dirs=[configs], rootless=True
+            ),
+            repeat=repeat,
+        )
+        yield result('get_context_config', samples)
+
+        samples = measure(
+            lambda: container.get_container_config(
+                'bench', ctx, dirs=[configs], rootless=True
+            ),
+            repeat=repeat,
+        )
+        yield result('get_container_config', samples)
+    finally:
+        shutil.rmtree(base)
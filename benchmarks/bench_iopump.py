@@ -0,0 +1,106 @@
+import os
+import pty
+import tty
+import socket
+import threading
+
+from darkwing.runtimes.runc import iopump, IOStats
+from . import measure, result
+
+CHUNK = 64 * 1024
+
+def _pipe_source():
+    r, w = os.pipe()
+    return r, w
+
+def _socket_source():
+    a, b = socket.socketpair()
+    return a.detach(), b.detach()
+
+def _tty_source():
+    # Read from master, write to (raw) slave, as with a container tty
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    return master, slave
+
+def _pipe_sink():
+    r, w = os.pipe()
+    return r, w
+
+def _socket_sink():
+    a, b = socket.socketpair()
+    return b.detach(), a.detach()
+
+SOURCES = {
+    'pipe': _pipe_source,
+    'socket': _socket_source,
+    'tty': _tty_source,
+}
+SINKS = {
+    'pipe': _pipe_sink,
+    'socket': _socket_sink,
+}
+
+def _produce(fd, total):
+    data = b'x' * CHUNK
+    sent = 0
+    try:
+        while sent < total:
+            sent += os.write(fd, data[:total - sent])
+    finally:
+        os.close(fd)
+
+def _consume(fd, counter):
+    try:
+        while True:
+            data = os.read(fd, CHUNK)
+            if not data:
+                break
+            counter.append(len(data))
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _pump_once(source, sink, total, bufsize, stats):
+    src_r, src_w = SOURCES[source]()
+    dst_r, dst_w = SINKS[sink]()
+    counter = []
+    threads = [
+        threading.Thread(target=_produce, args=(src_w, total)),
+        threading.Thread(target=_consume, args=(dst_r, counter)),
+    ]
+    for t in threads:
+        t.start()
+    iopump(src_r, dst_w, bufsize=bufsize, stats=stats)
+    for t in threads:
+        t.join()
+    if sum(counter) != total:
+        raise RuntimeError(
+            f'iopump {source}->{sink} moved {sum(counter)} of {total} bytes'
+        )
+
+def run(quick=False):
+    total = (4 if quick else 32) * 1024 * 1024
+    repeat = 3 if quick else 10
+    bufsizes = [None, 4096, 65536] if quick else [None, 512, 4096, 16384, 65536]
+
+    for source in SOURCES:
+        for sink in SINKS:
+            for bufsize in bufsizes:
+                stats = IOStats()
+                samples = measure(
+                    lambda: _pump_once(source, sink, total, bufsize, stats),
+                    repeat=repeat, warmup=1,
+                )
+                rec = result(
+                    'iopump', samples, source=source, sink=sink,
+                    bufsize=bufsize or 'default', bytes=total,
+                )
+                mean_s = rec['mean_ns'] / 1e9
+                rec['mib_per_s'] = round(total / mean_s / (1 << 20), 1)
+                # Per-run averages over warmup + timed runs
+                runs = repeat + 1
+                rec['writes_per_run'] = stats.writes // runs
+                rec['stalls_per_run'] = stats.stalls // runs
+                yield rec
@@ -0,0 +1,160 @@
+import os
+import sys
+import shutil
+import signal
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from darkwing.config import context, container
+from darkwing.runtimes.runc import RuncExecutor
+from darkwing.utils.timing import PhaseTimer
+from . import measure, result, use_fake_tools
+
+def _setup(base):
+    configs = base / 'configs'
+    ctx = context.make_context_config(
+        'bench', rootless=True, configs_dir=configs,
+        storage_dir=base / 'storage',
+    )
+    config = container.make_container_config('bench', ctx)
+    # Fake umoci only checks the image path exists
+    Path(config.data['image']['path']).mkdir(parents=True)
+    config.data['exec']['cmd'] = 'true'
+    config.data['exec']['terminal'] = False
+    return ctx, config
+
+def run(quick=False):
+    repeat = 5 if quick else 20
+    use_fake_tools()
+    base = Path(tempfile.mkdtemp(prefix='darkwing-bench-'))
+    old_runtime = os.environ.get('XDG_RUNTIME_DIR')
+    os.environ['XDG_RUNTIME_DIR'] = str(base / 'run')
+
+    try:
+        ctx, config = _setup(base)
+        con = container.Container('bench', config, context=ctx)
+        samples = measure(
+            lambda: con.unpack_image(quiet=True, reconfig=True), repeat=1,
+            warmup=0,
+        )
+        yield result('unpack_image', samples, tool='fake-umoci')
+
+        timer = PhaseTimer()
+
+        def run_once():
+            con = container.Container('bench', config, context=ctx)
+            executor = RuncExecutor(
+                context_name='bench', state_dir=base / 'state',
+                stdin=os.open(os.devnull, os.O_RDONLY),
+                stdout=os.open(os.devnull, os.O_WRONLY),
+                stderr=os.open(os.devnull, os.O_WRONLY),
+                # Executor errors are only shown with $BENCH_DEBUG set
+                log_file=sys.stderr if os.environ.get('BENCH_DEBUG') else None,
+                timer=timer,
+            )
+            code = executor.run_until_complete(con, remove=True)
+            if code:
+                raise RuntimeError(f'Container exited with {code}')
+
+        samples = measure(run_once, repeat=repeat, warmup=1)
+        yield result('run_until_complete', samples, tool='fake-runc')
+
+        # Same, but served by a warm pool from the context's pool table,
+        # refilled between runs as it would be between requests
+        ctx.data['pool'] = {'size': 1, 'ttl': 300.0}
+        pooled = RuncExecutor(
+            context_name='bench', state_dir=base / 'state',
+            stdin=os.open(os.devnull, os.O_RDONLY),
+            stdout=os.open(os.devnull, os.O_WRONLY),
+            stderr=os.open(os.devnull, os.O_WRONLY),
+            log_file=sys.stderr if os.environ.get('BENCH_DEBUG') else None,
+            timer=timer,
+        )
+
+        def wait_warm():
+            pool = pooled.get_pool(config)
+            deadline = time.monotonic() + 10
+            while pool is not None and not len(pool):
+                if time.monotonic() > deadline:
+                    raise RuntimeError('Warm pool not refilled')
+                time.sleep(0.005)
+
+        def run_pooled():
+            con = container.Container('bench', config, context=ctx)
+            code = pooled.run_until_complete(con, remove=True)
+            if code:
+                raise RuntimeError(f'Container exited with {code}')
+
+        try:
+            samples = measure(
+                run_pooled, repeat=repeat, warmup=1, setup=wait_warm
+            )
+            # Only the first run (which starts the pool) creates its own
+            acquired = pooled.get_pool(config).acquired
+            if acquired != repeat:
+                raise RuntimeError(
+                    f'Warm pool served {acquired} of {repeat} runs'
+                )
+        finally:
+            pooled.close()
+            ctx.data.pop('pool')
+        yield result('run_until_complete', samples, tool='fake-runc',
+                     pool=1)
+
+        # Health-check style execs against one long-running container
+        config.data['exec']['cmd'] = 'sleep'
+        config.data['exec']['args'] = ['60']
+        con = container.Container('bench', config, context=ctx)
+        executor = RuncExecutor(
+            context_name='bench', state_dir=base / 'state',
+            stdin=os.open(os.devnull, os.O_RDONLY),
+            stdout=os.open(os.devnull, os.O_WRONLY),
+            stderr=os.open(os.devnull, os.O_WRONLY),
+            log_file=sys.stderr if os.environ.get('BENCH_DEBUG') else None,
+            timer=timer,
+        )
+        exec_samples = []
+
+        def exec_all():
+            # Executor owns the main thread (signals), so exec from here
+            try:
+                while con.status != 'running':
+                    if con.returncode is not None:
+                        return
+                    time.sleep(0.01)
+
+                def exec_once():
+                    proc = executor.exec_in_container(con, ['true'])
+                    proc.communicate(timeout=10)
+                    if proc.returncode:
+                        raise RuntimeError(
+                            f'Exec exited with {proc.returncode}'
+                        )
+
+                exec_samples.extend(
+                    measure(exec_once, repeat=repeat, warmup=1)
+                )
+            finally:
+                if con.pid and con.returncode is None:
+                    os.kill(con.pid, signal.SIGKILL)
+
+        checker = threading.Thread(target=exec_all)
+        checker.start()
+        executor.run_until_complete(con, remove=True)
+        checker.join()
+        if exec_samples:
+            yield result('exec_in_container', exec_samples, tool='fake-runc')
+
+        # Per-phase breakdown from executor's own timers
+        for name, summary in sorted(timer.summary().items()):
+            rec = {'bench': f'phase:{name}', 'params': {'tool': 'fake-runc'}}
+            rec.update(summary)
+            yield rec
+    finally:
+        if old_runtime is None:
+            os.environ.pop('XDG_RUNTIME_DIR', None)
+        else:
+            os.environ['XDG_RUNTIME_DIR'] = old_runtime
+        shutil.rmtree(base)
@@ -0,0 +1,32 @@
+import shutil
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+
+from darkwing.config.container import make_runtime_dir
+from . import measure, result
+
+def run(quick=False):
+    repeat = 10 if quick else 50
+    base = Path(tempfile.mkdtemp(prefix='darkwing-bench-'))
+    config = SimpleNamespace(name='bench', path=None, data={
+        'secrets': {'target': '/run/secrets'},
+        'dns': {'hostname': 'bench.local'},
+        'volumes': {'mounts': []},
+    })
+
+    try:
+        for recreate in (True, False):
+            samples = measure(
+                lambda: make_runtime_dir(
+                    'bench', config, 'default', base_path=base,
+                    recreate=recreate,
+                ),
+                repeat=repeat,
+            )
+            yield result(
+                'make_runtime_dir', samples,
+                mode='fresh' if recreate else 'existing',
+            )
+    finally:
+        shutil.rmtree(base)
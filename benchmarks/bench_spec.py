@@ -0,0 +1,98 @@
+import json
+import shutil
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+
+from darkwing.runtimes import spec
+from . import measure, result
+
+def _base_spec(num_env):
+    return {
+        'ociVersion': '1.0.2',
+        'process': {
+            'terminal': True,
+            'user': {'uid': 0, 'gid': 0},
+            'args': ['sh'],
+            'env': [f'IMAGE_VAR_{n}=value{n}' for n in range(num_env)],
+            'cwd': '/',
+            'capabilities': {
+                kind: ['CAP_AUDIT_WRITE', 'CAP_KILL', 'CAP_NET_BIND_SERVICE']
+                for kind in ('bounding', 'effective', 'permitted')
+            },
+        },
+        'root': {'path': 'rootfs'},
+        'hostname': 'bench',
+        'mounts': [
+            {'destination': '/proc', 'type': 'proc', 'source': 'proc'},
+        ],
+        'linux': {
+            'uidMappings': [{'containerID': 0, 'hostID': 0, 'size': 1}],
+            'gidMappings': [{'containerID': 0, 'hostID': 0, 'size': 1}],
+        },
+    }
+
+def _make_config(base, num_mounts, num_env):
+    storage = base / 'storage'
+    storage.mkdir()
+    (storage / 'config.json').write_text(
+        json.dumps(_base_spec(num_env), indent='\t')
+    )
+    mounts = []
+    for n in range(num_mounts):
+        kind = 'shared' if n % 2 else 'private'
+        mounts.append({
+            'type': kind,
+            'source': f'vol{n}',
+            'target': f'/data/{n}',
+            'readonly': bool(n % 3 == 0),
+        })
+    data = {
+        'storage': {'base': str(storage)},
+        'dns': {'hostname': 'bench.local'},
+        'user': {'uid': 0, 'gid': 0},
+        'exec': {'dir': '', 'cmd': 'true', 'args': [], 'terminal': False},
+        'caps': {'add': ['CAP_SYS_NICE'], 'drop': ['CAP_KILL']},
+        'env': {
+            'vars': [f'VAR_{n}=x' for n in range(num_env)],
+            'host': ['PATH'],
+            'files': [],
+        },
+        'resources': {'pids': {'limit': 100}},
+        'volumes': {
+            'shared': str(base / 'shared'),
+            'private': str(base / 'private'),
+            'mounts': mounts,
+        },
+    }
+    return SimpleNamespace(name='bench', path=base / 'bench.toml', data=data)
+
+def run(quick=False):
+    sizes = [10, 100] if quick else [10, 100, 1000]
+    repeat = 5 if quick else 20
+
+    for size in sizes:
+        base = Path(tempfile.mkdtemp(prefix='darkwing-bench-'))
+        try:
+            config = _make_config(base, size, size)
+            spec_path = base / 'storage' / 'config.json'
+
+            counter = iter(range(1 << 30))
+
+            def changed():
+                # Force a rewrite each time
+                config.data['dns']['hostname'] = f'bench{next(counter)}.local'
+
+            for label, setup in (('changed', changed), ('unchanged', None)):
+                samples = measure(
+                    lambda: spec.update_spec_file(config, None),
+                    repeat=repeat, setup=setup,
+                )
+                rec = result(
+                    'update_spec_file', samples, mounts=size, env=size,
+                    write=label,
+                )
+                rec['spec_bytes'] = spec_path.stat().st_size
+                yield rec
+        finally:
+            shutil.rmtree(base)
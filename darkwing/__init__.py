@@ -108,8 +108,51 @@ def run_cmd(args):
 
     raise NotImplementedError
 
+def _load_context(name):
+    from darkwing.config import context
+
+    ctx = context.get_context_config(name)
+    if not ctx:
+        raise FileNotFoundError(f'No config found for context {name!r}')
+    return ctx
+
 def exec_cmd(args):
-    raise NotImplementedError
+    # Args: <container>[:<context>] <cmd> [args...]
+    from darkwing.config import container
+    from darkwing.runtimes.runc import RuncExecutor
+
+    if len(args) < 2:
+        raise ValueError('Exec requires a container and command')
+
+    name, sep, context_name = args[0].partition(':')
+    ctx = _load_context(context_name if sep else 'default')
+    con = container.load_container(name, ctx, make_rundir=True)
+
+    runc = RuncExecutor(context_name=ctx.name)
+    return runc.exec_until_complete(con, args[1:])
+
+def df_cmd(args):
+    # Args: [<context>]
+    from darkwing.storage import gc
+
+    ctx = _load_context(args[0] if args else 'default')
+    for usage in gc.df(ctx):
+        refs = ','.join(usage.refs) or '-'
+        print(f'{usage.kind:<10} {usage.bytes:>14} {usage.name} {refs}')
+
+def gc_cmd(args):
+    # Args: [<context>] [--dry-run]
+    from darkwing.storage import gc, trash
+
+    dry_run = '--dry-run' in args
+    args = [ arg for arg in args if arg != '--dry-run' ]
+    ctx = _load_context(args[0] if args else 'default')
+    removed = gc.gc(ctx, dry_run=dry_run)
+    for usage in removed:
+        print(f'Removed {usage.kind} {usage.name} ({usage.bytes} bytes)')
+    if not dry_run:
+        # Reaper threads are daemons, so let them finish
+        trash.get_reaper(gc.context_trash(ctx)).wait()
 
 def stop_cmd(args):
     raise NotImplementedError
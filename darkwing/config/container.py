@@ -5,10 +5,14 @@ from pathlib import Path
 from collections import deque
 
 from darkwing.utils import (
-    probably_root, ensure_dirs, ensure_files,
-    get_runtime_path, compute_returncode,
+    probably_root, ensure_paths, ensure_dirs,
+    get_runtime_path, compute_returncode, parse_signal,
 )
-from darkwing.runtimes import spec
+from darkwing.utils.timing import get_timer
+from darkwing.utils.profiling import get_profiler
+from darkwing.runtimes import spec, secrets
+from darkwing.runtimes.logs import log_dir, read_log_tail
+from darkwing.runtimes.attach import ATTACH_SOCKET
 from darkwing import storage
 from .defaults import default_base_paths, default_container
 
@@ -40,6 +44,9 @@ class Rundir(object):
 
     def remove(self):
         if self.path.exists():
+            # Never remove through an idmapped mount of the rootfs
+            storage.idmap.release_rootfs(self.path)
+            secrets.wipe_secrets(self.path)
             shutil.rmtree(self.path)
             return True
         return False
@@ -62,13 +69,27 @@ class Container(object):
         self.stderr = None
         self.returncode = None
         self.status = 'new'
+        self.cpuset = None
+        # Held for container's lifetime (see RuncExecutor._lock_container)
+        self.lock = None
+        # OCI process section, as template for execs (see spec.py)
+        self.process_template = None
+        # Warm pool holding it until acquired (see runtimes.pool)
+        self.pool = None
+        self._bundle_path = None
         # Internal state
         self._waiter = None
         self._runtime = None
         self._closing = None
         self._kill_sent = None
+        # Pending SIGKILL escalation while stopping (see TimerWheel)
+        self._stop_timer = None
         self._close_fds = deque()
         self._io_threads = deque()
+        # Per-stream forwarding counters (see runc.IOStats)
+        self.io_stats = {}
+        # Per-stream log files, when capturing output (see runtimes.logs)
+        self.log_writers = {}
         self._stop_event = None
         # TODO: waitpid lock?
 
@@ -88,13 +109,40 @@ class Container(object):
     @property
     def use_tty(self):
         if not hasattr(self, '_use_tty'):
-            self._use_tty = self.config.data['exec'].get('terminal', True)
+            # Captured output goes to separate stdout/stderr logs
+            self._use_tty = (
+                self.config.data['exec'].get('terminal', True) and
+                self.log_mode != 'file'
+            )
         return self._use_tty
 
     @use_tty.setter
     def use_tty(self, value):
         self._use_tty = value
 
+    @property
+    def stop_signal(self):
+        return parse_signal(
+            self.config.data.get('stop', {}).get('signal', 'SIGTERM')
+        )
+
+    @property
+    def stop_timeout(self):
+        return float(self.config.data.get('stop', {}).get('timeout', 10.0))
+
+    @property
+    def log_mode(self):
+        return self.config.data.get('logs', {}).get('mode', 'forward')
+
+    @property
+    def bundle_path(self):
+        # OCI bundle runc creates it from, unless given its own
+        return self._bundle_path or self.path
+
+    @bundle_path.setter
+    def bundle_path(self, value):
+        self._bundle_path = Path(value) if value else None
+
     @property
     def config_path(self):
         return self.config.path
@@ -107,6 +155,14 @@ class Container(object):
     def pidfile_path(self):
         return self.rundir.path / 'pid' if self.rundir else None
 
+    @property
+    def rundir_lock_path(self):
+        return self.rundir.path / 'lock' if self.rundir else None
+
+    @property
+    def attach_path(self):
+        return self.rundir.path / ATTACH_SOCKET if self.rundir else None
+
     @property
     def lockfile_path(self):
         return self.path / 'darkwing.lock'
@@ -139,14 +195,22 @@ class Container(object):
         except AttributeError:
             raise ValueError(f'Invalid storage type: {storage_type!r}')
 
+        timer = get_timer()
+        profiler = get_profiler()
+
         if make_rundir:
-            self.make_rundir(recreate=recreate)
+            with timer.phase('unpack.rundir', container=self.name):
+                self.make_rundir(recreate=recreate)
 
         # Unpack image (possibly remove existing)
-        storage_path = storage_lib.unpack_image(
-            self.config, write_output=not quiet,
-            refresh_rootfs=recreate, refresh_config=reconfig,
-        )
+        with timer.phase('unpack.image', container=self.name), \
+                profiler.phase('unpack'):
+            storage_path = storage_lib.unpack_image(
+                self.config, write_output=not quiet,
+                refresh_rootfs=recreate, refresh_config=reconfig,
+            )
+        if profiler.enabled and self.rundir:
+            profiler.dump(self.rundir.path)
         # Update storage path if required (future feature)
         if self.path != storage_path:
             self.path = storage_path
@@ -157,6 +221,15 @@ class Container(object):
 
         return self
 
+    def logs(self, stream='stdout', size=64 * 1024):
+        # Served from in-memory tail while capturing, else from file
+        writer = self.log_writers.get(stream)
+        if writer:
+            return writer.tail.get(size)
+        return read_log_tail(
+            log_dir(self.config, self.rundir) / f'{stream}.log', size
+        )
+
     def _wait(self, blocking=True):
         if self.returncode is not None or self.pid is None:
             return self.returncode
@@ -236,10 +309,11 @@ def get_container_config(name, context, dirs=None, rootless=None, uid=None):
         config_base, _ = default_base_paths(rootless, uid)
         dirs = [cwd_base, config_base]
 
-    for dirp in dirs:
-        config_path = (Path(dirp) / context_name / name).with_suffix('.toml')
-        if config_path.exists():
-            return Config(name, config_path, toml.load(config_path))
+    with get_profiler().phase('config'):
+        for dirp in dirs:
+            config_path = (Path(dirp) / context_name / name).with_suffix('.toml')
+            if config_path.exists():
+                return Config(name, config_path, toml.load(config_path))
 
     return None
 
@@ -299,6 +373,8 @@ def make_runtime_dir(name, config, context, base_path=None,
     volumes_path = rundir_path / 'volumes'
 
     if recreate and rundir_path.exists():
+        storage.idmap.release_rootfs(rundir_path)
+        secrets.wipe_secrets(rundir_path)
         shutil.rmtree(rundir_path)
 
     # Create runtime dirs
@@ -307,8 +383,9 @@ def make_runtime_dir(name, config, context, base_path=None,
         (secrets_path, 0o700),
         (volumes_path, 0o770),
     ]
-    # TODO: parse temp volumes from config, add to dirs
-    ensure_dirs(dirs, uid=uid, gid=gid)
+    # Temp volumes: dirs of 'runtime' ones (under volumes_path) are
+    # made along with other volumes' (see spec.mount_plan()), and
+    # 'tmpfs' ones need none, being mounted by runc
 
     # Determine runtime mounts
     resolvconf = rundir_path / 'resolv.conf'
@@ -335,7 +412,7 @@ def make_runtime_dir(name, config, context, base_path=None,
         },
         # TODO: /etc/hosts?
     ]
-    # TODO: parse temp volumes from config, add to mounts
+    # Temp volume mounts are configured volumes (see spec.mount_plan())
 
     # Create runtime files
     files = [
@@ -343,7 +420,8 @@ def make_runtime_dir(name, config, context, base_path=None,
         (hostname, 0o644),
         # TODO: hosts
     ]
-    ensure_files(files, uid=uid, gid=gid)
+    # Single batch, so rundir only opened once for all entries
+    ensure_paths(dirs=dirs, files=files, uid=uid, gid=gid)
 
     # Copy host's resolvconf
     # TODO: handle when symlink, or not present, or weird
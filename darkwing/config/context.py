@@ -3,6 +3,7 @@ import toml
 from pathlib import Path
 
 from darkwing.utils import probably_root, ensure_dirs
+from darkwing.utils.profiling import get_profiler
 from .defaults import default_base_paths, default_context
 
 
@@ -30,10 +31,11 @@ def get_context_config(name='default', dirs=None, rootless=None, uid=None):
         configs_base, _ = default_base_paths(rootless, uid)
         dirs = [cwd_base, configs_base]
 
-    for dirp in dirs:
-        context_path = (Path(dirp) / name).with_suffix('.toml')
-        if context_path.exists():
-            return Context(name, context_path, toml.load(context_path))
+    with get_profiler().phase('config'):
+        for dirp in dirs:
+            context_path = (Path(dirp) / name).with_suffix('.toml')
+            if context_path.exists():
+                return Context(name, context_path, toml.load(context_path))
 
     return None
 
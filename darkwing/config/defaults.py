@@ -66,6 +66,36 @@ def default_context(name='default', rootless=None, ouid=None, ogid=None,
             'gid': ogid,
             'rootless': rootless,
         },
+        # Defaults under containers' own; zero/absent means unlimited
+        # (rlimits take 'unlimited' instead, as zero is a real limit)
+        'resources': {
+            'cpu': {},
+            'memory': {},
+            'pids': {},
+            'blkio': {},
+            'rlimits': {},
+        },
+        # CPU/NUMA pinning: policy is none, static (cpus/mems given),
+        # spread or pack (count CPUs allocated by the executor)
+        'placement': {
+            'policy': 'none',
+            'count': 1,
+            'node': -1,
+            'exclusive': False,
+        },
+        # Pre-created containers kept per config (0 disables), each
+        # replaced after ttl seconds unused
+        'pool': {
+            'size': 0,
+            'ttl': 300.0,
+        },
+        # What gc may remove once unreferenced (see storage.gc)
+        'gc': {
+            'containers': True,
+            'volumes': False,
+            'images': False,
+            'min_age': 3600.0,
+        },
     }
 
 def default_container(name, context, image=None, tag='latest', uid=0, gid=0):
@@ -75,6 +105,11 @@ def default_container(name, context, image=None, tag='latest', uid=0, gid=0):
     image_path = Path(context.data['storage']['images']) / 'oci' / image
     storage_path = Path(context.data['storage']['containers']) / name
     secrets_path = Path(context.data['configs']['secrets']) / name
+    # Copy each section, so containers don't share context's tables
+    resources = {
+        section: (values.copy() if isinstance(values, dict) else values)
+        for section, values in context.data.get('resources', {}).items()
+    }
 
     return {
         'image': {
@@ -97,21 +132,36 @@ def default_container(name, context, image=None, tag='latest', uid=0, gid=0):
             'host': [],
             'files': [],
         },
+        # ID mapping: 'single' (just uid/gid to owner), 'subids' (also
+        # map_size IDs from owner's subuid/subgid ranges) or 'isolated'
+        # (a map_size block of those allocated to this container alone).
+        # With either of the latter, rootfs ownership is shifted to suit
+        # by an idmapped mount or cached copy: shift 'auto', 'idmap' or
+        # 'copy'
         'user': {
             'uid': uid,
             'gid': gid,
+            'mapping': 'single',
+            'map_size': 65536,
+            'shift': 'auto',
         },
         'caps': {
             'add': [],
             'drop': [],
         },
+        'resources': resources,
+        'placement': { **context.data.get('placement', {}) },
         'dns': {
             'hostname': f"{name}.{context.data['dns']['domain']}",
             'domain': context.data['dns']['domain'],
         },
         'network': { **context.data['network'] },
+        # Staged into the rundir (which must be on tmpfs, else one of
+        # size is mounted there, as root) just before start, and wiped
+        # once stopped; source type 'copy', 'gpg' or 'age'
         'secrets': {
             'target': '/run/secrets',
+            'size': '4M',
             'sources': [
                 {
                     'path': str(secrets_path),
@@ -120,9 +170,44 @@ def default_container(name, context, image=None, tag='latest', uid=0, gid=0):
                 },
             ],
         },
+        # Mounts of type 'bind', 'shared', 'private', 'runtime' (under
+        # the rundir), or 'tmpfs' (in memory, limited to its size, else
+        # tmpfs_size). Volumes with seed set get the image's contents
+        # at their target copied in, the first time only
         'volumes': {
             'shared': context.data['storage']['volumes'],
             'private': str(storage_path / 'volumes'),
+            'tmpfs_size': '64M',
             'mounts': [],
         },
+        # Output handling: 'forward' to darkwing's stdio, or 'file' to
+        # write rotated logs under location ('runtime', 'storage' or
+        # an absolute path)
+        'logs': {
+            'mode': 'forward',
+            'location': 'runtime',
+            'max_size': '10M',
+            'backups': 5,
+            'compress': False,
+            'flush_interval': 1.0,
+            'tail_size': '64K',
+        },
+        # Stop signal, and grace period (seconds) before SIGKILL
+        'stop': {
+            'signal': 'SIGTERM',
+            'timeout': 10.0,
+        },
+        # Attach socket for detached containers, each supervised by its
+        # own shim process (holding the pty, if exec.terminal, else its
+        # pipes): recent output replayed to new clients, slow clients
+        # either dropped from ('drop') or disconnected ('disconnect')
+        # once queue_size is reached. With input, clients may write to
+        # the container's stdin (else it's closed at start)
+        'attach': {
+            'enabled': True,
+            'input': True,
+            'scrollback': '64K',
+            'queue_size': '256K',
+            'slow_client': 'drop',
+        },
     }
@@ -0,0 +1,391 @@
+import os
+import sys
+import tty
+import time
+import signal
+import socket
+import struct
+import select
+import tempfile
+import termios
+import selectors
+import threading
+from pathlib import Path
+from collections import deque
+
+from darkwing.utils.units import parse_size
+
+ATTACH_SOCKET = 'attach.sock'
+
+SLOW_CLIENT_POLICIES = ('drop', 'disconnect')
+
+# Frame types; each frame is a type byte, 4-byte length, then data
+FRAME_REPLAYED = 0
+FRAME_STDOUT = 1
+FRAME_STDERR = 2
+FRAME_EXIT = 3
+# From clients: input (empty for EOF), and tty size as lines, columns
+FRAME_STDIN = 4
+FRAME_RESIZE = 5
+
+STREAM_FRAMES = {'stdout': FRAME_STDOUT, 'stderr': FRAME_STDERR}
+INPUT_FRAMES = (FRAME_STDIN, FRAME_RESIZE)
+
+_header = struct.Struct('!BI')
+WINSIZE = struct.Struct('!HH')
+
+def _frame(kind, data=b''):
+    return _header.pack(kind, len(data)) + data
+
+
+class _Client(object):
+
+    __slots__ = ('sock', 'queue', 'queued', 'offset', 'dropped', 'inbuf')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.queue = deque()
+        self.queued = 0
+        # Bytes of queue[0] already sent
+        self.offset = 0
+        self.dropped = 0
+        # Partial frame received
+        self.inbuf = bytearray()
+
+
+# Fans output out to clients of a UNIX socket, from the owner's
+# selector; new clients get the scrollback first, and clients too
+# slow for queue_size miss frames ('drop') or are disconnected
+class AttachServer(object):
+
+    def __init__(self, path, scrollback=64 * 1024, queue_size=256 * 1024,
+                 slow_client='drop', on_input=None):
+        if slow_client not in SLOW_CLIENT_POLICIES:
+            raise ValueError(f'Invalid slow client policy: {slow_client!r}')
+        self.path = Path(path)
+        self.scrollback = scrollback
+        self.queue_size = queue_size
+        self.slow_client = slow_client
+        self.on_input = on_input
+        self.dropped = 0
+        self._sock = None
+        self._selector = None
+        self._clients = {}
+        self._history = deque()
+        self._history_size = 0
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} path={str(self.path)!r} "
+            f"clients={len(self._clients)}>"
+        )
+
+    def open(self, selector):
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+        # Bound in a private dir, then moved into place once its mode
+        # is set, so it's never reachable with umask's (umask itself
+        # being process-wide, so racy with threads)
+        private = Path(tempfile.mkdtemp(
+            prefix=f'.{self.path.name}.', dir=self.path.parent
+        ))
+        sock = socket.socket(socket.AF_UNIX)
+        try:
+            try:
+                sock.bind(str(private / self.path.name))
+                os.chmod(private / self.path.name, 0o660)
+                os.replace(private / self.path.name, self.path)
+            finally:
+                try:
+                    (private / self.path.name).unlink()
+                except FileNotFoundError:
+                    pass
+                private.rmdir()
+            sock.listen()
+            sock.setblocking(False)
+        except Exception:
+            sock.close()
+            raise
+        self._sock = sock
+        self._selector = selector
+        selector.register(sock, selectors.EVENT_READ, self._accept)
+        return self
+
+    def _accept(self, key, mask):
+        try:
+            sock, _ = self._sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        sock.setblocking(False)
+        client = _Client(sock)
+        self._clients[sock] = client
+        self._selector.register(
+            sock, selectors.EVENT_READ,
+            lambda key, mask: self._service(client, mask),
+        )
+        # Replay is never dropped, as it's bounded by scrollback anyway
+        for frame in self._history:
+            self._queue(client, frame)
+        self._queue(client, _frame(FRAME_REPLAYED))
+        self._flush(client)
+
+    def _service(self, client, mask):
+        if mask & selectors.EVENT_READ:
+            try:
+                data = client.sock.recv(64 * 1024)
+            except (BlockingIOError, InterruptedError):
+                data = None
+            except OSError:
+                data = b''
+            if data == b'' or (data and not self._received(client, data)):
+                self._disconnect(client)
+                return
+        if mask & selectors.EVENT_WRITE:
+            self._flush(client)
+
+    def _received(self, client, data):
+        # Passes on whole frames; False if client should be dropped
+        if self.on_input is None:
+            return True
+        buf = client.inbuf
+        buf.extend(data)
+        while len(buf) >= _header.size:
+            kind, length = _header.unpack_from(buf)
+            if kind not in INPUT_FRAMES or length > self.queue_size:
+                return False
+            end = _header.size + length
+            if len(buf) < end:
+                break
+            frame_data = bytes(buf[_header.size:end])
+            del buf[:end]
+            if not self.on_input(kind, frame_data):
+                return False
+        return True
+
+    def _queue(self, client, frame):
+        client.queue.append(frame)
+        client.queued += len(frame)
+
+    def _flush(self, client):
+        queue = client.queue
+        while queue:
+            view = memoryview(queue[0])[client.offset:]
+            try:
+                sent = client.sock.send(view)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                self._disconnect(client)
+                return
+            if sent < len(view):
+                client.offset += sent
+                break
+            client.queued -= len(queue.popleft())
+            client.offset = 0
+
+        # Only wait for writability while there's something to send
+        events = selectors.EVENT_READ
+        if queue:
+            events |= selectors.EVENT_WRITE
+        key = self._selector.get_key(client.sock)
+        if key.events != events:
+            self._selector.modify(client.sock, events, key.data)
+
+    def _disconnect(self, client):
+        if self._clients.pop(client.sock, None) is None:
+            return
+        try:
+            self._selector.unregister(client.sock)
+        except (KeyError, ValueError):
+            pass
+        client.sock.close()
+        client.queue.clear()
+
+    def publish(self, stream, data):
+        if not data:
+            return
+        frame = _frame(STREAM_FRAMES[stream], data)
+
+        self._history.append(frame)
+        self._history_size += len(frame)
+        while self._history_size > self.scrollback and len(self._history) > 1:
+            self._history_size -= len(self._history.popleft())
+
+        for client in list(self._clients.values()):
+            if client.queued + len(frame) > self.queue_size:
+                if self.slow_client == 'disconnect':
+                    self._disconnect(client)
+                else:
+                    client.dropped += len(data)
+                    self.dropped += len(data)
+                continue
+            was_empty = not client.queue
+            self._queue(client, frame)
+            # Try sending straight away rather than next time round
+            if was_empty:
+                self._flush(client)
+
+    @property
+    def clients(self):
+        return len(self._clients)
+
+    def close(self, returncode=None, timeout=1.0):
+        # Flushes exit code and queued output (up to timeout) first
+        if self._sock is None:
+            return
+        if returncode is not None:
+            frame = _frame(FRAME_EXIT, str(returncode).encode())
+            for client in self._clients.values():
+                self._queue(client, frame)
+
+        deadline = time.monotonic() + timeout
+        for client in list(self._clients.values()):
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0 or not client.queue:
+                    continue
+                client.sock.settimeout(remaining)
+                first = True
+                for frame in client.queue:
+                    view = memoryview(frame)
+                    if first:
+                        view = view[client.offset:]
+                        first = False
+                    client.sock.sendall(view)
+            except OSError:
+                pass
+            finally:
+                self._disconnect(client)
+
+        self._selector.unregister(self._sock)
+        self._sock.close()
+        self._sock = None
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+def attach_input(config):
+    # Whether attached clients may write to the container's input
+    attach_config = config.data.get('attach', {})
+    return bool(
+        attach_config.get('enabled', True) and
+        attach_config.get('input', True)
+    )
+
+def make_attach_server(config, rundir, on_input=None):
+    attach_config = config.data.get('attach', {})
+    if not attach_config.get('enabled', True):
+        return None
+    return AttachServer(
+        Path(rundir.path) / ATTACH_SOCKET,
+        scrollback=parse_size(attach_config.get('scrollback', '64K')),
+        queue_size=parse_size(attach_config.get('queue_size', '256K')),
+        slow_client=attach_config.get('slow_client', 'drop'),
+        on_input=on_input if attach_input(config) else None,
+    )
+
+
+class _InputSender(object):
+    # Copies stdin to an attach socket from a thread (as reads block),
+    # along with the tty's size if stdin is one
+
+    def __init__(self, sock, stdin):
+        self.sock = sock
+        self.fd = stdin if isinstance(stdin, int) else stdin.fileno()
+        self.isatty = os.isatty(self.fd)
+        self._lock = threading.Lock()
+        self._stop_r, self._stop_w = os.pipe()
+        self._thread = threading.Thread(
+            name='attach-input', target=self._run, daemon=True,
+        )
+
+    def send(self, kind, data=b''):
+        with self._lock:
+            self.sock.sendall(_frame(kind, data))
+
+    def send_size(self, *args):
+        try:
+            size = os.get_terminal_size(self.fd)
+            self.send(FRAME_RESIZE, WINSIZE.pack(size.lines, size.columns))
+        except OSError:
+            pass
+
+    def _run(self):
+        try:
+            while True:
+                ready, _, _ = select.select([self.fd, self._stop_r], [], [])
+                if self._stop_r in ready:
+                    return
+                data = os.read(self.fd, 64 * 1024)
+                self.send(FRAME_STDIN, data)
+                if not data:
+                    return
+        except OSError:
+            pass
+
+    def start(self):
+        if self.isatty:
+            self.send_size()
+        self._thread.start()
+
+    def stop(self):
+        os.write(self._stop_w, b'\0')
+        if self._thread.ident is not None:
+            self._thread.join()
+        os.close(self._stop_r)
+        os.close(self._stop_w)
+
+def attach(path, stdout=None, stderr=None, replay=True, stdin=None):
+    # Copies output until exit, sending any stdin (set raw if a tty);
+    # returns exit code, or None if closed without one
+    if stdout is None:
+        stdout = sys.stdout.buffer
+    if stderr is None:
+        stderr = sys.stderr.buffer
+    outputs = {FRAME_STDOUT: stdout, FRAME_STDERR: stderr}
+
+    sock = socket.socket(socket.AF_UNIX)
+    sock.connect(str(path))
+    sender = _InputSender(sock, stdin) if stdin is not None else None
+    saved_attrs = None
+    saved_handler = False
+    replaying = True
+    with sock, sock.makefile('rb') as f:
+        try:
+            if sender:
+                if sender.isatty:
+                    saved_attrs = termios.tcgetattr(sender.fd)
+                    tty.setraw(sender.fd, termios.TCSANOW)
+                    # Handlers can only be set from the main thread
+                    if threading.current_thread() is threading.main_thread():
+                        saved_handler = signal.signal(
+                            signal.SIGWINCH, sender.send_size
+                        )
+                sender.start()
+
+            while True:
+                header = f.read(_header.size)
+                if len(header) < _header.size:
+                    return None
+                kind, length = _header.unpack(header)
+                data = f.read(length)
+                if len(data) < length:
+                    return None
+
+                if kind == FRAME_REPLAYED:
+                    replaying = False
+                elif kind == FRAME_EXIT:
+                    return int(data)
+                elif kind in outputs and (replay or not replaying):
+                    outputs[kind].write(data)
+                    outputs[kind].flush()
+        finally:
+            if saved_handler is not False:
+                signal.signal(signal.SIGWINCH, saved_handler)
+            if sender:
+                sender.stop()
+            if saved_attrs is not None:
+                termios.tcsetattr(sender.fd, termios.TCSADRAIN, saved_attrs)
@@ -0,0 +1,302 @@
+import io
+import os
+import sys
+import gzip
+import time
+import queue
+import shutil
+import threading
+import itertools
+import traceback
+from pathlib import Path
+
+from darkwing.utils.units import parse_size
+
+LOG_STREAMS = ('stdout', 'stderr')
+
+
+# Most recent bytes written, for tail queries without disk reads
+class TailBuffer(object):
+
+    def __init__(self, max_size=64 * 1024):
+        self.max_size = max_size
+        self._buf = bytearray()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buf)
+
+    def append(self, data):
+        with self._lock:
+            if len(data) >= self.max_size:
+                self._buf[:] = data[-self.max_size:]
+                return
+            self._buf.extend(data)
+            excess = len(self._buf) - self.max_size
+            if excess > 0:
+                del self._buf[:excess]
+
+    def get(self, size=None):
+        with self._lock:
+            if size is None or size >= len(self._buf):
+                return bytes(self._buf)
+            return bytes(self._buf[-size:])
+
+
+# Buffered log sink for iopump(), rotated at max_bytes (backups
+# optionally gzipped in background); written out every
+# flush_interval, so flush() is cheap, use sync() to force
+class RotatingLogWriter(io.RawIOBase):
+
+    def __init__(self, path, max_bytes=10 << 20, backups=5, compress=False,
+                 buffer_size=64 * 1024, flush_interval=1.0, tail_size=64 * 1024,
+                 flush_thread=True):
+        super().__init__()
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.tail = TailBuffer(tail_size)
+        self._lock = threading.Lock()
+        self._file = None
+        self._size = 0
+        self._dirty = False
+        self._last_flush = time.monotonic()
+        # Rotated logs awaiting compression, handled in order by one
+        # thread (started on first use)
+        self._compressor = None
+        self._to_compress = queue.SimpleQueue()
+        # Numbered on from any an earlier writer left behind, which are
+        # then treated as its latest rotations
+        leftovers = self._leftovers()
+        self._rotations = itertools.count(
+            leftovers[-1][0] + 1 if leftovers else 0
+        )
+        for _, pending in leftovers:
+            self._rotated(pending)
+        self._stop_flusher = threading.Event()
+        self._open()
+        self._flusher = None
+        # Without a flusher thread, caller must call flush() periodically
+        if flush_interval and flush_thread:
+            self._flusher = threading.Thread(
+                name=f'log-flush-{self.path.name}', target=self._flush_loop,
+                daemon=True,
+            )
+            self._flusher.start()
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} path={str(self.path)!r}>"
+
+    def _open(self):
+        self._file = open(self.path, 'ab', buffering=self.buffer_size)
+        self._size = self._file.tell()
+
+    def _flush_loop(self):
+        while not self._stop_flusher.wait(self.flush_interval):
+            self.sync()
+
+    def _sync(self):
+        if self._file and not self._file.closed:
+            self._file.flush()
+        self._dirty = False
+        self._last_flush = time.monotonic()
+
+    def _backup_path(self, n):
+        return self.path.with_name(f'{self.path.name}.{n}')
+
+    def _shift_backups(self):
+        # One file per backup, either compressed or not (eg. if that
+        # failed), so each shifted one replaces both forms
+        for n in range(self.backups - 1, 0, -1):
+            for suffix in ('', '.gz'):
+                src = Path(f'{self._backup_path(n)}{suffix}')
+                if not src.exists():
+                    continue
+                for other in ('', '.gz'):
+                    try:
+                        os.unlink(f'{self._backup_path(n + 1)}{other}')
+                    except FileNotFoundError:
+                        pass
+                os.replace(src, f'{self._backup_path(n + 1)}{suffix}')
+
+    def _leftovers(self):
+        # (index, path) of rotated logs not yet made backups, in order
+        prefix = f'{self.path.name}.rotating.'
+        found = []
+        for path in self.path.parent.glob(f'{prefix}*'):
+            index = path.name[len(prefix):]
+            if index.isdigit():
+                found.append((int(index), path))
+        return sorted(found)
+
+    def _rotated(self, pending):
+        # Makes pending (already renamed away from path) backup 1
+        if self.backups <= 0:
+            os.unlink(pending)
+        elif self.compress:
+            # Shifting backups waits for earlier compressions, so both
+            # happen in the compressor thread rather than blocking writes
+            if self._compressor is None:
+                self._compressor = threading.Thread(
+                    name=f'log-compress-{self.path.name}',
+                    target=self._compress_loop, daemon=True,
+                )
+                self._compressor.start()
+            self._to_compress.put(pending)
+        else:
+            self._shift_backups()
+            os.replace(pending, self._backup_path(1))
+
+    def _rotate(self):
+        # With writer lock held, so only renames here
+        self._file.close()
+        if self.backups <= 0:
+            os.unlink(self.path)
+        elif self.compress:
+            pending = self.path.with_name(
+                f'{self.path.name}.rotating.{next(self._rotations)}'
+            )
+            os.replace(self.path, pending)
+            self._rotated(pending)
+        else:
+            self._rotated(self.path)
+        self._open()
+
+    def _compress_loop(self):
+        while True:
+            pending = self._to_compress.get()
+            if pending is None:
+                return
+            try:
+                self._shift_backups()
+                _compress_file(pending, Path(f'{self._backup_path(1)}.gz'))
+            except OSError:
+                print(f'Error compressing {pending}:', file=sys.stderr)
+                traceback.print_exc(file=sys.stderr)
+                # Kept uncompressed instead, so still counted as a
+                # backup, and later rotations carry on
+                try:
+                    os.replace(pending, self._backup_path(1))
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    traceback.print_exc(file=sys.stderr)
+
+    def readable(self):
+        return False
+
+    def writable(self):
+        return True
+
+    def isatty(self):
+        return False
+
+    def fileno(self):
+        # Regular file, so always selectable as writable
+        return self._file.fileno()
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed log')
+        with self._lock:
+            if self._size and self._size + len(data) > self.max_bytes:
+                self._rotate()
+            n = self._file.write(data)
+            self._size += n
+            self._dirty = True
+        self.tail.append(data)
+        return n
+
+    def flush(self):
+        # Time-based; only writes through once flush_interval has passed
+        with self._lock:
+            if self._dirty and (
+                not self.flush_interval or
+                time.monotonic() - self._last_flush >= self.flush_interval
+            ):
+                self._sync()
+
+    def sync(self):
+        with self._lock:
+            if self._dirty:
+                self._sync()
+
+    def close(self):
+        if self.closed:
+            return
+        self._stop_flusher.set()
+        if self._flusher:
+            self._flusher.join()
+        with self._lock:
+            if self._file:
+                self._file.close()
+            compressor, self._compressor = self._compressor, None
+        # Outside the lock, as compressing may take a while
+        if compressor:
+            self._to_compress.put(None)
+            compressor.join()
+        super().close()
+
+
+def _compress_file(path, gz_path):
+    gz_path = Path(gz_path)
+    tmp_path = gz_path.with_name(f'{gz_path.name}.tmp')
+    try:
+        with open(path, 'rb') as src, gzip.open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+        os.replace(tmp_path, gz_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    os.unlink(path)
+
+def read_log_tail(path, size=64 * 1024):
+    # Uncompressed logs only
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            f.seek(max(0, end - size))
+            return f.read()
+    except FileNotFoundError:
+        return b''
+
+def log_dir(config, rundir):
+    # 'runtime' (default) is the rundir, 'storage' the storage dir,
+    # else an absolute path
+    location = config.data.get('logs', {}).get('location') or 'runtime'
+    if location == 'runtime':
+        if not rundir:
+            raise ValueError('Runtime log location requires a runtime dir')
+        return Path(rundir.path) / 'logs'
+    elif location == 'storage':
+        return Path(config.data['storage']['base']) / 'logs'
+    path = Path(location)
+    if not path.is_absolute():
+        raise ValueError(f'Log location "{location}" must be absolute')
+    return path
+
+def make_log_writers(config, rundir, streams=LOG_STREAMS, flush_thread=True):
+    logs_config = config.data.get('logs', {})
+    base = log_dir(config, rundir)
+    base.mkdir(mode=0o750, parents=True, exist_ok=True)
+
+    return {
+        stream: RotatingLogWriter(
+            base / f'{stream}.log',
+            max_bytes=parse_size(logs_config.get('max_size', '10M')),
+            backups=int(logs_config.get('backups', 5)),
+            compress=bool(logs_config.get('compress', False)),
+            buffer_size=parse_size(logs_config.get('buffer_size', '64K')),
+            flush_interval=float(logs_config.get('flush_interval', 1.0)),
+            tail_size=parse_size(logs_config.get('tail_size', '64K')),
+            flush_thread=flush_thread,
+        )
+        for stream in streams
+    }
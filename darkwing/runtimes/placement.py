@@ -0,0 +1,264 @@
+import os
+import json
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+from darkwing.utils import FileLock, is_locked, write_atomic
+
+NODE_PATH = Path('/sys/devices/system/node')
+
+# Shared allocation table, in the context's runtime dir
+PLACEMENT_FILE = 'placement.json'
+
+POLICIES = ('none', 'static', 'spread', 'pack')
+
+def parse_cpulist(text):
+    # Kernel cpulist format, eg '0-3,8,10-11'
+    cpus = set()
+    for part in text.strip().split(','):
+        part = part.strip()
+        if not part:
+            continue
+        start, sep, end = part.partition('-')
+        if sep:
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(start))
+    return cpus
+
+def format_cpulist(cpus):
+    ranges = []
+    for cpu in sorted(set(cpus)):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(
+        str(start) if start == end else f'{start}-{end}'
+        for start, end in ranges
+    )
+
+def host_topology():
+    # NUMA node -> usable CPUs; single node 0 if no NUMA info
+    allowed = os.sched_getaffinity(0)
+    nodes = {}
+    try:
+        node_dirs = list(NODE_PATH.glob('node[0-9]*'))
+    except OSError:
+        node_dirs = []
+    for node_dir in node_dirs:
+        try:
+            cpus = parse_cpulist((node_dir / 'cpulist').read_text())
+        except OSError:
+            continue
+        cpus &= allowed
+        if cpus:
+            nodes[int(node_dir.name[4:])] = cpus
+    if not nodes:
+        nodes[0] = set(allowed)
+    return nodes
+
+
+class PlacementError(Exception):
+    pass
+
+
+# CPUs (and so NUMA nodes) handed out to containers, to spread or
+# pack them; with a path, shared as JSON under a FileLock, dropping
+# entries whose owner lockfile is no longer held
+class CpuAllocator(object):
+
+    def __init__(self, topology=None, path=None):
+        self.nodes = topology if topology is not None else host_topology()
+        self._cpu_node = {
+            cpu: node for node, cpus in self.nodes.items() for cpu in cpus
+        }
+        self._users = { cpu: 0 for cpu in self._cpu_node }
+        self._allocated = {}
+        self._owners = {}
+        self._lock = threading.Lock()
+        self.path = None
+        self._file_lock = None
+        if path is not None:
+            self.path = Path(path)
+            self._file_lock = FileLock(
+                self.path.with_name(self.path.name + '.lock')
+            )
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} nodes={len(self.nodes)} "
+            f"cpus={len(self._cpu_node)} allocated={len(self._allocated)}>"
+        )
+
+    @contextmanager
+    def _table(self):
+        # Holds our locks, with any shared table loaded while held and
+        # saved after if changed
+        with self._lock:
+            if self.path is None:
+                yield
+                return
+            self.path.parent.mkdir(mode=0o770, parents=True, exist_ok=True)
+            with self._file_lock:
+                table = self._load()
+                yield
+                new_table = self._dump()
+                if new_table != table:
+                    write_atomic(
+                        self.path,
+                        json.dumps(new_table, separators=(',', ':')),
+                        mode=0o640,
+                    )
+
+    def _load(self):
+        try:
+            table = json.loads(self.path.read_text())
+        except (FileNotFoundError, ValueError):
+            table = {}
+        self._users = { cpu: 0 for cpu in self._cpu_node }
+        self._allocated = {}
+        self._owners = {}
+        for key, entry in table.items():
+            owner = entry.get('owner')
+            if owner and not is_locked(owner):
+                continue
+            cpus, mems = set(entry['cpus']), set(entry['mems'])
+            for cpu in cpus:
+                if cpu in self._users:
+                    self._users[cpu] += 1
+            self._allocated[key] = (cpus, mems)
+            self._owners[key] = owner
+        return table
+
+    def _dump(self):
+        return {
+            key: {
+                'cpus': sorted(cpus),
+                'mems': sorted(mems),
+                'owner': self._owners.get(key),
+            }
+            for key, (cpus, mems) in self._allocated.items()
+        }
+
+    def _free_cpus(self, node):
+        return [ c for c in sorted(self.nodes[node]) if not self._users[c] ]
+
+    def _least_used(self, node, count):
+        return sorted(self.nodes[node], key=lambda c: (self._users[c], c))[
+            :count
+        ]
+
+    def _choose_node(self, count, policy):
+        free = { node: len(self._free_cpus(node)) for node in self.nodes }
+        fits = [ node for node, n in free.items() if n >= count ]
+        if not fits:
+            return None
+        if policy == 'pack':
+            # Fullest node that still fits, keeping others free
+            return min(fits, key=lambda node: (free[node], node))
+        # Emptiest node
+        return max(fits, key=lambda node: (free[node], -node))
+
+    def allocate(self, key, count=1, policy='spread', node=None,
+                 exclusive=False, owner=None):
+        # On a single node where possible; exclusive raises PlacementError
+        # rather than sharing CPUs
+        if policy not in ('spread', 'pack'):
+            raise ValueError(f'Invalid placement policy: {policy!r}')
+        if count < 1:
+            raise ValueError(f'Invalid CPU count: {count!r}')
+
+        with self._table():
+            if key in self._allocated:
+                return self._allocated[key]
+
+            if node is not None:
+                if node not in self.nodes:
+                    raise PlacementError(f'Unknown NUMA node {node}')
+                nodes = [node]
+            else:
+                chosen = self._choose_node(count, policy)
+                nodes = [chosen] if chosen is not None else []
+
+            if nodes and len(self._free_cpus(nodes[0])) >= count:
+                cpus = set(self._free_cpus(nodes[0])[:count])
+            elif exclusive:
+                raise PlacementError(
+                    f'Not enough free CPUs for {key!r} (wanted {count})'
+                )
+            elif nodes:
+                # Share the least-used CPUs on the requested node
+                cpus = set(self._least_used(nodes[0], count))
+            else:
+                # Nothing fits on one node; share least-used host-wide
+                cpus = set(sorted(
+                    self._users, key=lambda c: (self._users[c], c)
+                )[:count])
+
+            return self._assign(key, cpus, owner=owner)
+
+    def reserve(self, key, cpus, mems=None, owner=None):
+        # Static cpuset, so allocate() avoids it
+        cpus = set(cpus)
+        with self._table():
+            if key in self._allocated:
+                return self._allocated[key]
+            return self._assign(key, cpus, mems, owner=owner)
+
+    def _assign(self, key, cpus, mems=None, owner=None):
+        for cpu in cpus:
+            if cpu in self._users:
+                self._users[cpu] += 1
+        if mems is None:
+            mems = { self._cpu_node[c] for c in cpus if c in self._cpu_node }
+        result = (cpus, set(mems))
+        self._allocated[key] = result
+        self._owners[key] = str(owner) if owner else None
+        return result
+
+    def release(self, key):
+        with self._table():
+            result = self._allocated.pop(key, None)
+            self._owners.pop(key, None)
+            if result:
+                for cpu in result[0]:
+                    if self._users.get(cpu):
+                        self._users[cpu] -= 1
+        return result
+
+    def allocated(self):
+        with self._table():
+            return dict(self._allocated)
+
+
+def place_container(allocator, key, placement, owner=None):
+    # Held while owner (a lockfile) stays locked; returns cpulist strings
+    # (cpus, mems), or None if not pinned
+    if not placement:
+        return None
+
+    policy = placement.get('policy', 'none')
+    if policy not in POLICIES:
+        raise ValueError(f'Invalid placement policy: {policy!r}')
+
+    if policy == 'none':
+        return None
+    elif policy == 'static':
+        cpus = parse_cpulist(placement.get('cpus', ''))
+        if not cpus:
+            raise ValueError('Static placement requires "cpus"')
+        mems = placement.get('mems')
+        cpus, mems = allocator.reserve(
+            key, cpus, parse_cpulist(mems) if mems else None, owner=owner
+        )
+    else:
+        node = placement.get('node', -1)
+        cpus, mems = allocator.allocate(
+            key, count=int(placement.get('count', 1)), policy=policy,
+            node=None if node < 0 else node,
+            exclusive=placement.get('exclusive', False), owner=owner,
+        )
+
+    return format_cpulist(cpus), format_cpulist(mems)
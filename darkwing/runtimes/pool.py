@@ -0,0 +1,194 @@
+import os
+import time
+import threading
+import itertools
+import traceback
+from collections import deque
+
+from darkwing.config.container import Container
+from darkwing.utils.host import get_host_info
+
+
+# Members' own bundles, in their config's storage dir
+POOL_DIR = '.pool'
+
+
+# Containers for one config created ahead of runs, so a run need
+# only 'runc start' one; own bundle for the spec, shared rootfs.
+# Refilled after runs and replaced after ttl, until closed
+class WarmPool(object):
+
+    # Delay before retrying after a failed refill
+    RETRY_INTERVAL = 5.0
+
+    def __init__(self, executor, config, context, size=None, ttl=None,
+                 tty=None):
+        pool_config = {}
+        if hasattr(context, 'data'):
+            pool_config = context.data.get('pool', {})
+        self.executor = executor
+        self.config = config
+        self.context = context
+        self.size = int(pool_config.get('size', 0) if size is None else size)
+        self.ttl = float(pool_config.get('ttl', 300.0) if ttl is None else ttl)
+        if tty is None:
+            # As a run would choose (see Container.use_tty)
+            tty = (
+                config.data['exec'].get('terminal', True) and
+                config.data.get('logs', {}).get('mode') != 'file' and
+                executor._host_tty()
+            )
+        self.tty = bool(tty)
+        # Runs served by a member
+        self.acquired = 0
+        self._members = deque()
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._closed = False
+        with executor._condition:
+            executor._pools.append(self)
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} config={self.config.name!r} "
+            f"size={self.size} ready={len(self._members)}>"
+        )
+
+    def __len__(self):
+        return len(self._members)
+
+    def _new_member(self):
+        # Unique per process, as runc state may outlive a crashed one
+        name = f'{self.config.name}-warm-{os.getpid()}-{next(self._ids)}'
+        container = Container(name, self.config, context=self.context)
+        container.use_tty = self.tty
+        container.pool = self
+        container.bundle_path = container.path / POOL_DIR / name
+        self.executor.create_container(container, attach_stdio=False)
+        return container
+
+    def _discard(self, container):
+        container.pool = None
+        try:
+            self.executor.remove_container(container, force=True)
+        except Exception:
+            self.executor._write_log(traceback.format_exc())
+        container.close()
+        if container.rundir:
+            container.rundir.remove()
+
+    def _expire(self):
+        expired = []
+        cutoff = time.monotonic() - self.ttl
+        with self._lock:
+            while self._members and self._members[0][0] < cutoff:
+                expired.append(self._members.popleft()[1])
+        for container in expired:
+            self.executor._debug_log(
+                f'Warm container {container.name} expired'
+            )
+            self._discard(container)
+        return len(expired)
+
+    def fill(self):
+        # Returns number added
+        added = 0
+        # Members' init processes must be reparented to us to be reaped
+        self.executor._set_subreaper(True)
+        while not self._closed:
+            with self._lock:
+                if len(self._members) >= self.size:
+                    break
+            container = self._new_member()
+            with self._lock:
+                closed = self._closed
+                if not closed:
+                    self._members.append((time.monotonic(), container))
+            if closed:
+                # Closed while creating, so don't keep it
+                self._discard(container)
+                break
+            added += 1
+        return added
+
+    def _next_check(self):
+        with self._lock:
+            if self._members:
+                expires = self._members[0][0] + self.ttl
+                return max(0, expires - time.monotonic())
+        return self.ttl
+
+    def _refill_loop(self):
+        while not self._closed:
+            delay = None
+            try:
+                self._expire()
+                self.fill()
+            except Exception:
+                if self._closed:
+                    break
+                self.executor._write_log(traceback.format_exc())
+                delay = self.RETRY_INTERVAL
+            if delay is None:
+                delay = self._next_check()
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+
+    def start(self):
+        if self._thread is None and self.size > 0:
+            # Probed here rather than by the first refill, as its
+            # commands' exits could be reaped by the executor first
+            get_host_info()
+            self._thread = threading.Thread(
+                name=f'{self.config.name}-pool', target=self._refill_loop,
+                daemon=True,
+            )
+            self._thread.start()
+        return self
+
+    def acquire(self, tty=None):
+        # Oldest unexpired member, or None (also if tty choice differs)
+        if tty is not None and bool(tty) != self.tty:
+            return None
+        container = None
+        cutoff = time.monotonic() - self.ttl
+        stale = []
+        with self._lock:
+            while self._members:
+                created, member = self._members.popleft()
+                if created >= cutoff:
+                    container = member
+                    self.acquired += 1
+                    break
+                stale.append(member)
+        for member in stale:
+            self._discard(member)
+        if container is not None:
+            container.pool = None
+        return container
+
+    def refill(self):
+        # Only once a run ends, so refills don't compete with it
+        self._wakeup.set()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._wakeup.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+        with self._lock:
+            members = [ member for _, member in self._members ]
+            self._members.clear()
+        for container in members:
+            self._discard(container)
+
+        with self.executor._condition:
+            if self in self.executor._pools:
+                self.executor._pools.remove(self)
@@ -7,21 +7,33 @@ import termios
 import socket
 import select
 import signal
+import selectors
 import threading
 import subprocess
 import array
 import json
 import errno
+import time
 import traceback
+import itertools
 from pathlib import Path
 from functools import partial
 from collections import deque
+from contextlib import contextmanager
 
 from darkwing.utils import (
-    get_runtime_path, ensure_dirs, simple_command, compute_returncode,
-    set_subreaper, output_isatty, resize_tty, send_tty_eof,
+    get_runtime_path, ensure_dirs, compute_returncode,
+    set_subreaper, output_isatty, resize_tty, send_tty_eof, parse_signal,
+    FileLock,
 )
-from . import spec
+from darkwing.utils.timers import TimerWheel
+from darkwing.utils.host import get_host_info
+from darkwing.utils.timing import get_timer
+from darkwing.utils.profiling import get_profiler
+from darkwing.storage import idmap, trash
+from . import spec, secrets
+from .placement import CpuAllocator, PLACEMENT_FILE, place_container
+from .logs import make_log_writers
 
 def _noop_sighandler(signum, frame):
     pass
@@ -29,8 +41,72 @@ def _noop_sighandler(signum, frame):
 def _raise_sighandler(signum, frame):
     raise Exception(f'Caught signal {signum}')
 
+def _lock_errmsg(errmsg, lock):
+    owner = lock.owner()
+    return f'{errmsg} (pid {owner})' if owner else errmsg
+
+def _read_pipes(*pipes):
+    # Reads each pipe to EOF at once, returning the bytes from each
+    outputs = { pipe: bytearray() for pipe in pipes }
+    with selectors.DefaultSelector() as selector:
+        for pipe in pipes:
+            selector.register(pipe, selectors.EVENT_READ)
+        while selector.get_map():
+            for key, _ in selector.select():
+                data = os.read(key.fd, 64 * 1024)
+                if data:
+                    outputs[key.fileobj].extend(data)
+                else:
+                    selector.unregister(key.fileobj)
+    return [ bytes(outputs[pipe]) for pipe in pipes ]
+
+# Per-stream counters; stalls are times the buffer was full
+class IOStats(object):
+
+    __slots__ = (
+        'bytes_in', 'bytes_out', 'reads', 'writes',
+        'stalls', 'stall_ns', 'max_buffered', '_stall_start',
+    )
+
+    def __init__(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.reads = 0
+        self.writes = 0
+        self.stalls = 0
+        self.stall_ns = 0
+        self.max_buffered = 0
+        self._stall_start = None
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} in={self.bytes_in} "
+            f"out={self.bytes_out} stalls={self.stalls}>"
+        )
+
+    def _stall(self, stalled):
+        if stalled:
+            if self._stall_start is None:
+                self._stall_start = time.monotonic_ns()
+                self.stalls += 1
+        elif self._stall_start is not None:
+            self.stall_ns += time.monotonic_ns() - self._stall_start
+            self._stall_start = None
+
+    def as_dict(self):
+        return {
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'reads': self.reads,
+            'writes': self.writes,
+            'stalls': self.stalls,
+            'stall_ns': self.stall_ns,
+            'max_buffered': self.max_buffered,
+        }
+
 def iopump(read_from, write_to, stop_event=None, pipe_eof=True,
-           select_timeout=0.2, future=None, print_exc=False):
+           select_timeout=0.2, future=None, print_exc=False, stats=None,
+           bufsize=None):
     # Allow giving raw fds
     if isinstance(read_from, int):
         read_from = open(read_from, 'rb', buffering=0)
@@ -39,7 +115,10 @@ def iopump(read_from, write_to, stop_event=None, pipe_eof=True,
 
     # Anything else to init?
     buf = bytearray()
-    bufsize = io.DEFAULT_BUFFER_SIZE // 2
+    # Explicit size is taken as-is, otherwise capped for pipes below
+    fixed_bufsize = bufsize is not None
+    if not fixed_bufsize:
+        bufsize = io.DEFAULT_BUFFER_SIZE // 2
     use_read1 = hasattr(read_from, 'read1')
     exc = None
 
@@ -52,7 +131,7 @@ def iopump(read_from, write_to, stop_event=None, pipe_eof=True,
         # (Taken from asyncio)
         mode = os.fstat(write_to.fileno()).st_mode
         pipe_eof = stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode)
-        if pipe_eof:
+        if pipe_eof and not fixed_bufsize:
             # Ensure we use at most the max pipe writeable size
             # TODO: set write_to non-blocking?
             bufsize = min(bufsize, select.PIPE_BUF)
@@ -76,6 +155,10 @@ def iopump(read_from, write_to, stop_event=None, pipe_eof=True,
                 # Read if room in buffer
                 elif len(buf) < bufsize:
                     rlist.append(read_from)
+                    if stats:
+                        stats._stall(False)
+                elif stats:
+                    stats._stall(True)
             # Write if data in buffer
             if buf:
                 wlist.append(write_to)
@@ -127,6 +210,11 @@ def iopump(read_from, write_to, stop_event=None, pipe_eof=True,
                     pass
                 elif data:
                     buf.extend(data)
+                    if stats:
+                        stats.reads += 1
+                        stats.bytes_in += len(data)
+                        if len(buf) > stats.max_buffered:
+                            stats.max_buffered = len(buf)
                 else:
                     # Closed
                     try:
@@ -159,6 +247,9 @@ def iopump(read_from, write_to, stop_event=None, pipe_eof=True,
                 # Update buffer
                 if sent:
                     del buf[:sent]
+                    if stats:
+                        stats.writes += 1
+                        stats.bytes_out += sent
 
             # Bit of housekeeping
             data = None
@@ -172,6 +263,8 @@ def iopump(read_from, write_to, stop_event=None, pipe_eof=True,
     finally:
         # We done
         buf.clear()
+        if stats:
+            stats._stall(False)
 
         # TODO: set exception?
         if read_from:
@@ -211,6 +304,147 @@ class RuncError(Exception):
     # TODO: __repr__()
 
 
+# Process from exec_in_container(); stdio are raw file objects (all
+# the same pty with a tty)
+class ExecProcess(object):
+
+    def __init__(self, executor, container, args, tty=False):
+        self.executor = executor
+        self.container = container
+        self.args = args
+        self.use_tty = bool(tty)
+        self.pid = None
+        self.tty = None
+        self.stdin = None
+        self.stdout = None
+        self.stderr = None
+        self.returncode = None
+        # Runc process, if running in foreground
+        self._proc = None
+        self._closing = None
+        self._close_fds = deque()
+        self._io_threads = deque()
+        self._stop_event = None
+        self.io_stats = {}
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} container={self.container.name!r} "
+            f"pid={self.pid!r} args={self.args!r}>"
+        )
+
+    @property
+    def name(self):
+        return self.container.name
+
+    def _set_returncode(self, returncode):
+        # Called by executor's _reap(), with its condition held
+        with self.executor._condition:
+            if self.returncode is None:
+                self.returncode = returncode
+            self.executor._condition.notify_all()
+
+    def wait(self, timeout=None):
+        ex = self.executor
+        with ex._condition:
+            if self.returncode is not None:
+                return self.returncode
+            reaping = ex._running
+
+        if reaping:
+            # Executor's signal loop will reap, so just wait for it
+            with ex._condition:
+                done = ex._condition.wait_for(
+                    lambda: self.returncode is not None or not ex._running,
+                    timeout,
+                )
+            if not done:
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            if self.returncode is not None:
+                return self.returncode
+
+        if self._proc:
+            self._set_returncode(self._proc.wait(timeout))
+        else:
+            try:
+                _, sts = os.waitpid(self.pid, 0)
+            except ChildProcessError:
+                # Not our child (or reaped elsewhere)
+                self._set_returncode(255)
+            else:
+                self._set_returncode(compute_returncode(sts))
+        return self.returncode
+
+    def communicate(self, input=None, timeout=None):
+        # Returns (stdout, stderr) bytes; stderr empty with a tty
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        if self.stdin:
+            try:
+                if input:
+                    self.stdin.write(input)
+            except BrokenPipeError:
+                pass
+            if not self.use_tty:
+                self.stdin.close()
+                self.stdin = None
+
+        output = {}
+        readers = [self.stdout] if self.use_tty else [self.stdout, self.stderr]
+        readers = [r for r in readers if r]
+        for r in readers:
+            output[r] = bytearray()
+        while readers:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise subprocess.TimeoutExpired(self.args, timeout)
+            rlist, _, _ = select.select(readers, [], [], remaining)
+            for r in rlist:
+                try:
+                    data = os.read(r.fileno(), 65536)
+                except OSError:
+                    # Pty hangup once process exits
+                    data = b''
+                if data:
+                    output[r].extend(data)
+                else:
+                    readers.remove(r)
+
+        if deadline is not None:
+            self.wait(max(0, deadline - time.monotonic()))
+        self.close()
+        return (
+            bytes(output.get(self.stdout, b'')),
+            bytes(output.get(self.stderr, b'')) if not self.use_tty else b'',
+        )
+
+    def close(self):
+        if self._closing is not None:
+            return self.returncode
+        self._closing = True
+        try:
+            self.wait()
+        finally:
+            if self._stop_event:
+                self._stop_event.set()
+            while self._io_threads:
+                self._io_threads.popleft().join()
+            for fileobj in (self.stdin, self.stdout, self.stderr):
+                if fileobj:
+                    try:
+                        fileobj.close()
+                    except OSError:
+                        pass
+            while self._close_fds:
+                try:
+                    os.close(self._close_fds.popleft())
+                except OSError:
+                    pass
+            self.executor._forget_exec(self)
+        return self.returncode
+
+
 class RuncExecutor(object):
 
     # TODO: add (configurable) signal to force-kill containers
@@ -228,7 +462,8 @@ class RuncExecutor(object):
 
     def __init__(self, context_name='default', state_dir=None,
                  stdin=None, stdout=None, stderr=None, close_stdio=False,
-                 uid=None, gid=None, debug=False, log_file=sys.stderr):
+                 uid=None, gid=None, debug=False, log_file=sys.stderr,
+                 timer=None, warm_pools=True):
         # Stdio
         self.stdin = stdin
         self.stdout = stdout
@@ -238,6 +473,8 @@ class RuncExecutor(object):
         self.debug = bool(debug)
         self._log_file = log_file
         self._log_isatty = log_file and log_file.isatty()
+        # Phase timings (shared process-wide unless given)
+        self.timer = timer if timer is not None else get_timer()
         # Host process state
         self.uid = uid
         self.gid = gid
@@ -252,9 +489,24 @@ class RuncExecutor(object):
         # Container process state
         self._containers = {}
         self._other_pids = {}
+        self._execs = {}
+        self._exec_ids = itertools.count()
+        # Detached execs not yet registered, and exit statuses of
+        # unknown children reaped meanwhile (perhaps theirs)
+        self._detaching = 0
+        self._unclaimed = {}
+        # Warm pools feeding this executor (see pool.py), started per
+        # config as its context's pool table asks, if warm_pools
+        self.warm_pools = warm_pools
+        self._pools = []
+        # Bundle lockfile path -> [FileLock, containers using it]
+        self._bundle_locks = {}
         self._condition = threading.Condition()
         self._running = None
         self._closing = None
+        self._cpu_allocator = None
+        # Stop escalation timers, driven by signal loop
+        self._timers = TimerWheel()
         # Runc state dir
         if state_dir is None:
             self._state_dir = get_runtime_path(uid) / context_name / '.runc'
@@ -272,6 +524,45 @@ class RuncExecutor(object):
         if self.debug:
             self._write_log(message, flush=flush)
 
+    @property
+    def cpu_allocator(self):
+        if self._cpu_allocator is None:
+            # Shared with other executors in this context, so they
+            # don't all pick the same CPUs
+            self._cpu_allocator = CpuAllocator(
+                path=self._state_dir.parent / PLACEMENT_FILE
+            )
+        return self._cpu_allocator
+
+    @cpu_allocator.setter
+    def cpu_allocator(self, value):
+        self._cpu_allocator = value
+
+    def _place_container(self, container):
+        # Container config takes priority over context defaults
+        placement = container.config.data.get('placement')
+        if not placement and hasattr(container.context, 'data'):
+            placement = container.context.data.get('placement')
+        if not placement or placement.get('policy', 'none') == 'none':
+            return None
+
+        # Held for container's lifetime, even by a shim (see shim.py)
+        container.cpuset = place_container(
+            self.cpu_allocator, container.name, placement,
+            owner=container.rundir_lock_path,
+        )
+        if container.cpuset:
+            self._debug_log(
+                f'Placed container {container.name} on CPUs '
+                f'{container.cpuset[0]} (mems {container.cpuset[1]})'
+            )
+        return container.cpuset
+
+    def _unplace_container(self, container):
+        if container.cpuset and self._cpu_allocator:
+            self._cpu_allocator.release(container.name)
+        container.cpuset = None
+
     def _ensure_state_dir(self):
         return bool(ensure_dirs(
             [(self._state_dir, 0o770)],
@@ -323,7 +614,9 @@ class RuncExecutor(object):
                 closefd=(self.stderr != sys.stderr.fileno())
             )
 
-        # Check if we're in a tty
+        # Check if we're in a tty (unless still open from a last run)
+        if self.tty_fd is not None:
+            return
         for fd in [self.stdin, self.stdout, self.stderr]:
             if not fd:
                 continue
@@ -364,6 +657,14 @@ class RuncExecutor(object):
 
         return True
 
+    def _host_tty(self):
+        # Whether runs get a tty, as far as our stdio allows
+        self._setup_stdio()
+        return (
+            self.tty_fd is not None and
+            output_isatty(self.stdin, self.stdout)
+        )
+
     def _setup_tty(self, container):
         # Determine TTY
         # Only use tty mode if both host and container using ttys
@@ -454,6 +755,11 @@ class RuncExecutor(object):
                     # Set return code here; container's wait() won't see it
                     if container.returncode is None:
                         container.returncode = compute_returncode(sts)
+                    if container._stop_timer:
+                        self._timers.cancel(container._stop_timer)
+                        container._stop_timer = None
+                    # Wake anything waiting in stop_containers()
+                    self._condition.notify_all()
                 elif pid in self._other_pids:
                     other_proc = self._other_pids[pid]
                     returncode = compute_returncode(sts)
@@ -466,6 +772,10 @@ class RuncExecutor(object):
                                 other_proc.returncode = returncode
                     elif callable(other_proc):
                         other_proc(returncode)
+                elif self._detaching:
+                    # Orphans are reparented before their parent's exit
+                    # is seen, so may be a detached exec's process
+                    self._unclaimed[pid] = compute_returncode(sts)
                 else:
                     # TODO: log martians
                     pass
@@ -477,29 +787,52 @@ class RuncExecutor(object):
         # Get new terminal size
         columns, lines = os.get_terminal_size(self.tty_fd)
 
-        # Send resize to any containers with ttys
+        # Send resize to any containers (or execs) with ttys
         with self._condition:
             for pid, container in self._containers.items():
                 if container.returncode is None and container.tty is not None:
                     resize_tty(container.tty, columns, lines)
+            for pid, exec_proc in self._execs.items():
+                if exec_proc.returncode is None and exec_proc.tty is not None:
+                    resize_tty(exec_proc.tty, columns, lines)
+
+    def _wake(self):
+        # Wake signal loop (a zero byte is never a real signal)
+        if self._sig_wsock is not None:
+            try:
+                self._sig_wsock.send(b'\0')
+            except (BlockingIOError, OSError):
+                pass
 
     def _send_signal(self, sig=signal.SIGTERM):
-        # Send signal to all still-running containers
+        # Send signal to all still-running containers and execs
         with self._condition:
             for pid, container in self._containers.items():
-                if container.returncode is None:
+                # Not-yet-started (eg pooled) containers left alone
+                if (container.returncode is None and
+                        container.status != 'created'):
                     os.kill(pid, sig)
+            for pid, exec_proc in self._execs.items():
+                if exec_proc.returncode is None:
+                    try:
+                        os.kill(pid, sig)
+                    except ProcessLookupError:
+                        pass
 
-    def _process_signals(self):
+    def _process_signals(self, done=None):
+        # Runs until done() is true, or by default all containers exit
         try:
             with self._condition:
                 self._running = True
             while True:
-                # Read from signal fd
+                # Read from signal fd, or time out for next stop timer
+                self._sig_rsock.settimeout(self._timers.next_timeout())
                 try:
                     data = self._sig_rsock.recv(4096)
                 except InterruptedError:
                     continue
+                except socket.timeout:
+                    data = b''
                 # Handle signals
                 for sig in data:
                     if sig == signal.SIGCHLD:
@@ -510,6 +843,9 @@ class RuncExecutor(object):
                     elif sig == signal.SIGWINCH:
                         # Resize container tty
                         self._resize_tty()
+                    elif sig == signal.SIGTERM:
+                        # Graceful stop, escalating to SIGKILL
+                        self.stop_containers(wait=False)
                     elif sig in self.FORWARD_SIGNALS:
                         # Forward to container(s)
                         self._send_signal(sig)
@@ -518,11 +854,19 @@ class RuncExecutor(object):
                         # all still-running (possibly hung) containers?
                         # Otherwise ignore
                         continue
+                # Escalate any stops past their grace period
+                self._timers.advance()
                 # End once all containers exited
                 with self._condition:
+                    if done is not None:
+                        if done():
+                            break
+                        continue
+                    # Only started containers; pooled ones wait indefinitely
                     alive = [
                         pid for pid, con in self._containers.items()
-                        if con.returncode is None
+                        if con.returncode is None and
+                        con.status != 'created'
                     ]
                     # TODO: anything to do with still-running containers?
                     if not alive:
@@ -544,39 +888,158 @@ class RuncExecutor(object):
         return None
 
     def _close(self):
+        # Closes and forgets containers, though not those still waiting
+        # in pools (which live until taken, or until close())
         with self._condition:
-            self._closing = True
-        # Close all containers
-        for pid, con in self._containers.items():
+            containers = [
+                (pid, con) for pid, con in self._containers.items()
+                if con.pool is None
+            ]
+        for pid, con in containers:
             # TODO: send sigkill if still running?
             con.close()
+            # Exited containers have no further use for their secrets
+            if con.rundir and con.returncode is not None:
+                secrets.wipe_secrets(con.rundir_path)
+            self._report_io_stats(con)
+            self._unplace_container(con)
+            self._unlock_container(con)
+            with self._condition:
+                if self._containers.get(pid) is con:
+                    del self._containers[pid]
         # TODO: terminate & wait for other processes
         # Notify waiters
         with self._condition:
             self._condition.notify_all()
 
+    def _release_host(self):
+        # Undoes run setup, though while there are pools we stay
+        # subreaper (for members' init processes), and keep stdio for
+        # the next run, until close()
+        keep = bool(self._pools)
+        self._set_subreaper(keep)
+        self._restore_signals()
+        self._reset_tty()
+        if not keep:
+            self._close_stdio()
+
+    def close(self):
+        # Only needed with pools, as runs otherwise clean up after
+        # themselves; pools first, so their spare containers are
+        # removed, not awaited
+        for pool in list(self._pools):
+            pool.close()
+        with self._condition:
+            if self._closing:
+                return
+            self._closing = True
+        self._close()
+        self._set_subreaper(False)
+        self._close_stdio()
+
     # Main loop
 
     def run_until_complete(self, container, remove=True):
+        # Runs a ready pool member in its place if there is one
+        with self._condition:
+            if self._closing:
+                raise RuntimeError('Cannot run when closing')
+
+        phase = partial(self.timer.phase, container=container.name)
+        profiler = get_profiler()
+
+        try:
+            with phase('run'), profiler.phase('run'):
+                return self._run_until_complete(container, remove, phase)
+        finally:
+            if profiler.enabled and container.rundir_path:
+                for path in profiler.dump(container.rundir_path):
+                    self._debug_log(f'Wrote profile {path}')
+
+    def run_detached(self, container, remove=True):
+        # Returns once started under its shim; shim module builds on
+        # this one
+        from .shim import run_detached
+
         with self._condition:
             if self._closing:
                 raise RuntimeError('Cannot run when closing')
 
+        with self.timer.phase('detach', container=container.name):
+            return run_detached(self, container, remove=remove)
+
+    def get_pool(self, config):
+        # This executor's WarmPool for config, if it has one
+        with self._condition:
+            for pool in self._pools:
+                if (pool.config.name == config.name and
+                        pool.config.path == config.path):
+                    return pool
+        return None
+
+    def _ensure_pool(self, container):
+        # Starts a pool for container's config, if its context wants
+        # one; kept for later runs until close()
+        if not self.warm_pools or self.get_pool(container.config):
+            return None
+        if not hasattr(container.context, 'data'):
+            return None
+        pool_config = container.context.data.get('pool', {})
+        if int(pool_config.get('size', 0)) <= 0:
+            return None
+        # Pool module builds on this one
+        from .pool import WarmPool
+        pool = WarmPool(
+            self, container.config, container.context,
+            tty=container.use_tty,
+        )
+        self._debug_log(f'Started pool for {container.config.name}')
+        return pool.start()
+
+    def _acquire_warm(self, container):
+        # Member of the pool for container's config, if one's ready
+        # with the same tty choice
+        pool = self.get_pool(container.config)
+        if pool is None:
+            return None
+        return pool.acquire(tty=container.use_tty)
+
+    def _run_until_complete(self, container, remove, phase):
+        # Container actually run, perhaps a warm one in its place
+        target = container
+
         # Runc setup
         self._ensure_state_dir()
 
         try:
             # Internal setup
-            self._setup_stdio()
-            self._setup_tty(container)
-            self._setup_signals()
-            self._set_subreaper(True)
+            with phase('run.setup'):
+                self._setup_stdio()
+                self._setup_tty(container)
+                self._setup_signals()
+                self._set_subreaper(True)
             self._debug_log('Internal setup complete')
 
             # Assuming container unpacked and ready
             # TODO: allow running multiple containers
-            self.create_container(container)
-            self._debug_log(f'Container created (tty: {container.use_tty})')
+            if container.status == 'new':
+                # Run a warm pool member in its place, if there's one
+                # (the first run of a config just starts its pool)
+                self._ensure_pool(container)
+                warm = self._acquire_warm(container)
+                if warm is not None:
+                    self._debug_log(f'Using warm container {warm.name}')
+                    target = warm
+            if (target.status == 'created' and
+                    target.pid in self._containers):
+                # Already created (eg taken from a WarmPool), so only
+                # needs its stdio attaching
+                with phase('create.stdio'):
+                    self._setup_container_stdio(target)
+                self._debug_log('Using pre-created container')
+            else:
+                self.create_container(target)
+            self._debug_log(f'Container created (tty: {target.use_tty})')
 
             # TODO: setup container networking
             
@@ -586,12 +1049,13 @@ class RuncExecutor(object):
 
             # Anything else in particular before we start?
             # TODO: multiple
-            self.start_container(container)
+            self.start_container(target)
             self._debug_log('Container started')
 
             # Loop reading from signal fd, forwarding signals
             # and waitpid()'ing on SIGCHLD
-            self._process_signals()
+            with phase('run.wait'):
+                self._process_signals()
             self._debug_log('Container finished')
 
             # TODO: teardown container networking
@@ -602,7 +1066,7 @@ class RuncExecutor(object):
             # Cleanup container remnants
             # TODO: multiple
             if remove:
-                self.remove_container(container)
+                self.remove_container(target)
                 self._debug_log('Container removed')
 
         except Exception as e:
@@ -614,11 +1078,18 @@ class RuncExecutor(object):
 
         finally:
             # Internal teardown
-            self._close()
-            self._set_subreaper(False)
-            self._restore_signals()
-            self._reset_tty()
-            self._close_stdio()
+            with phase('run.teardown'):
+                self._close()
+                self._release_host()
+                if target is not container:
+                    container.returncode = target.returncode
+                    container.status = target.status
+                    # Named for the pool, so nothing would reuse it
+                    if target.status == 'removed':
+                        target.rundir.remove()
+                # Only now, so as not to slow this run
+                for pool in list(self._pools):
+                    pool.refill()
             self._debug_log('Internal teardown complete')
 
         return self.returncode
@@ -628,6 +1099,63 @@ class RuncExecutor(object):
     def _base_runc_cmd(self, command):
         return ['runc', '--root', str(self._state_dir), command]
 
+    @contextmanager
+    def _open_console_socket(self, path):
+        # Listening socket for runc to send a pty master through
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        tty_socket = socket.socket(socket.AF_UNIX)
+        try:
+            tty_socket.settimeout(0.2)
+            tty_socket.bind(str(path))
+            tty_socket.listen()
+            yield tty_socket
+        finally:
+            tty_socket.close()
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _recv_console_fd(self, tty_socket):
+        # Returns (fd, msg) received through console socket
+        sock = None
+        try:
+            sock, _ = tty_socket.accept()
+            sock.settimeout(0.2)
+            fds = array.array('i')
+            msg, ancdata, flags, _ = sock.recvmsg(
+                4096, socket.CMSG_LEN(fds.itemsize)
+            )
+            for cmsg_level, cmsg_type, cmsg_data in ancdata:
+                if (cmsg_level == socket.SOL_SOCKET and
+                        cmsg_type == socket.SCM_RIGHTS):
+                    # Only expecting a single fd
+                    fd_len = len(cmsg_data) - (len(cmsg_data) % fds.itemsize)
+                    fds.frombytes(cmsg_data[:fd_len])
+        finally:
+            if sock:
+                sock.close()
+
+        return (fds[0] if len(fds) else None), msg
+
+    def _use_console_fd(self, target, name, fd, msg):
+        # Set up target's (container or exec) stdio on received pty
+        if fd is None:
+            if msg:
+                errmsg = msg.decode(errors='surrogateescape')
+            else:
+                errmsg = "Couldn't get tty"
+            raise RuncError(name, errmsg)
+
+        target.tty = fd
+        target._close_fds.append(fd)
+        target.stdin = open(fd, 'wb', buffering=0, closefd=False)
+        target.stdout = open(fd, 'rb', buffering=0, closefd=False)
+        target.stderr = open(fd, 'rb', buffering=0, closefd=False)
+
     def _create_container_tty(self, container, runc_cmd):
         tty_socket_path = container.rundir_path / 'tty.sock'
         runc_cmd += [
@@ -636,80 +1164,61 @@ class RuncExecutor(object):
             container.name,
         ]
 
-        # Init socket
-        try:
-            tty_socket_path.unlink()
-        except FileNotFoundError:
-            pass
-        tty_socket = socket.socket(socket.AF_UNIX)
-        tty_socket.settimeout(0.2)
-        tty_socket.bind(str(tty_socket_path))
-        tty_socket.listen()
-
         # Run create command
-        try:
-            sock = None
-            proc = subprocess.Popen(
-                runc_cmd, cwd=container.path, stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            )
+        with self._open_console_socket(tty_socket_path) as tty_socket:
+            with self._condition:
+                proc = subprocess.Popen(
+                    runc_cmd, cwd=container.bundle_path,
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                )
+                self._track_other(proc)
 
             try:
                 # Get new tty through socket
-                sock, _ = tty_socket.accept()
-                sock.settimeout(0.2)
-                fds = array.array('i')
-                msg, ancdata, flags, _ = sock.recvmsg(
-                    4096, socket.CMSG_LEN(fds.itemsize)
-                )
-                for cmsg_level, cmsg_type, cmsg_data in ancdata:
-                    if (cmsg_level == socket.SOL_SOCKET and
-                            cmsg_type == socket.SCM_RIGHTS):
-                        # Only expecting a single fd
-                        fd_len = len(cmsg_data) - (len(cmsg_data) % fds.itemsize)
-                        fds.fromstring(cmsg_data[:fd_len])
+                with self.timer.phase(
+                    'create.tty_handoff', container=container.name
+                ):
+                    fd, msg = self._recv_console_fd(tty_socket)
             finally:
-                if sock:
-                    sock.close()
                 # Now handle start process
-                returncode = proc.wait()
+                returncode = self._wait_other(proc)
                 if returncode:
                     errmsg = proc.stderr.read().decode(errors='surrogateescape')
                     raise RuncError(container.name, errmsg, code=returncode)
-        finally:
-            tty_socket.close()
-            tty_socket_path.unlink()
-
-        if len(fds) == 0:
-            if msg:
-                errmsg = msg.decode(errors='surrogateescape')
-            else:
-                errmsg = "Couldn't get tty"
-            raise RuncError(container.name, errmsg)
 
         # Set up container stdio with new socket
-        tty = fds[0]
-        container.tty = tty
-        container._close_fds.append(tty)
-        container.stdin = open(tty, 'wb', buffering=0, closefd=False)
-        container.stdout = open(tty, 'rb', buffering=0, closefd=False)
-        container.stderr = open(tty, 'rb', buffering=0, closefd=False)
+        self._use_console_fd(container, container.name, fd, msg)
 
         return container
 
+    def _make_stdio_pairs(self):
+        # Our ends and child's ends of stdin, stdout, stderr
+        pairs = [ socket.socketpair() for _ in range(3) ]
+        return [ p for p, c in pairs ], [ c for p, c in pairs ]
+
+    def _use_stdio_pairs(self, target, parents):
+        stdin_p, stdout_p, stderr_p = parents
+        target.stdin = open(stdin_p.detach(), 'wb', buffering=0)
+        target.stdout = open(stdout_p.detach(), 'rb', buffering=0)
+        target.stderr = open(stderr_p.detach(), 'rb', buffering=0)
+
     def _create_container_notty(self, container, runc_cmd):
         runc_cmd += [container.name]
 
         # Create pipes
-        stdin_p, stdin_c = socket.socketpair()
-        stdout_p, stdout_c = socket.socketpair()
-        stderr_p, stderr_c = socket.socketpair()
+        parents, children = self._make_stdio_pairs()
+        stdin_p, stdout_p, stderr_p = parents
+        stdin_c, stdout_c, stderr_c = children
 
         try:
-            proc = subprocess.Popen(
-                runc_cmd, stdin=stdin_c, stdout=stdout_c, stderr=stderr_c,
-            )
-            proc.wait()
+            with self._condition:
+                proc = subprocess.Popen(
+                    runc_cmd, stdin=stdin_c, stdout=stdout_c,
+                    stderr=stderr_c,
+                )
+                self._track_other(proc)
+            self._wait_other(proc)
             if proc.returncode:
                 try:
                     # Get error message
@@ -745,9 +1254,7 @@ class RuncExecutor(object):
             for fileobj in [stdin_c, stdout_c, stderr_c]:
                 fileobj.close()
 
-        container.stdin = open(stdin_p.detach(), 'wb', buffering=0)
-        container.stdout = open(stdout_p.detach(), 'rb', buffering=0)
-        container.stderr = open(stderr_p.detach(), 'rb', buffering=0)
+        self._use_stdio_pairs(container, parents)
 
         return container
 
@@ -758,83 +1265,142 @@ class RuncExecutor(object):
         # Shorter select timeout if a tty
         select_time = 0.1 if container.use_tty else 0.2
         # Setup each i/o thread
-        if container.stdin:
-            container._io_threads.append(threading.Thread(
-                name=f"{container.name}-stdin", daemon=False,
-                target=iopump, args=(self.stdin, container.stdin),
-                kwargs={'stop_event': stop_ev, 'select_timeout': select_time},
-            ))
-        if container.stdout:
-            container._io_threads.append(threading.Thread(
-                name=f"{container.name}-stdout", daemon=False,
-                target=iopump, args=(container.stdout, self.stdout),
-                kwargs={'stop_event': stop_ev, 'select_timeout': select_time},
-            ))
-        if container.stderr:
-            container._io_threads.append(threading.Thread(
-                name=f"{container.name}-stderr", daemon=False,
-                target=iopump, args=(container.stderr, self.stderr),
-                kwargs={'stop_event': stop_ev, 'select_timeout': select_time},
-            ))
-        for t in container._io_threads:
-            t.start()
+        if container.log_mode == 'file':
+            # Output captured to log files, container gets no input
+            container.log_writers = make_log_writers(
+                container.config, container.rundir
+            )
+            if container.stdin:
+                container.stdin.close()
+                container.stdin = None
+            streams = [
+                ('stdout', container.stdout, container.log_writers['stdout']),
+                ('stderr', container.stderr, container.log_writers['stderr']),
+            ]
+        else:
+            streams = [
+                ('stdin', self._borrow(self.stdin, 'rb'), container.stdin),
+                ('stdout', container.stdout, self._borrow(self.stdout, 'wb')),
+                ('stderr', container.stderr, self._borrow(self.stderr, 'wb')),
+            ]
+        self._start_iopumps(container, container.name, streams, select_time)
 
         return container
 
-    def _check_container_pidfile(self, container):
-        # Check if container pidfile exists, remove if stopped
-        try:
-            pid = container.pidfile_path.read_text()
-            if pid:
-                pid = int(pid)
-            # Check if container process running
-            if pid and pid != container.pid:
-                try:
-                    os.kill(pid, 0)
-                except ProcessLookupError:
-                    # PID not running, carry on
-                    container.pidfile_path.unlink()
-                else:
-                    # Technically this doesn't guarantee the pid
-                    # in question is this container, but /shrug
-                    # TODO: check state
-                    errmsg = f"Container already exists"
-                    raise RuncError(container.name, errmsg)
-        except FileNotFoundError:
-            # Good to go
-            pass
+    def _borrow(self, fileobj, mode):
+        # Iopumps close both ends once done, so they get our stdio
+        # through wrappers that leave it open for later runs
+        return open(fileobj.fileno(), mode, buffering=0, closefd=False)
 
-    def _check_container_lockfile(self, container):
-        # Check if container lockfile exists, remove if stopped
-        try:
-            pid = container.lockfile_path.read_text()
-            if pid:
-                pid = int(pid)
-            # Check if darkwing process running
-            if pid and pid != self.pid:
-                try:
-                    os.kill(pid, 0)
-                except ProcessLookupError:
-                    # PID not running, carry on
-                    container.lockfile_path.unlink()
-                else:
-                    # Technically this doesn't guarantee the pid
-                    # in question is this container, but /shrug
-                    # TODO: check state
-                    errmsg = f"Container already in use"
-                    raise RuncError(container.name, errmsg)
-        except FileNotFoundError:
-            # Good to go
-            pass
+    def _start_iopumps(self, target, name, streams, select_time):
+        # One iopump thread per (stream, read_from, write_to) on target
+        stop_ev = target._stop_event
+        for stream, read_from, write_to in streams:
+            if not getattr(target, stream):
+                continue
+            stats = target.io_stats[stream] = IOStats()
+            target._io_threads.append(threading.Thread(
+                name=f"{name}-{stream}", daemon=False,
+                target=iopump, args=(read_from, write_to),
+                kwargs={
+                    'stop_event': stop_ev, 'select_timeout': select_time,
+                    'stats': stats,
+                },
+            ))
+        for t in target._io_threads:
+            t.start()
 
-    def _write_container_lockfile(self, container):
-        # TODO: use open() with an opener to set mode
-        container.lockfile_path.write_text(str(self.pid))
+    def _report_io_stats(self, container):
+        for stream, stats in container.io_stats.items():
+            record = {
+                'event': 'io',
+                'container': container.name,
+                'stream': stream,
+                **stats.as_dict(),
+            }
+            self.timer.emit(record)
+            self._debug_log(
+                f'I/O {container.name}-{stream}: '
+                f'{stats.bytes_in} in, {stats.bytes_out} out, '
+                f'{stats.reads} reads, {stats.writes} writes, '
+                f'{stats.stalls} stalls ({stats.stall_ns // 1000}us), '
+                f'max buffered {stats.max_buffered}'
+            )
+
+    def _lock_container(self, container):
+        # Rundir lock is per container, held until removed; bundle lock
+        # is shared by all our containers using it (eg. pool members)
+        lock = FileLock(container.rundir_lock_path)
+        if not lock.acquire(blocking=False):
+            raise RuncError(
+                container.name, _lock_errmsg('Container already exists', lock)
+            )
+        with self._condition:
+            path = container.lockfile_path
+            held = self._bundle_locks.get(path)
+            if held is None:
+                bundle_lock = FileLock(path, mode=0o660)
+                if not bundle_lock.acquire(blocking=False):
+                    lock.release()
+                    raise RuncError(container.name, _lock_errmsg(
+                        'Container already in use', bundle_lock
+                    ))
+                held = self._bundle_locks[path] = [bundle_lock, 0]
+            held[1] += 1
+        container.lock = lock
+
+    def _unlock_container(self, container, unlink=False):
+        lock, container.lock = container.lock, None
+        if lock is None:
+            return
+        with self._condition:
+            path = container.lockfile_path
+            held = self._bundle_locks.get(path)
+            if held:
+                held[1] -= 1
+                if held[1] <= 0:
+                    del self._bundle_locks[path]
+                    held[0].release(unlink=unlink)
+        lock.release(unlink=unlink)
+
+    def _abort_create(self, container, created=False):
+        if created:
+            # Whatever runc got as far as making goes too
+            runc_cmd = self._base_runc_cmd('delete')
+            runc_cmd.extend(['--force', container.name])
+            self._runc_command(runc_cmd)
+            try:
+                container.pidfile_path.unlink()
+            except FileNotFoundError:
+                pass
+            container.pid = None
+            container.status = 'new'
+        self._unplace_container(container)
+        if container.rundir:
+            idmap.release_rootfs(container.rundir_path)
+            secrets.wipe_secrets(container.rundir_path)
+        self._remove_bundle(container)
+        self._unlock_container(container)
+
+    def _make_bundle(self, container, oci_spec):
+        # Own bundle (eg. for pool members) for its own spec only; the
+        # rootfs is shared with the config's other runs, as it'd be if
+        # run from the storage dir itself
+        bundle = container.bundle_path
+        bundle.mkdir(mode=0o700, parents=True, exist_ok=True)
+        rootfs = container.path / oci_spec['root']['path']
+        oci_spec['root']['path'] = str(rootfs)
+
+    def _remove_bundle(self, container):
+        if container.bundle_path != container.path:
+            trash.move_to_trash(
+                container.bundle_path, trash.trash_dir(container.config)
+            )
 
     def _get_container_state(self, container, update=False,
                              raise_on_failure=True):
         runc_cmd = self._base_runc_cmd('state') + [container.name]
-        proc = simple_command(runc_cmd, write_output=False)
+        proc = self._runc_command(runc_cmd)
         proc_out = proc.stdout.encode(errors='surrogateescape')
         if proc.returncode:
             if raise_on_failure:
@@ -853,7 +1419,7 @@ class RuncExecutor(object):
 
         return state
 
-    def create_container(self, container):
+    def create_container(self, container, attach_stdio=True):
         with self._condition:
             if self._closing:
                 raise RuntimeError('Cannot create container when closing')
@@ -863,52 +1429,89 @@ class RuncExecutor(object):
                     f'created (pid {container.pid})'
                 )
             # TODO: internally lock container
+        if not get_host_info().has_tool('runc'):
+            raise RuncError(container.name, 'runc not found in PATH')
+
+        phase = partial(self.timer.phase, container=container.name)
 
         if not container.rundir:
-            container.make_rundir()
+            with phase('create.rundir'):
+                container.make_rundir()
 
         # Ensure not clobbering another process
-        self._check_container_pidfile(container)
-        self._check_container_lockfile(container)
-        # Lock unpacked container now
-        self._write_container_lockfile(container)
+        with phase('create.lock'):
+            self._lock_container(container)
+
+        # Pin to CPUs/NUMA nodes if configured
+        self._place_container(container)
 
         # Update OCI spec file
-        spec.update_spec_file(
-            container.config, container.rundir,
-            allow_tty=container.use_tty,
-            # TODO: force_tty?
-        )
+        try:
+            # Before runc binds the secrets dir, so it's the tmpfs bound
+            with phase('create.secrets'):
+                secrets.mount_secrets(container.config, container.rundir_path)
+            with phase('create.spec'):
+                oci_spec = spec.build_spec(
+                    container.config, container.rundir,
+                    allow_tty=container.use_tty,
+                    # TODO: force_tty?
+                    cpuset=container.cpuset, context=container.context,
+                )
+            with phase('create.rootfs'):
+                # Rootfs ownership to match any subordinate ID mappings
+                idmap.prepare_rootfs(
+                    container.config, oci_spec, container.rundir
+                )
+                if container.bundle_path != container.path:
+                    self._make_bundle(container, oci_spec)
+            with phase('create.spec'):
+                spec.write_spec(
+                    oci_spec, container.bundle_path / 'config.json',
+                    pretty=self.debug,
+                )
+                # Kept for exec_in_container(), saves re-reading spec
+                container.process_template = spec.process_template(oci_spec)
+        except Exception:
+            self._abort_create(container)
+            raise
 
         # Create container runc-side
         runc_cmd = self._base_runc_cmd('create')
         # TODO: other options? Specify '--rootless'?
         runc_cmd.extend([
-            '--bundle', str(container.path),
+            '--bundle', str(container.bundle_path),
             '--pid-file', str(container.pidfile_path),
         ])
 
         # TODO: only setup tty if stdin and stdout are (the same?) tty
-        if container.use_tty:
-            self._create_container_tty(container, runc_cmd)
-        else:
-            self._create_container_notty(container, runc_cmd)
-
-        # Now get state
-        state = self._get_container_state(container, update=True)
-        # TODO: check pid too?
-        if state['status'] != 'created':
-            raise RuncError(
-                container.name, f"Unexpected status {state['status']}"
-            )
+        try:
+            with phase('create.runc'):
+                if container.use_tty:
+                    self._create_container_tty(container, runc_cmd)
+                else:
+                    self._create_container_notty(container, runc_cmd)
+
+            # Now get state
+            with phase('create.state'):
+                state = self._get_container_state(container, update=True)
+            # TODO: check pid too?
+            if state['status'] != 'created':
+                raise RuncError(
+                    container.name, f"Unexpected status {state['status']}"
+                )
+        except Exception:
+            self._abort_create(container, created=True)
+            raise
 
         with self._condition:
             # TODO: ensure exclusive
             # TODO: by name as well?
             self._containers[container.pid] = container
 
-        # Start up i/o thread(s)
-        self._setup_container_stdio(container)
+        # Start up i/o thread(s), unless caller handles stdio itself
+        if attach_stdio:
+            with phase('create.stdio'):
+                self._setup_container_stdio(container)
 
         return container
 
@@ -918,9 +1521,18 @@ class RuncExecutor(object):
                 f'Cannot start {container.status} '
                 f'container "{container.name}"'
             )
-        
+
+        phase = partial(self.timer.phase, container=container.name)
+
+        # Only now, so secrets are exposed no longer than needed (into
+        # the tmpfs mounted before create)
+        if container.rundir:
+            with phase('start.secrets'):
+                secrets.stage_secrets(container.config, container.rundir_path)
+
         runc_cmd = self._base_runc_cmd('start') + [container.name]
-        proc = simple_command(runc_cmd, write_output=False)
+        with phase('start.runc'):
+            proc = self._runc_command(runc_cmd)
         proc_out = proc.stdout.encode(errors='surrogateescape')
         if proc.returncode:
             # TODO: Kill container?
@@ -928,45 +1540,169 @@ class RuncExecutor(object):
             raise RuncError(container.name, errmsg, code=proc.returncode)
 
         # Now get state
-        state = self._get_container_state(container, update=True)
-        if state['status'] != 'running':
+        with phase('start.state'):
+            state = self._get_container_state(container, update=True)
+        # Processes which exit straight away (eg. 'true') may already
+        # be stopped; their exit is still reaped and reported as usual
+        if state['status'] not in ('running', 'stopped'):
             raise RuncError(
                 container.name, f"Unexpected status {state['status']}"
             )
 
         return container
 
-    def stop_container(self, container):
-        raise NotImplementedError
+    def _stop_one(self, container, timeout=None, sig=None):
+        # With condition held
+        if not container.pid or container.returncode is not None:
+            return False
+        if container._stop_timer is not None:
+            # Already stopping
+            return False
 
-    def remove_container(self, container):
-        state = self._get_container_state(container, raise_on_failure=False)
-        if not state:
+        sig = container.stop_signal if sig is None else parse_signal(sig)
+        if timeout is None:
+            timeout = container.stop_timeout
+        try:
+            os.kill(container.pid, sig)
+        except ProcessLookupError:
             return False
-        if state['status'] != 'stopped':
-            raise RuncError(
-                container.name, 'Cannot remove container unless stopped'
+        container._stop_timer = self._timers.schedule(
+            timeout, self._kill_container, container
+        )
+        return True
+
+    def _kill_container(self, container):
+        # Grace period expired
+        with self._condition:
+            container._stop_timer = None
+            if container.returncode is not None:
+                return
+            container._kill_sent = True
+            try:
+                os.kill(container.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                return
+        self._debug_log(f'Container {container.name} killed after timeout')
+
+    def _wait_stopped(self, containers, timeout=None):
+        def stopped():
+            return all(c.returncode is not None for c in containers)
+
+        with self._condition:
+            running = self._running
+            if running:
+                # Signal loop reaps and escalates, so just wait
+                return self._condition.wait_for(stopped, timeout)
+
+        # Otherwise poll here, reaping and escalating ourselves
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not stopped():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            self._reap()
+            with self._condition:
+                for con in containers:
+                    if con.returncode is not None:
+                        continue
+                    try:
+                        os.kill(con.pid, 0)
+                    except ProcessLookupError:
+                        # Not our child, so exit status unknown
+                        con.returncode = 255
+            self._timers.advance()
+            delay = self._timers.next_timeout()
+            self._sleep_until_exit(
+                containers, 0.05 if delay is None else min(delay, 0.05)
             )
+        return True
+
+    def _sleep_until_exit(self, containers, delay):
+        # Waits on pidfds where available, so an exit wakes us at once
+        if not get_host_info().pidfd:
+            time.sleep(delay)
+            return
+        pidfds = []
+        try:
+            for con in containers:
+                if con.returncode is not None:
+                    continue
+                try:
+                    pidfds.append(os.pidfd_open(con.pid))
+                except ProcessLookupError:
+                    # Already gone, no need to wait
+                    return
+            if pidfds:
+                select.select(pidfds, [], [], delay)
+        finally:
+            for fd in pidfds:
+                os.close(fd)
+
+    def stop_containers(self, containers=None, timeout=None, sig=None,
+                        wait=True):
+        # Stop signals all at once, then SIGKILL after grace periods, so a
+        # group takes about one grace period
+        with self._condition:
+            if containers is None:
+                containers = [
+                    con for con in self._containers.values()
+                    if con.returncode is None and con.status != 'created'
+                ]
+            for con in containers:
+                self._stop_one(con, timeout=timeout, sig=sig)
+        # Signal loop may need a shorter timeout for new timers
+        self._wake()
+        self._debug_log(f'Stopping {len(containers)} container(s)')
+
+        if wait:
+            self._wait_stopped(containers)
+        return containers
+
+    def stop_container(self, container, timeout=None, sig=None, wait=True):
+        self.stop_containers([container], timeout=timeout, sig=sig, wait=wait)
+        return container
+
+    def remove_container(self, container, force=False):
+        phase = partial(self.timer.phase, container=container.name)
 
-        runc_cmd = self._base_runc_cmd('delete') + [container.name]
-        proc = simple_command(runc_cmd, write_output=False)
+        if not force:
+            with phase('remove.state'):
+                state = self._get_container_state(
+                    container, raise_on_failure=False
+                )
+            if not state:
+                return False
+            if state['status'] != 'stopped':
+                raise RuncError(
+                    container.name, 'Cannot remove container unless stopped'
+                )
+
+        # Forced delete also kills container if still running
+        runc_cmd = self._base_runc_cmd('delete')
+        if force:
+            runc_cmd.append('--force')
+        runc_cmd.append(container.name)
+        with phase('remove.runc'):
+            proc = self._runc_command(runc_cmd)
         proc_out = proc.stdout.encode(errors='surrogateescape')
         if proc.returncode:
             errmsg = proc_out or f'Error removing container'
             raise RuncError(container.name, errmsg, code=proc.returncode)
 
-        # Remove pidfile, lockfile
+        if container.rundir:
+            idmap.release_rootfs(container.rundir_path)
+            secrets.wipe_secrets(container.rundir_path)
+        self._remove_bundle(container)
+
+        # Remove pidfile, lockfiles (unlinked while still held)
         with self._condition:
             try:
                 container.pidfile_path.unlink()
             except FileNotFoundError:
                 pass
-            try:
-                container.lockfile_path.unlink()
-            except FileNotFoundError:
-                pass
+            self._unlock_container(container, unlink=True)
             if container.pid in self._containers:
                 del self._containers[container.pid]
+            self._unplace_container(container)
 
         container.status = 'removed'
         return container
@@ -976,5 +1712,262 @@ class RuncExecutor(object):
     def run_container(self, container):
         raise NotImplementedError
 
-    def exec_in_container(self, container):
-        raise NotImplementedError
+    def exec_in_container(self, container, args, env=None, cwd=None,
+                          tty=False, user=None):
+        # Safe to call concurrently from several threads
+        with self._condition:
+            if self._closing:
+                raise RuntimeError('Cannot exec when closing')
+
+        if container.process_template is None:
+            # Not created by us, so take template from bundle's spec
+            spec_path = spec.spec_file_path(container.config)
+            container.process_template = spec.process_template(
+                json.loads(spec_path.read_text())
+            )
+        process = spec.exec_process(
+            container.process_template, args, env=env, cwd=cwd,
+            terminal=tty, user=user,
+        )
+        exec_proc = ExecProcess(self, container, process['args'], tty=tty)
+
+        # Process spec passed through an in-memory file, not the bundle
+        spec_fd = os.memfd_create(f'{container.name}-exec', os.MFD_CLOEXEC)
+        try:
+            view = memoryview(spec.dump_spec(process).encode())
+            while view:
+                view = view[os.write(spec_fd, view):]
+            runc_cmd = self._base_runc_cmd('exec') + [
+                '--process', f'/proc/self/fd/{spec_fd}',
+            ]
+            with self.timer.phase('exec.runc', container=container.name):
+                if tty:
+                    self._exec_tty(container, exec_proc, runc_cmd, spec_fd)
+                else:
+                    self._exec_notty(container, exec_proc, runc_cmd, spec_fd)
+        finally:
+            os.close(spec_fd)
+
+        return exec_proc
+
+    def _exec_tty(self, container, exec_proc, runc_cmd, spec_fd):
+        # Runc only hands over the pty when detached, so track exec'd
+        # process by pidfile (reparented to us as subreaper)
+        exec_id = f'exec-{os.getpid()}-{next(self._exec_ids)}'
+        tty_socket_path = container.rundir_path / f'{exec_id}.sock'
+        pid_path = container.rundir_path / f'{exec_id}.pid'
+        runc_cmd += [
+            '--detach',
+            '--console-socket', str(tty_socket_path),
+            '--pid-file', str(pid_path),
+            container.name,
+        ]
+
+        def runc_exited(returncode):
+            # Called with lock held as runc is reaped (here or by
+            # _reap()); the exec'd process is reparented to us just
+            # before, so may have been reaped already, as unclaimed
+            proc.returncode = returncode
+            if returncode:
+                return
+            try:
+                exec_proc.pid = int(pid_path.read_text())
+            except (OSError, ValueError):
+                return
+            self._other_pids[exec_proc.pid] = exec_proc._set_returncode
+            self._execs[exec_proc.pid] = exec_proc
+            if exec_proc.pid in self._unclaimed:
+                exec_proc._set_returncode(self._unclaimed.pop(exec_proc.pid))
+
+        with self._open_console_socket(tty_socket_path) as tty_socket:
+            # Registered before _reap() can see it exit
+            with self._condition:
+                self._detaching += 1
+                proc = subprocess.Popen(
+                    runc_cmd, stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                    pass_fds=(spec_fd,),
+                )
+                self._other_pids[proc.pid] = runc_exited
+            try:
+                with self.timer.phase(
+                    'exec.tty_handoff', container=container.name
+                ):
+                    running = True
+                    while True:
+                        try:
+                            fd, msg = self._recv_console_fd(tty_socket)
+                            break
+                        except TimeoutError:
+                            # Execs run side by side, so may be slow to
+                            # start; only give up once runc has exited
+                            # (after one more try, for a last handoff)
+                            if not running:
+                                raise
+                            running = self._wait_other(proc, 0) is None
+            finally:
+                self._wait_other(proc)
+                with self._condition:
+                    self._detaching -= 1
+                    if not self._detaching:
+                        self._unclaimed.clear()
+                errmsg = proc.stderr.read().decode(errors='surrogateescape')
+                proc.stdout.close()
+                proc.stderr.close()
+                try:
+                    pid_path.unlink()
+                except FileNotFoundError:
+                    pass
+                if proc.returncode:
+                    raise RuncError(
+                        container.name, errmsg, code=proc.returncode
+                    )
+
+        if exec_proc.pid is None:
+            raise RuncError(container.name, "Couldn't get exec pid")
+        self._use_console_fd(exec_proc, container.name, fd, msg)
+
+        return exec_proc
+
+    def _track_other(self, proc):
+        # With condition held, so before _reap() can see proc exit
+        def exited(returncode):
+            proc.returncode = returncode
+        self._other_pids[proc.pid] = exited
+
+    def _runc_command(self, runc_cmd):
+        # As simple_command(), but waited on through _other_pids, since
+        # _reap() may take any child's exit status (eg. while a pool
+        # refills from another thread)
+        with self._condition:
+            proc = subprocess.Popen(
+                runc_cmd, stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            )
+            self._track_other(proc)
+        try:
+            stdout, stderr = _read_pipes(proc.stdout, proc.stderr)
+        finally:
+            returncode = self._wait_other(proc)
+            proc.stdout.close()
+            proc.stderr.close()
+        return subprocess.CompletedProcess(
+            runc_cmd, returncode,
+            stdout.decode(errors='surrogateescape'),
+            stderr.decode(errors='surrogateescape'),
+        )
+
+    def _wait_other(self, proc, timeout=None):
+        # Waits for proc, registered in _other_pids with a callback that
+        # sets its returncode, reaping it here unless _reap() gets there
+        # first (Popen.wait() would race _reap() for the exit status).
+        # Returns None if still running after timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._condition:
+                if proc.returncode is None:
+                    try:
+                        pid, sts = os.waitpid(proc.pid, os.WNOHANG)
+                    except ChildProcessError:
+                        # Reaped elsewhere, so exit status unknown
+                        pid, sts = proc.pid, None
+                    if pid:
+                        self._other_pids[proc.pid](
+                            255 if sts is None else compute_returncode(sts)
+                        )
+                if proc.returncode is not None:
+                    self._other_pids.pop(proc.pid, None)
+                    return proc.returncode
+            delay = 0.05
+            if deadline is not None:
+                delay = min(delay, deadline - time.monotonic())
+                if delay <= 0:
+                    return None
+            self._sleep_until_exit([proc], delay)
+
+    def _exec_notty(self, container, exec_proc, runc_cmd, spec_fd):
+        runc_cmd += [container.name]
+        parents, children = self._make_stdio_pairs()
+
+        try:
+            # Registered before _reap() can see it exit
+            with self._condition:
+                proc = subprocess.Popen(
+                    runc_cmd, stdin=children[0], stdout=children[1],
+                    stderr=children[2], pass_fds=(spec_fd,),
+                )
+                exec_proc._proc = proc
+                exec_proc.pid = proc.pid
+                self._other_pids[proc.pid] = exec_proc._set_returncode
+                self._execs[proc.pid] = exec_proc
+        except Exception:
+            for fileobj in parents:
+                fileobj.close()
+            raise
+        finally:
+            for fileobj in children:
+                fileobj.close()
+
+        self._use_stdio_pairs(exec_proc, parents)
+
+        return exec_proc
+
+    def _forget_exec(self, exec_proc):
+        with self._condition:
+            self._execs.pop(exec_proc.pid, None)
+            if exec_proc.returncode is not None:
+                self._other_pids.pop(exec_proc.pid, None)
+
+    def exec_until_complete(self, container, args, env=None, cwd=None,
+                            user=None):
+        # With our stdio (a tty if stdio is one)
+        phase = partial(self.timer.phase, container=container.name)
+        exec_proc = None
+
+        try:
+            with phase('exec.setup'):
+                self._setup_stdio()
+                use_tty = (
+                    self.tty_fd is not None and
+                    output_isatty(self.stdin, self.stdout)
+                )
+                self.tty_raw = use_tty
+                self._set_tty_raw()
+                self._setup_signals()
+                self._set_subreaper(True)
+
+            exec_proc = self.exec_in_container(
+                container, args, env=env, cwd=cwd, tty=use_tty, user=user,
+            )
+            self._resize_tty()
+
+            exec_proc._stop_event = threading.Event()
+            self._start_iopumps(exec_proc, f'{container.name}-exec', [
+                ('stdin', self._borrow(self.stdin, 'rb'), exec_proc.stdin),
+                ('stdout', exec_proc.stdout, self._borrow(self.stdout, 'wb')),
+                ('stderr', exec_proc.stderr, self._borrow(self.stderr, 'wb')),
+            ], 0.1 if use_tty else 0.2)
+
+            with phase('exec.wait'):
+                self._process_signals(
+                    done=lambda: exec_proc.returncode is not None
+                )
+            self.returncode = exec_proc.returncode
+
+        except Exception as e:
+            self._write_log(traceback.format_exc())
+            if isinstance(e, RuncError):
+                self.returncode = e.code
+            else:
+                self.returncode = 1
+
+        finally:
+            with phase('exec.teardown'):
+                if exec_proc:
+                    if exec_proc.returncode is None:
+                        os.kill(exec_proc.pid, signal.SIGKILL)
+                    exec_proc.close()
+                    self._report_io_stats(exec_proc)
+                self._release_host()
+
+        return self.returncode
@@ -0,0 +1,343 @@
+import os
+import re
+import stat
+import json
+import errno
+import queue
+import hashlib
+import threading
+import subprocess
+from pathlib import Path
+
+from darkwing.utils import probably_root, parse_size, write_atomic, copy_fd
+from darkwing.utils.syscalls import (
+    MS_NOSUID, MS_NODEV, MS_NOEXEC, mount, umount,
+)
+
+SECRETS_DIR = 'secrets'
+# Source hashes of what's staged, kept alongside (so also on tmpfs)
+MANIFEST = '.manifest.json'
+
+TMPFS_TYPES = ('tmpfs', 'ramfs')
+TMPFS_SOURCE = 'darkwing-secrets'
+DEFAULT_TMPFS_SIZE = '4M'
+
+SOURCE_TYPES = ('copy', 'gpg', 'age')
+# Dropped from encrypted files' names when staged
+_SUFFIXES = {
+    'gpg': ('.gpg', '.pgp', '.asc'),
+    'age': ('.age',),
+}
+
+DEFAULT_WORKERS = min(8, os.cpu_count() or 1)
+
+_CHUNK = 1 << 16
+
+_escape_re = re.compile(r'\\([0-7]{3})')
+
+
+def mount_info(path):
+    # (mount point, fs type, source) from /proc/self/mountinfo
+    path = os.path.realpath(path)
+    found = ('', None, None)
+    with open('/proc/self/mountinfo') as f:
+        for line in f:
+            fields = line.split()
+            try:
+                point = _escape_re.sub(
+                    lambda m: chr(int(m.group(1), 8)), fields[4]
+                )
+                sep = fields.index('-', 6)
+                fstype, source = fields[sep + 1], fields[sep + 2]
+            except (IndexError, ValueError):
+                continue
+            if path != point and not path.startswith(point.rstrip('/') + '/'):
+                continue
+            # Later lines are mounted over earlier ones
+            if len(point) >= len(found[0]):
+                found = (point, fstype, source)
+    return found
+
+def _check_tmpfs(path, mountable=False):
+    # True if path is already on tmpfs, False if one may be mounted
+    _, fstype, _ = mount_info(path)
+    if fstype in TMPFS_TYPES:
+        return True
+    if not mountable:
+        raise OSError(
+            errno.EPERM, f'Secrets dir on {fstype}, not tmpfs', str(path)
+        )
+    return False
+
+def ensure_tmpfs(path, size=DEFAULT_TMPFS_SIZE):
+    # Mounts a private tmpfs (root only); returns True if it did
+    if _check_tmpfs(path, mountable=probably_root()):
+        return False
+    mount(
+        TMPFS_SOURCE, path, 'tmpfs', MS_NOSUID | MS_NODEV | MS_NOEXEC,
+        f'mode=0700,size={parse_size(size)}',
+    )
+    return True
+
+def _staged_name(name, kind):
+    for suffix in _SUFFIXES.get(kind, ()):
+        if name.endswith(suffix) and len(name) > len(suffix):
+            return name[:-len(suffix)]
+    return name
+
+def collect_secrets(sources):
+    # {staged name: (source path, table)}, later sources win; missing
+    # sources and hidden files skipped
+    found = {}
+    for source in sources:
+        kind = source.get('type', 'copy')
+        if kind not in SOURCE_TYPES:
+            raise ValueError(f'Invalid secrets source type: {kind!r}')
+        path = Path(source['path'])
+        if path.is_file():
+            name = source.get('name') or _staged_name(path.name, kind)
+            found[name] = (str(path), source)
+            continue
+        for dir_path, dir_names, file_names in os.walk(path):
+            dir_names[:] = [ d for d in dir_names if not d.startswith('.') ]
+            rel = os.path.relpath(dir_path, path)
+            for name in file_names:
+                full = os.path.join(dir_path, name)
+                if name.startswith('.') or not os.path.isfile(full):
+                    continue
+                name = _staged_name(name, kind)
+                found[os.path.normpath(os.path.join(rel, name))] = (
+                    full, source
+                )
+    return found
+
+def _hash_fd(fd):
+    # Leaves fd rewound, ready to copy
+    digest = hashlib.sha256()
+    while True:
+        chunk = os.read(fd, _CHUNK)
+        if not chunk:
+            break
+        digest.update(chunk)
+    os.lseek(fd, 0, os.SEEK_SET)
+    return digest.hexdigest()
+
+def _decrypt_cmd(kind, source):
+    # Both read ciphertext from stdin, write plaintext to stdout
+    if kind == 'gpg':
+        cmd = ['gpg', '--batch', '--quiet', '--decrypt']
+        if source.get('homedir'):
+            cmd[1:1] = ['--homedir', source['homedir']]
+        return cmd
+    cmd = ['age', '--decrypt']
+    if source.get('identity'):
+        cmd.extend(['--identity', source['identity']])
+    return cmd
+
+def _decrypt_fd(kind, source, path, src_fd, dst_fd):
+    # Plaintext goes straight to dst_fd (on tmpfs), never via a pipe
+    # through us or any other file
+    proc = subprocess.run(
+        _decrypt_cmd(kind, source), stdin=src_fd, stdout=dst_fd,
+        stderr=subprocess.PIPE,
+    )
+    if proc.returncode:
+        errmsg = proc.stderr.decode(errors='replace').strip()
+        raise RuntimeError(f'Decrypting {path} failed: {errmsg}')
+
+def _wipe_file(path):
+    # Zeroes regular files before unlinking, so secrets don't linger
+    # in freed pages
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return False
+    if stat.S_ISREG(st.st_mode) and st.st_nlink == 1 and st.st_size:
+        try:
+            os.chmod(path, stat.S_IRUSR | stat.S_IWUSR)
+            fd = os.open(path, os.O_WRONLY | os.O_NOFOLLOW | os.O_CLOEXEC)
+        except OSError:
+            pass
+        else:
+            try:
+                zeros = bytes(min(st.st_size, _CHUNK))
+                offset = 0
+                while offset < st.st_size:
+                    count = min(len(zeros), st.st_size - offset)
+                    offset += os.pwrite(fd, zeros[:count], offset)
+            finally:
+                os.close(fd)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    return True
+
+def _stage_one(secrets_path, name, path, source, entry):
+    # Returns (manifest entry, whether written)
+    kind = source.get('type', 'copy')
+    mode = int(str(source.get('mode', '0400')), 8)
+    dest = secrets_path / name
+
+    src_fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        st = os.fstat(src_fd)
+        # Unchanged file (by stat) needs no reading at all...
+        stamp = [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, kind]
+        staged = entry is not None and dest.exists()
+        if staged and entry['stamp'] == stamp and entry['mode'] == mode:
+            return entry, False
+        # ...and unchanged content (eg. just touched) no copying or
+        # decrypting
+        digest = _hash_fd(src_fd)
+        new_entry = {'stamp': stamp, 'hash': digest, 'mode': mode}
+        if staged and entry['hash'] == digest and entry['stamp'][4] == kind:
+            os.chmod(dest, mode)
+            return new_entry, False
+
+        tmp_path = dest.with_name(f'.{dest.name}.tmp')
+        dst_fd = os.open(
+            tmp_path,
+            os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW
+            | os.O_CLOEXEC,
+            0o600,
+        )
+        try:
+            try:
+                if kind == 'copy':
+                    # In-kernel, via copy_file_range() where possible
+                    copy_fd(src_fd, dst_fd)
+                else:
+                    _decrypt_fd(kind, source, path, src_fd, dst_fd)
+                os.fchmod(dst_fd, mode)
+            finally:
+                os.close(dst_fd)
+            os.replace(tmp_path, dest)
+        except BaseException:
+            _wipe_file(tmp_path)
+            raise
+        return new_entry, True
+    finally:
+        os.close(src_fd)
+
+def _load_manifest(path):
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
+
+def _has_secrets(config, secrets_path):
+    sources = config.data.get('secrets', {}).get('sources', ())
+    if (secrets_path / MANIFEST).exists():
+        return True
+    return bool(collect_secrets(sources))
+
+def mount_secrets(config, rundir_path):
+    # Before runc create, which binds the dir as it is then
+    secrets_path = Path(rundir_path) / SECRETS_DIR
+    if not _has_secrets(config, secrets_path):
+        return False
+    secrets_path.mkdir(mode=0o700, exist_ok=True)
+    size = config.data.get('secrets', {}).get('size', DEFAULT_TMPFS_SIZE)
+    return ensure_tmpfs(secrets_path, size)
+
+def stage_secrets(config, rundir_path, workers=None):
+    # Into the tmpfs from mount_secrets(), so nothing decrypted hits
+    # disk; unchanged sources (by hash) left alone
+    secrets = config.data.get('secrets', {})
+    found = collect_secrets(secrets.get('sources', ()))
+    secrets_path = Path(rundir_path) / SECRETS_DIR
+    manifest_path = secrets_path / MANIFEST
+    if not found and not manifest_path.exists():
+        return 0
+
+    secrets_path.mkdir(mode=0o700, exist_ok=True)
+    _check_tmpfs(secrets_path)
+    manifest = _load_manifest(manifest_path)
+    for name in found:
+        if os.sep in name:
+            (secrets_path / name).parent.mkdir(
+                mode=0o700, parents=True, exist_ok=True
+            )
+
+    pending = queue.SimpleQueue()
+    for item in found.items():
+        pending.put(item)
+    staged = {}
+    errors = []
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            try:
+                name, (path, source) = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                result = _stage_one(
+                    secrets_path, name, path, source, manifest.get(name)
+                )
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+                continue
+            with lock:
+                staged[name] = result
+
+    if workers is None:
+        workers = DEFAULT_WORKERS
+    workers = min(workers, len(found))
+    if workers <= 1:
+        # Common case of one or two small files: no threads to start
+        work()
+    else:
+        threads = [
+            threading.Thread(name=f'secrets-{n}', target=work, daemon=True)
+            for n in range(workers)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    # Anything no longer in sources goes, as do failed ones' old copies
+    for name in manifest:
+        if name not in staged:
+            _wipe_file(secrets_path / name)
+    write_atomic(
+        manifest_path,
+        json.dumps({ name: entry for name, (entry, _) in staged.items() }),
+        mode=0o600,
+    )
+    if errors:
+        raise errors[0]
+    return sum(1 for _, written in staged.values() if written)
+
+def wipe_secrets(rundir_path):
+    # Zeroed first, then any tmpfs ensure_tmpfs() mounted is unmounted
+    secrets_path = Path(rundir_path) / SECRETS_DIR
+    if not secrets_path.is_dir():
+        return False
+    removed = False
+    for dir_path, dir_names, file_names in os.walk(
+        secrets_path, topdown=False
+    ):
+        for name in file_names:
+            removed = _wipe_file(os.path.join(dir_path, name)) or removed
+        for name in dir_names:
+            path = os.path.join(dir_path, name)
+            try:
+                if os.path.islink(path):
+                    os.unlink(path)
+                else:
+                    os.rmdir(path)
+            except OSError:
+                pass
+
+    point, _, source = mount_info(secrets_path)
+    if point == os.path.realpath(secrets_path) and source == TMPFS_SOURCE:
+        umount(secrets_path)
+        removed = True
+    return removed
@@ -0,0 +1,483 @@
+import os
+import sys
+import json
+import time
+import signal
+import selectors
+import subprocess
+import traceback
+from pathlib import Path
+
+from darkwing.utils import write_atomic, is_locked
+from darkwing.utils.ttys import resize_tty
+from darkwing.config.context import Context
+from darkwing.config.container import Config, Container, Rundir
+from .logs import LOG_STREAMS, make_log_writers
+from .attach import (
+    FRAME_RESIZE, make_attach_server, attach_input, WINSIZE,
+)
+from .runc import IOStats, RuncError, RuncExecutor
+
+# Files written to the container's rundir by its shim
+SHIM_FILE = 'shim.json'
+EXIT_FILE = 'exit.json'
+SHIM_LOG = 'shim.log'
+
+
+# Supervises one detached container from a single-threaded select
+# loop: pty/pipes to logs and attach clients, reaping, signals and
+# exit status in the rundir
+class ContainerShim(object):
+
+    # Time allowed to drain output once the container has exited
+    DRAIN_TIMEOUT = 1.0
+    # Client input buffered for the container, beyond which the
+    # sending client is disconnected
+    INPUT_LIMIT = 64 * 1024
+
+    def __init__(self, executor, container, remove=True):
+        self.executor = executor
+        self.container = container
+        self.remove = remove
+        self.pid = os.getpid()
+        self._selector = None
+        self._streams = {}
+        self._exited_at = None
+        self._attach = None
+        self._input = bytearray()
+        self._input_fd = None
+        self._input_eof = False
+        self._writing = False
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} pid={self.pid} "
+            f"container={self.container.name!r}>"
+        )
+
+    def _setup_streams(self):
+        con = self.container
+        # No flusher threads; the loop flushes on each pass instead
+        con.log_writers = make_log_writers(
+            con.config, con.rundir, flush_thread=False
+        )
+        if con.tty is not None:
+            # All output (so just the stdout log) and input on one pty
+            con.stderr.close()
+            con.stderr = None
+        if con.stdin and attach_input(con.config):
+            if con.tty is not None:
+                # Own fd for writes, registered apart from reads
+                self._input_fd = os.dup(con.tty)
+            else:
+                self._input_fd = con.stdin.fileno()
+            os.set_blocking(self._input_fd, False)
+        elif con.stdin:
+            # Nothing to feed the container's input from
+            con.stdin.close()
+            con.stdin = None
+
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(
+            self.executor._sig_rsock, selectors.EVENT_READ, None
+        )
+        for stream in LOG_STREAMS:
+            read_from = getattr(con, stream)
+            if not read_from:
+                continue
+            os.set_blocking(read_from.fileno(), False)
+            con.io_stats[stream] = IOStats()
+            self._selector.register(read_from, selectors.EVENT_READ, stream)
+            self._streams[stream] = read_from
+
+        # Attach server callbacks are registered as the selector data
+        self._attach = make_attach_server(
+            con.config, con.rundir, on_input=self._on_input
+        )
+        if self._attach:
+            self._attach.open(self._selector)
+
+    def _on_input(self, kind, data):
+        # From attach clients; False disconnects the sender
+        con = self.container
+        if kind == FRAME_RESIZE:
+            if con.tty is not None and len(data) == WINSIZE.size:
+                lines, columns = WINSIZE.unpack(data)
+                try:
+                    resize_tty(con.tty, columns, lines)
+                except OSError:
+                    pass
+            return True
+        if self._input_fd is None or self._input_eof:
+            return True
+        if not data:
+            # Ptys have no EOF as such (clients send ^D as input)
+            if con.tty is None:
+                self._input_eof = True
+                self._write_input()
+            return True
+        if len(self._input) + len(data) > self.INPUT_LIMIT:
+            return False
+        self._input.extend(data)
+        self._write_input()
+        return True
+
+    def _write_input(self, key=None, mask=None):
+        try:
+            while self._input:
+                del self._input[:os.write(self._input_fd, self._input)]
+        except BlockingIOError:
+            pass
+        except OSError:
+            # Container closed its input, so takes no more
+            self._input.clear()
+            self._input_eof = True
+
+        # Only wait for writability while there's something to write
+        if self._input and not self._writing:
+            self._selector.register(
+                self._input_fd, selectors.EVENT_WRITE, self._write_input
+            )
+            self._writing = True
+        elif not self._input and self._writing:
+            self._selector.unregister(self._input_fd)
+            self._writing = False
+        if not self._input and self._input_eof:
+            self._close_input()
+
+    def _close_input(self):
+        con = self.container
+        if self._input_fd is None:
+            return
+        if self._writing:
+            self._selector.unregister(self._input_fd)
+            self._writing = False
+        if con.tty is not None:
+            os.close(self._input_fd)
+        elif con.stdin:
+            con.stdin.close()
+            con.stdin = None
+        self._input_fd = None
+        self._input.clear()
+
+    def _close_streams(self):
+        con = self.container
+        if self._selector:
+            self._close_input()
+        if self._attach:
+            self._attach.close(returncode=con.returncode)
+            if self._attach.dropped:
+                self.executor._debug_log(
+                    f'Attach clients missed {self._attach.dropped} bytes'
+                )
+            self._attach = None
+        if self._selector:
+            self._selector.close()
+            self._selector = None
+        for stream in LOG_STREAMS:
+            read_from = getattr(con, stream)
+            if read_from:
+                read_from.close()
+                setattr(con, stream, None)
+        self._streams.clear()
+        for writer in con.log_writers.values():
+            writer.close()
+
+    def _read_stream(self, stream, read_from):
+        try:
+            data = os.read(read_from.fileno(), 64 * 1024)
+        except BlockingIOError:
+            return
+        except OSError:
+            # Pty/socket hangup, treat as EOF
+            data = b''
+
+        if not data:
+            self._selector.unregister(read_from)
+            del self._streams[stream]
+            return
+
+        stats = self.container.io_stats[stream]
+        stats.reads += 1
+        stats.bytes_in += len(data)
+        self.container.log_writers[stream].write(data)
+        stats.writes += 1
+        stats.bytes_out += len(data)
+        if self._attach:
+            self._attach.publish(stream, data)
+
+    def _handle_signals(self):
+        ex = self.executor
+        try:
+            data = ex._sig_rsock.recv(4096)
+        except InterruptedError:
+            return
+        for sig in data:
+            if sig == signal.SIGCHLD:
+                ex._reap()
+                if (self.container.returncode is not None and
+                        self._exited_at is None):
+                    self._exited_at = time.monotonic()
+            elif sig == signal.SIGTERM:
+                # Graceful stop, escalating to SIGKILL
+                ex.stop_containers(wait=False)
+            elif sig in ex.FORWARD_SIGNALS:
+                ex._send_signal(sig)
+
+    def _loop(self):
+        writers = self.container.log_writers.values()
+        interval = min(w.flush_interval for w in writers) or 1.0
+
+        # Run until container exits and its output is drained (or
+        # something else holding the pipes open outlives it)
+        while self._exited_at is None or self._streams:
+            timeout = interval
+            next_timer = self.executor._timers.next_timeout()
+            if next_timer is not None:
+                timeout = min(timeout, next_timer)
+            if self._exited_at is not None:
+                remaining = self._exited_at + self.DRAIN_TIMEOUT
+                remaining -= time.monotonic()
+                if remaining <= 0:
+                    break
+                timeout = min(timeout, remaining)
+
+            for key, mask in self._selector.select(timeout):
+                if key.data is None:
+                    self._handle_signals()
+                elif isinstance(key.data, str):
+                    self._read_stream(key.data, key.fileobj)
+                else:
+                    key.data(key, mask)
+
+            self.executor._timers.advance()
+            for writer in writers:
+                writer.flush()
+
+    def _write_state(self, path, data):
+        write_atomic(
+            self.container.rundir_path / path,
+            json.dumps(data, separators=(',', ':')), mode=0o640,
+        )
+
+    def run(self, notify=None):
+        # notify(state) once running, or notify(error) if not started
+        ex = self.executor
+        con = self.container
+        # A pty if configured, all its output going to the stdout log
+        con.use_tty = bool(con.config.data['exec'].get('terminal', True))
+        started = False
+
+        ex._ensure_state_dir()
+        try:
+            ex._setup_signals()
+            ex._set_subreaper(True)
+
+            ex.create_container(con, attach_stdio=False)
+            self._setup_streams()
+            ex.start_container(con)
+
+            state = {
+                'pid': self.pid,
+                'container_pid': con.pid,
+                'started_at': time.time(),
+            }
+            self._write_state(SHIM_FILE, state)
+            started = True
+            if notify:
+                notify(state)
+            ex._debug_log(f'Shim {self.pid} supervising pid {con.pid}')
+
+            self._loop()
+            ex.returncode = ex._get_returncode()
+            self._write_state(EXIT_FILE, {
+                'returncode': ex.returncode,
+                'container_pid': con.pid,
+                'finished_at': time.time(),
+            })
+            ex._debug_log(f'Container exited ({ex.returncode})')
+
+            if self.remove:
+                ex.remove_container(con)
+                ex._debug_log('Container removed')
+
+        except Exception as e:
+            ex._write_log(traceback.format_exc())
+            ex.returncode = e.code if isinstance(e, RuncError) else 1
+            if not started and notify:
+                notify({'error': str(e), 'code': ex.returncode})
+            # Don't leave the container running unsupervised
+            if con.pid and con.returncode is None:
+                try:
+                    os.kill(con.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+        finally:
+            self._close_streams()
+            ex._close()
+            ex._set_subreaper(False)
+            ex._restore_signals()
+
+        return ex.returncode
+
+
+def _job(executor, container, remove, notify_fd):
+    # What the shim process needs to rebuild executor and container
+    context = container.context
+    if context is not None and not isinstance(context, (str, bytes)):
+        context = {
+            'name': context.name,
+            'path': str(context.path),
+            'data': context.data,
+        }
+    return {
+        'name': container.name,
+        'config': {
+            'name': container.config.name,
+            'path': str(container.config.path),
+            'data': container.config.data,
+        },
+        'context': context,
+        'rundir': {
+            'path': str(container.rundir.path),
+            'data': container.rundir.data,
+        },
+        'executor': {
+            'context_name': executor._state_dir.parent.name,
+            'state_dir': str(executor._state_dir.parent.parent),
+            'uid': executor.uid,
+            'gid': executor.gid,
+            'debug': executor.debug,
+        },
+        'remove': remove,
+        'notify_fd': notify_fd,
+    }
+
+def _shim_main(job):
+    rundir = Rundir(Path(job['rundir']['path']), job['rundir']['data'])
+    # Detach from caller's stdio; shim output goes to its own log
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    os.close(devnull)
+    log_file = open(rundir.path / SHIM_LOG, 'a', buffering=1)
+    executor = RuncExecutor(log_file=log_file, **job['executor'])
+
+    context = job['context']
+    if isinstance(context, dict):
+        context = Context(
+            context['name'], Path(context['path']), context['data']
+        )
+    config = Config(
+        job['config']['name'], Path(job['config']['path']),
+        job['config']['data'],
+    )
+    container = Container(
+        job['name'], config, rundir=rundir, context=context
+    )
+    notify_fd = job['notify_fd']
+
+    def notify(state):
+        nonlocal notify_fd
+        if notify_fd is None:
+            return
+        with open(notify_fd, 'wb') as f:
+            f.write(json.dumps(state).encode())
+        notify_fd = None
+
+    try:
+        shim = ContainerShim(executor, container, remove=job['remove'])
+        return shim.run(notify=notify)
+    finally:
+        if notify_fd is not None:
+            os.close(notify_fd)
+        log_file.close()
+
+def main():
+    # Job arrives as JSON on stdin; forks again first (while still
+    # single-threaded), so the shim is no child of the caller and
+    # never gains a controlling terminal
+    job = json.loads(sys.stdin.buffer.read())
+    if os.fork():
+        os._exit(0)
+    return _shim_main(job) or 0
+
+def run_detached(executor, container, remove=True):
+    # Shim holds the lock while supervising; caller may exit any time
+    # after, see read_shim_state()
+    if not container.rundir:
+        container.make_rundir()
+    for name in (SHIM_FILE, EXIT_FILE):
+        try:
+            (container.rundir_path / name).unlink()
+        except FileNotFoundError:
+            pass
+
+    rfd, wfd = os.pipe()
+    job = _job(executor, container, remove, wfd)
+    # Wherever the caller found darkwing, so does the shim
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [
+        str(Path(__file__).resolve().parents[2]), env.get('PYTHONPATH'),
+    ]))
+    try:
+        # Spawned, not forked, so none of the caller's threads or
+        # state (eg. other containers' locks) carry over
+        proc = subprocess.Popen(
+            [sys.executable, '-m', 'darkwing.runtimes.shim'],
+            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+            pass_fds=(wfd,), start_new_session=True, env=env,
+        )
+    finally:
+        os.close(wfd)
+    # Returns once the session leader exits, leaving the shim running
+    proc.communicate(json.dumps(job, default=str).encode())
+    with open(rfd, 'rb') as f:
+        msg = f.read()
+
+    if not msg:
+        raise RuncError(
+            container.name, 'Shim exited before starting container'
+        )
+    state = json.loads(msg)
+    if 'error' in state:
+        raise RuncError(container.name, state['error'], code=state['code'])
+
+    # Not our child, so only informational from here
+    container.pid = state['container_pid']
+    container.status = 'running'
+    return state
+
+def read_shim_state(container):
+    # None if never detached; 'lost' if the shim died without an exit
+    # status
+    if not container.rundir:
+        return None
+    try:
+        state = json.loads((container.rundir_path / SHIM_FILE).read_text())
+    except FileNotFoundError:
+        return None
+
+    try:
+        exit_state = json.loads(
+            (container.rundir_path / EXIT_FILE).read_text()
+        )
+    except FileNotFoundError:
+        exit_state = None
+
+    if exit_state is not None:
+        state.update(exit_state)
+        state['status'] = 'exited'
+        return state
+
+    # Shim's lock can't be fooled by pid reuse, unlike kill(pid, 0)
+    if is_locked(container.rundir_lock_path):
+        state['status'] = 'running'
+    else:
+        state['status'] = 'lost'
+    return state
+
+
+if __name__ == '__main__':
+    sys.exit(main())
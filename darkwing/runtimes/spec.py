@@ -1,9 +1,16 @@
 import os
 import json
 import shlex
+import hashlib
 from pathlib import Path
 
-from darkwing.utils.files import ensure_dirs
+from darkwing.utils.files import ensure_dirs, write_atomic
+from darkwing.utils.env import read_env_file
+from darkwing.utils.units import parse_size
+from darkwing.utils.subids import container_id_maps
+from darkwing.utils.users import probably_root
+from darkwing.storage.seed import seed_marker, seed_volume
+from darkwing.storage.idmap import IdShifter
 
 def _split_args(args):
     if isinstance(args, str):
@@ -15,15 +22,110 @@ def _split_args(args):
 def _update_capabilities(caps, caps_config):
     new_caps = {}
 
+    # Build lookups once, rather than per capability set
+    drop_set = set(caps_config['drop'])
+    add_list = list(dict.fromkeys(caps_config['add']))
+
     for kind, cap_list in caps.items():
-        new_list = [c for c in cap_list if c not in set(caps_config['drop'])]
+        new_list = [c for c in cap_list if c not in drop_set]
         new_set = set(new_list)
-        new_list.extend(c for c in caps_config['add'] if c not in new_set)
+        new_list.extend(c for c in add_list if c not in new_set)
         new_caps[kind] = new_list
 
     return new_caps
 
-def _update_environment(env, env_config):
+# As the OCI spec (and setrlimit()) expect for no limit
+RLIM_INFINITY = 2**64 - 1
+_UNLIMITED = ('unlimited', 'infinity', '-1')
+
+def _rlimit_value(rlimit_type, value):
+    if str(value).strip().lower() in _UNLIMITED:
+        return RLIM_INFINITY
+    # Sizes (eg. fsize, memlock) may use suffixes, as elsewhere
+    try:
+        return parse_size(value)
+    except ValueError:
+        raise ValueError(
+            f'Invalid {rlimit_type} limit: {value!r}'
+        ) from None
+
+def _update_rlimits(rlimits, rlimits_config):
+    rlimit_map = { r['type']: r for r in rlimits }
+
+    # Accept either 'nofile' or 'RLIMIT_NOFILE', and either a
+    # single value or a [soft, hard] pair
+    for name, value in rlimits_config.items():
+        rlimit_type = name.upper()
+        if not rlimit_type.startswith('RLIMIT_'):
+            rlimit_type = f'RLIMIT_{rlimit_type}'
+        if isinstance(value, (list, tuple)):
+            soft, hard = value
+        else:
+            soft = hard = value
+        rlimit_map[rlimit_type] = {
+            'type': rlimit_type,
+            'soft': _rlimit_value(rlimit_type, soft),
+            'hard': _rlimit_value(rlimit_type, hard),
+        }
+
+    return list(rlimit_map.values())
+
+def _merge_resources(defaults, res_config):
+    # Context defaults under container's own, section by section; zero
+    # means unset, except in rlimits (where it's a real limit)
+    merged = {}
+    for section in set(defaults) | set(res_config):
+        base = defaults.get(section) or {}
+        own = res_config.get(section) or {}
+        if section != 'rlimits':
+            own = { key: value for key, value in own.items() if value }
+        merged[section] = { **base, **own }
+    return merged
+
+def _update_resources(resources, res_config):
+    new_res = dict(resources)
+
+    # CPU: shares (relative weight), quota/period (us), or limit as a
+    # (fractional) number of CPUs, converted to quota over period
+    cpu_config = res_config.get('cpu', {})
+    cpu = dict(new_res.get('cpu', {}))
+    if cpu_config.get('shares'):
+        cpu['shares'] = int(cpu_config['shares'])
+    period = int(cpu_config.get('period') or 0)
+    if cpu_config.get('quota'):
+        cpu['quota'] = int(cpu_config['quota'])
+    elif cpu_config.get('limit'):
+        period = period or 100000
+        cpu['quota'] = int(float(cpu_config['limit']) * period)
+    if period:
+        cpu['period'] = period
+    if cpu:
+        new_res['cpu'] = cpu
+
+    # Memory: sizes in bytes or with suffix, swap is memory+swap total
+    mem_config = res_config.get('memory', {})
+    memory = dict(new_res.get('memory', {}))
+    for key in ('limit', 'reservation', 'swap'):
+        if mem_config.get(key):
+            memory[key] = parse_size(mem_config[key])
+    if memory:
+        new_res['memory'] = memory
+
+    # Pids
+    pids_config = res_config.get('pids', {})
+    if pids_config.get('limit'):
+        new_res['pids'] = { 'limit': int(pids_config['limit']) }
+
+    # Block I/O
+    blkio_config = res_config.get('blkio', {})
+    if blkio_config.get('weight'):
+        block_io = dict(new_res.get('blockIO', {}))
+        block_io['weight'] = int(blkio_config['weight'])
+        new_res['blockIO'] = block_io
+
+    return new_res
+
+def _update_environment(env, env_config, base_path=None):
     env_vars = {}
 
     # First expand into dictionary
@@ -31,6 +133,13 @@ def _update_environment(env, env_config):
         name, sep, value = var.partition('=')
         env_vars[name] = value
 
+    # Merge files in order, so vars/host below still take precedence
+    for env_file in env_config.get('files', []):
+        env_path = Path(env_file)
+        if base_path and not env_path.is_absolute():
+            env_path = Path(base_path) / env_path
+        env_vars.update(read_env_file(env_path))
+
     # Set/unset fixed
     for var in env_config['vars']:
         name, sep, value = var.partition('=')
@@ -51,8 +160,6 @@ def _update_environment(env, env_config):
         else:
             env_vars.pop(name, None)
 
-    # TODO: read & parse files
-
     return [ f"{name}={value}" for name, value in env_vars.items() ]
 
 def _mount_source_path(mount_type, mount_src, volumes, rundir_data):
@@ -78,14 +185,7 @@ def _mount_source_path(mount_type, mount_src, volumes, rundir_data):
 
     return mount_path
 
-def _mount_spec(mount, volumes, rundir_data):
-    # Vary based on mount type
-    mount_type = mount['type']
-    mount_src = mount['source']
-    mount_path = _mount_source_path(
-        mount_type, mount_src, volumes, rundir_data
-    )
-
+def _mount_spec(mount, mount_path):
     # Base spec
     mount_spec = {
         'destination': mount['target'],
@@ -104,40 +204,129 @@ def _mount_spec(mount, volumes, rundir_data):
 
     return mount_spec
 
-def _update_mounts(mounts, volumes, rundir_data):
-    mount_map = { m['destination']: m for m in mounts }
-    
-    for mount in volumes['mounts']:
-        spec = _mount_spec(mount, volumes, rundir_data)
-        mount_map[spec['destination']] = spec
-
-    if rundir_data:
-        for mount in rundir_data['mounts']:
-            spec = _mount_spec(mount, volumes, rundir_data)
-            mount_map[spec['destination']] = spec
-
-    return list(mount_map.values())
-
-def _ensure_mounts(volumes, rundir_data, ouid=None, ogid=None):
-    mount_dirs = []
+# For tmpfs volumes not giving their own
+TMPFS_SIZE = '64M'
+TMPFS_MODE = '1777'
+
+def _tmpfs_spec(mount, default_size=TMPFS_SIZE):
+    target = mount['target']
+    if not target.startswith('/'):
+        raise ValueError(f'Tmpfs mount "{target}" must be absolute')
+    # Unlimited tmpfs could take half the host's memory
+    size = parse_size(mount.get('size', default_size))
+    if size <= 0:
+        raise ValueError(f'Tmpfs mount "{target}" needs a size limit')
+    mode = mount.get('mode', TMPFS_MODE)
+    if isinstance(mode, str):
+        mode = int(mode, 8)
+
+    options = ['nodev', 'nosuid', f'mode={mode:o}', f'size={size}']
+    if mount.get('noexec'):
+        options.append('noexec')
+    for key in ('uid', 'gid'):
+        if mount.get(key) is not None:
+            options.append(f'{key}={int(mount[key])}')
+    return {
+        'destination': target,
+        'type': 'tmpfs',
+        'source': 'tmpfs',
+        'options': options,
+    }
 
+def mount_plan(volumes, rundir_data):
+    # Resolved once for _update_mounts() and _ensure_mounts(), with one
+    # stat() per bind source; tmpfs volumes have none
+    resolved = {}
+    specs = {}
+    dirs = {}
+    seeds = {}
+    missing = []
+
+    def resolve(mount):
+        key = (mount['type'], mount['source'])
+        try:
+            return resolved[key]
+        except KeyError:
+            path = _mount_source_path(*key, volumes, rundir_data)
+            resolved[key] = path
+            return path
+
+    tmpfs_size = volumes.get('tmpfs_size', TMPFS_SIZE)
     for mount in volumes['mounts']:
         mount_type = mount['type']
-        mount_path = _mount_source_path(
-            mount_type, mount['source'], volumes, rundir_data
-        )
+        if mount.get('seed') and mount_type in ('bind', 'tmpfs'):
+            raise ValueError(
+                f'Cannot seed {mount_type} mount "{mount["target"]}"'
+            )
+        if mount_type == 'tmpfs':
+            spec = _tmpfs_spec(mount, tmpfs_size)
+            specs[spec['destination']] = spec
+            continue
+        mount_path = resolve(mount)
         if mount_type == 'bind':
-            # For bind mounts, ensure exists
-            if not mount_path.exists():
-                raise ValueError(f'Bind mount "{mount_path}" must exist')
-        else:
-            # For volumes, ensure directory created
+            # For bind mounts, check exists (reported in _ensure_mounts)
+            if mount_path not in dirs:
+                try:
+                    os.stat(mount_path)
+                except FileNotFoundError:
+                    missing.append(mount_path)
+                # Mark as seen, but no dir to create
+                dirs[mount_path] = None
+        elif mount_path not in dirs:
+            # For volumes, directory to be created
             dir_mode = mount.get('mode', '0770')
             if isinstance(dir_mode, str):
                 dir_mode = int(dir_mode, 8)
-            mount_dirs.append((mount_path, dir_mode))
+            dirs[mount_path] = dir_mode
+        if mount.get('seed') and mount_path not in seeds:
+            # Marker kept in the volume type's base dir
+            base = _mount_source_path(mount_type, '', volumes, rundir_data)
+            seeds[mount_path] = (
+                mount['target'], seed_marker(base, mount_path)
+            )
+        # Later mounts override earlier ones at same destination
+        spec = _mount_spec(mount, mount_path)
+        specs[spec['destination']] = spec
 
-    return ensure_dirs(mount_dirs, uid=ouid, gid=ogid)
+    if rundir_data:
+        for mount in rundir_data['mounts']:
+            spec = _mount_spec(mount, resolve(mount))
+            specs[spec['destination']] = spec
+
+    return {
+        'specs': specs,
+        'dirs': [ (p, m) for p, m in dirs.items() if m is not None ],
+        'seeds': seeds,
+        'missing': missing,
+    }
+
+def _update_mounts(mounts, plan):
+    mount_map = { m['destination']: m for m in mounts }
+    mount_map.update(plan['specs'])
+
+    return list(mount_map.values())
+
+def _ensure_mounts(plan, ouid=None, ogid=None, rootfs=None, ids=None):
+    if plan['missing']:
+        missing = ', '.join(f'"{p}"' for p in plan['missing'])
+        raise ValueError(f'Bind mount(s) {missing} must exist')
+
+    created = ensure_dirs(plan['dirs'], uid=ouid, gid=ogid)
+    # Image contents hidden by seeded volumes copied in, first time only
+    if rootfs is not None:
+        for volume_path, (target, marker_path) in plan['seeds'].items():
+            seed_volume(volume_path, marker_path, rootfs, target, ids=ids)
+    return created
+
+def _seed_ids(linux):
+    # Seeded files need the host IDs showing as the image's in the
+    # container; only root can set those, else they're left owned by
+    # us, as a rootless unpack's are
+    if not probably_root():
+        return None
+    if linux.get('uidMappings') and linux.get('gidMappings'):
+        return IdShifter(linux['uidMappings'], linux['gidMappings'])
+    return lambda uid, gid: (uid, gid)
 
 def _update_id_maps(id_maps, container_id, host_id):
     new_maps = []
@@ -153,11 +342,73 @@ def _update_id_maps(id_maps, container_id, host_id):
 
     return new_maps
 
+def _file_digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).digest()
+    except FileNotFoundError:
+        return None
+
+def dump_spec(spec, pretty=False):
+    if pretty:
+        return json.dumps(spec, indent='\t')
+    return json.dumps(spec, separators=(',', ':'))
+
+def write_spec(spec, spec_path, pretty=False):
+    # Skipped if unchanged; returns True if written
+    data = dump_spec(spec, pretty=pretty).encode()
+    if _file_digest(spec_path) == hashlib.sha256(data).digest():
+        return False
+    write_atomic(spec_path, data)
+    return True
+
+def process_template(spec):
+    # Copy of process section, to save re-reading the spec file
+    return json.loads(json.dumps(spec['process']))
+
+def exec_process(template, args, env=None, cwd=None, terminal=False,
+                 user=None):
+    # Only changed top-level keys are copied, leaving template as is
+    proc = dict(template)
+    proc['args'] = _split_args(args)
+    if not proc['args']:
+        raise ValueError('Exec requires a command')
+    proc['terminal'] = bool(terminal)
+    if env:
+        # Same 'NAME=value' (or 'NAME' to unset) form as env.vars
+        proc['env'] = _update_environment(
+            template.get('env', []), {'vars': env, 'host': []}
+        )
+    if cwd:
+        proc['cwd'] = cwd
+    if user is not None:
+        uid, gid = user
+        proc['user'] = { **template.get('user', {}), 'uid': uid, 'gid': gid }
+    # Console size only applies to the container's own process
+    proc.pop('consoleSize', None)
+    return proc
+
 def update_spec_file(config, rundir, ouid=None, ogid=None,
-                     allow_tty=None, force_tty=None, ensure_mounts=True):
+                     allow_tty=None, force_tty=None, ensure_mounts=True,
+                     pretty=False, cpuset=None, context=None):
+    spec = build_spec(
+        config, rundir, ouid=ouid, ogid=ogid, allow_tty=allow_tty,
+        force_tty=force_tty, ensure_mounts=ensure_mounts, cpuset=cpuset,
+        context=context,
+    )
+    spec_path = spec_file_path(config)
+    write_spec(spec, spec_path, pretty=pretty)
+    return spec_path
+
+def spec_file_path(config):
+    return Path(config.data['storage']['base']) / 'config.json'
+
+def build_spec(config, rundir, ouid=None, ogid=None, allow_tty=None,
+               force_tty=None, ensure_mounts=True, cpuset=None,
+               context=None):
     assert allow_tty is None or force_tty is None
     # Get config file
-    spec_path = Path(config.data['storage']['base']) / 'config.json'
+    spec_path = spec_file_path(config)
     orig_path = Path(config.data['storage']['base']) / 'config.orig.json'
     try:
         # If original/backup present, prefer as clean version
@@ -166,7 +417,7 @@ def update_spec_file(config, rundir, ouid=None, ogid=None,
         # No backup, so assume config is fresh
         spec_str = spec_path.read_text()
         # Write backup
-        orig_path.write_text(spec_str)
+        write_atomic(orig_path, spec_str)
 
     spec = json.loads(spec_str)
 
@@ -205,36 +456,62 @@ def update_spec_file(config, rundir, ouid=None, ogid=None,
             proc['capabilities'], config.data['caps']
         )
 
-    # TODO: rlimits
+    # Resource limits, falling back to context's defaults
+    res_config = config.data.get('resources', {})
+    if hasattr(context, 'data'):
+        res_config = _merge_resources(
+            context.data.get('resources', {}), res_config
+        )
+    if res_config.get('rlimits'):
+        proc['rlimits'] = _update_rlimits(
+            proc.get('rlimits', []), res_config['rlimits']
+        )
+    linux = spec['linux']
+    resources = _update_resources(linux.get('resources', {}), res_config)
+    # Pinned CPUs/memory nodes, as allocated by executor
+    if cpuset:
+        cpu = resources.setdefault('cpu', {})
+        cpu['cpus'], cpu['mems'] = cpuset
+    if resources:
+        linux['resources'] = resources
 
     # Update environment
-    proc['env'] = _update_environment(proc['env'], config.data['env'])
+    proc['env'] = _update_environment(
+        proc['env'], config.data['env'],
+        base_path=Path(config.path).parent if config.path else None,
+    )
 
     # Update mounts
-    spec['mounts'] = _update_mounts(
-        spec['mounts'], config.data['volumes'],
-        rundir.data if rundir else None
+    plan = mount_plan(config.data['volumes'], rundir.data if rundir else None)
+    spec['mounts'] = _update_mounts(spec['mounts'], plan)
+
+    # Full subordinate ID mappings, if configured
+    id_maps = container_id_maps(
+        config,
+        os.geteuid() if ouid is None else ouid,
+        os.getegid() if ogid is None else ogid,
     )
-    if ensure_mounts:
-        _ensure_mounts(
-            config.data['volumes'],
-            rundir.data if rundir else None,
-            ouid=ouid, ogid=ogid
-        )
-
-    # Update rootless mapped uid/gid
-    # TODO: additional mappings
-    linux = spec['linux']
-    if ouid is not None:
+    if id_maps:
+        linux['uidMappings'], linux['gidMappings'] = id_maps
+        namespaces = linux.setdefault('namespaces', [])
+        if not any(ns.get('type') == 'user' for ns in namespaces):
+            namespaces.append({'type': 'user'})
+    # Otherwise just update rootless mapped uid/gid
+    elif ouid is not None:
         linux['uidMappings'] = _update_id_maps(
             linux['uidMappings'], config.data['user']['uid'], ouid
         )
-    if ogid is not None:
+    if ogid is not None and not id_maps:
         linux['gidMappings'] = _update_id_maps(
             linux['gidMappings'], config.data['user']['gid'], ogid
         )
 
-    # Write updated file
-    spec_path.write_text(json.dumps(spec, indent='\t'))
+    # Once mappings are final, for seeded volumes' ownership
+    if ensure_mounts:
+        _ensure_mounts(
+            plan, ouid=ouid, ogid=ogid,
+            rootfs=Path(config.data['storage']['base']) / 'rootfs',
+            ids=_seed_ids(linux) if plan['seeds'] else None,
+        )
 
-    return spec_path
+    return spec
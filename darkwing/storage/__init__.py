@@ -1 +1 @@
-from . import fs
+from . import fs, idmap, seed
@@ -1,10 +1,10 @@
 import os
 import sys
-import shutil
 import subprocess
 from pathlib import Path
 
-from darkwing.utils import probably_root, simple_command
+from darkwing.utils import probably_root, simple_command, get_host_info
+from .trash import trash_dir, move_to_trash, recover_trash
 
 def fetch_image():
     raise NotImplementedError
@@ -13,6 +13,8 @@ def unpack_image(config, rootless=None, write_output=True,
                  refresh_rootfs=False, refresh_config=False):
     if rootless is None:
         rootless = not probably_root()
+    if not get_host_info().has_tool('umoci'):
+        raise FileNotFoundError('umoci not found in PATH')
 
     unpack_cmd = [ 'umoci', 'raw', 'unpack' ]
     config_cmd = [ 'umoci', 'raw', 'config' ]
@@ -38,6 +40,9 @@ def unpack_image(config, rootless=None, write_output=True,
     config_cmd.append(f"--rootfs={rootfs_path}")
     config_cmd.append(str(config_path))
 
+    # Finish off any removals interrupted by an earlier crash
+    recover_trash(trash_dir(config))
+
     # Clear out existing rootfs (or bail)
     do_unpack = True
     try:
@@ -54,7 +59,8 @@ def unpack_image(config, rootless=None, write_output=True,
         elif file_list:
             if write_output:
                 print(f"Removing existing rootfs at {rootfs_path}", flush=True)
-            shutil.rmtree(rootfs_path)
+            # Removed in background, so unpacking can start at once
+            move_to_trash(rootfs_path, trash_dir(config))
             rootfs_path.mkdir(mode=0o770)
 
     if do_unpack:
@@ -0,0 +1,290 @@
+import os
+import stat
+import time
+import queue
+import threading
+import toml
+from pathlib import Path
+
+from darkwing.utils import FileLock, is_locked
+from darkwing.utils.subids import release_container_ids
+from .trash import TRASH_DIR, DEFAULT_WORKERS, move_to_trash
+
+
+# Disk usage of one tree, as du counts it (hardlinks once per scan);
+# refs are configs referring to it, as 'context/name'
+class Usage(object):
+
+    __slots__ = (
+        'kind', 'name', 'path', 'refs', 'bytes', 'apparent', 'files',
+        'dirs', 'mtime',
+    )
+
+    def __init__(self, kind, name, path, refs=()):
+        self.kind = kind
+        self.name = name
+        self.path = Path(path)
+        self.refs = list(refs)
+        self.bytes = 0
+        self.apparent = 0
+        self.files = 0
+        self.dirs = 0
+        self.mtime = 0
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} {self.kind}={self.name!r} "
+            f"bytes={self.bytes} refs={len(self.refs)}>"
+        )
+
+    @property
+    def referenced(self):
+        return bool(self.refs)
+
+    def as_dict(self):
+        return {
+            'kind': self.kind,
+            'name': self.name,
+            'path': str(self.path),
+            'refs': self.refs,
+            'bytes': self.bytes,
+            'apparent': self.apparent,
+            'files': self.files,
+            'dirs': self.dirs,
+            'mtime': self.mtime,
+        }
+
+def _load_tomls(dir_path):
+    # Each file read exactly once; unreadable/invalid ones skipped
+    loaded = {}
+    try:
+        it = os.scandir(dir_path)
+    except FileNotFoundError:
+        return loaded
+    with it:
+        for entry in it:
+            if not entry.name.endswith('.toml') or not entry.is_file():
+                continue
+            try:
+                loaded[entry.name[:-5]] = toml.load(entry.path)
+            except (OSError, toml.TomlDecodeError):
+                continue
+    return loaded
+
+def scan_configs(context):
+    # Including other contexts sharing its images dir, as
+    # {context name: {container name: config data}}
+    images = context.data['storage']['images']
+    contexts = {context.name: context.data}
+    for name, data in _load_tomls(Path(context.path).parent).items():
+        if name == context.name:
+            continue
+        if data.get('storage', {}).get('images') == images:
+            contexts[name] = data
+
+    return {
+        name: _load_tomls(data['configs']['base'])
+        for name, data in contexts.items()
+        if data.get('configs', {}).get('base')
+    }
+
+def _scan_dir(path, usage, seen, lock):
+    # Accounts path's entries, returning its subdirectories
+    subdirs = []
+    total = apparent = files = dirs = 0
+    mtime = 0
+    try:
+        it = os.scandir(path)
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return subdirs
+    with it:
+        for entry in it:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                subdirs.append(entry.path)
+                dirs += 1
+            else:
+                files += 1
+                if st.st_nlink > 1:
+                    key = (st.st_dev, st.st_ino)
+                    with lock:
+                        if key in seen:
+                            continue
+                        seen.add(key)
+            total += st.st_blocks * 512
+            apparent += st.st_size
+            mtime = max(mtime, st.st_mtime)
+
+    with lock:
+        usage.bytes += total
+        usage.apparent += apparent
+        usage.files += files
+        usage.dirs += dirs
+        usage.mtime = max(usage.mtime, mtime)
+    return subdirs
+
+def measure_usage(usages, workers=None):
+    # All trees at once, with worker threads
+    if workers is None:
+        workers = DEFAULT_WORKERS
+    seen = set()
+    lock = threading.Lock()
+    pending = queue.Queue()
+
+    def work():
+        while True:
+            item = pending.get()
+            try:
+                if item is None:
+                    return
+                path, usage = item
+                for subdir in _scan_dir(path, usage, seen, lock):
+                    pending.put((subdir, usage))
+            finally:
+                pending.task_done()
+
+    for usage in usages:
+        try:
+            st = os.stat(usage.path, follow_symlinks=False)
+        except FileNotFoundError:
+            continue
+        usage.mtime = st.st_mtime
+        if stat.S_ISDIR(st.st_mode):
+            usage.dirs += 1
+            pending.put((str(usage.path), usage))
+
+    threads = [
+        threading.Thread(name=f'gc-scan-{n}', target=work, daemon=True)
+        for n in range(max(1, workers))
+    ]
+    for t in threads:
+        t.start()
+    pending.join()
+    for t in threads:
+        pending.put(None)
+    for t in threads:
+        t.join()
+    return usages
+
+def _subdirs(path, skip=()):
+    try:
+        with os.scandir(path) as it:
+            return sorted(
+                entry.name for entry in it
+                if entry.is_dir(follow_symlinks=False)
+                and entry.name not in skip
+            )
+    except FileNotFoundError:
+        return []
+
+def df(context, configs=None, workers=None):
+    # Images, container storage dirs and trash; pass configs from
+    # scan_configs() to skip reloading them
+    if configs is None:
+        configs = scan_configs(context)
+
+    storage = context.data['storage']
+    images_base = Path(storage['images']) / 'oci'
+    containers_base = Path(storage['containers'])
+
+    # Image path -> refs, and this context's container storage dirs
+    image_refs = {}
+    storage_refs = {}
+    for ctx_name, ctx_configs in configs.items():
+        for name, data in ctx_configs.items():
+            ref = f'{ctx_name}/{name}'
+            image = data.get('image', {}).get('path')
+            if image:
+                image_refs.setdefault(Path(image), []).append(ref)
+            base = data.get('storage', {}).get('base')
+            if base and ctx_name == context.name:
+                storage_refs.setdefault(Path(base), []).append(ref)
+
+    usages = []
+    for name in _subdirs(images_base):
+        path = images_base / name
+        usages.append(Usage('image', name, path, image_refs.get(path, ())))
+    for name in _subdirs(containers_base, skip=(TRASH_DIR,)):
+        path = containers_base / name
+        usages.append(
+            Usage('container', name, path, storage_refs.get(path, ()))
+        )
+    trash_path = context_trash(context)
+    if trash_path.is_dir():
+        usages.append(Usage('trash', TRASH_DIR, trash_path))
+
+    return measure_usage(usages, workers=workers)
+
+def context_trash(context):
+    return Path(context.data['storage']['containers']) / TRASH_DIR
+
+def gc_policy(context, **overrides):
+    # Context's gc table (see config.defaults), with any overrides
+    policy = dict(context.data.get('gc', {}))
+    policy.update(overrides)
+    return policy
+
+def gc(context, policy=None, dry_run=False, workers=None):
+    # Unreferenced images/storage dirs to the trash, per policy (default
+    # the context's gc table); returns Usages removed, or would be
+    if policy is None:
+        policy = gc_policy(context)
+    cutoff = time.time() - float(policy.get('min_age', 3600.0))
+    trash_path = context_trash(context)
+
+    removed = []
+    for usage in df(context, workers=workers):
+        if usage.referenced or usage.mtime > cutoff:
+            continue
+        lock = None
+        if usage.kind == 'image' and policy.get('images', False):
+            targets = [usage.path]
+        elif usage.kind == 'container' and policy.get('containers', True):
+            # Held across the moves, so nothing can start using it
+            # between our check and the move; a dry run just checks
+            lock_path = usage.path / 'darkwing.lock'
+            if dry_run:
+                if is_locked(lock_path):
+                    continue
+            else:
+                lock = FileLock(lock_path, mode=0o660)
+                if not lock.acquire(blocking=False):
+                    continue
+            if policy.get('volumes', False):
+                targets = [usage.path]
+            else:
+                targets = [
+                    usage.path / name
+                    for name in os.listdir(usage.path)
+                    if name not in ('volumes', lock_path.name)
+                ]
+        else:
+            continue
+
+        try:
+            if not targets:
+                # Only kept volumes left from an earlier gc
+                continue
+            if not dry_run:
+                for target in targets:
+                    move_to_trash(target, trash_path)
+                if usage.kind == 'container':
+                    release_container_ids(usage.name, usage.path.parent)
+            removed.append(usage)
+        finally:
+            if lock is not None:
+                # Gone with the dir already if volumes went too
+                lock.release(unlink=True)
+
+        # Leave just the volumes behind
+        if (not dry_run and usage.kind == 'container' and
+                not policy.get('volumes', False)):
+            try:
+                usage.path.rmdir()
+            except OSError:
+                pass
+
+    return removed
@@ -0,0 +1,182 @@
+import os
+import json
+import errno
+import hashlib
+from pathlib import Path
+
+from darkwing.utils import probably_root, get_host_info, FileLock
+from darkwing.utils.syscalls import (
+    CLONE_NEWUSER, OPEN_TREE_CLONE, AT_RECURSIVE,
+    open_tree, mount_setattr_idmap, move_mount, umount, unshare,
+)
+from .trash import move_to_trash, trash_dir
+from .seed import copy_tree
+
+# Idmapped mount point, in container's rundir
+IDMAP_ROOTFS = 'rootfs'
+# Shifted copies, in container's storage dir
+SHIFTED_DIR = '.shifted'
+
+SHIFT_MODES = ('auto', 'idmap', 'copy')
+
+# Owner for IDs outside the mappings, as the kernel shows them
+OVERFLOW_ID = 65534
+
+def _format_maps(maps):
+    return ''.join(
+        f"{m['containerID']} {m['hostID']} {m['size']}\n" for m in maps
+    )
+
+def userns_fd(uid_maps, gid_maps):
+    # For MOUNT_ATTR_IDMAP, in a new otherwise unused user namespace
+    ready_r, ready_w = os.pipe()
+    done_r, done_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # Child just holds the namespace open until we're done
+        code = 1
+        try:
+            os.close(ready_r)
+            os.close(done_w)
+            unshare(CLONE_NEWUSER)
+            os.write(ready_w, b'1')
+            os.read(done_r, 1)
+            code = 0
+        finally:
+            os._exit(code)
+
+    os.close(ready_w)
+    os.close(done_r)
+    try:
+        if os.read(ready_r, 1) != b'1':
+            raise OSError(errno.EPERM, 'Failed to create user namespace')
+        proc = Path('/proc', str(pid))
+        (proc / 'uid_map').write_text(_format_maps(uid_maps))
+        (proc / 'gid_map').write_text(_format_maps(gid_maps))
+        return os.open(proc / 'ns' / 'user', os.O_RDONLY | os.O_CLOEXEC)
+    finally:
+        os.close(ready_r)
+        os.close(done_w)
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            # Reaped by executor's signal loop instead
+            pass
+
+def mount_idmapped(source, target, uid_maps, gid_maps):
+    # Recursive bind with ownership shifted, no files touched
+    ns_fd = userns_fd(uid_maps, gid_maps)
+    try:
+        tree_fd = open_tree(source, OPEN_TREE_CLONE | AT_RECURSIVE)
+        try:
+            mount_setattr_idmap(tree_fd, ns_fd)
+            Path(target).mkdir(mode=0o755, exist_ok=True)
+            move_mount(tree_fd, target)
+        finally:
+            os.close(tree_fd)
+    finally:
+        os.close(ns_fd)
+
+def release_rootfs(rundir_path):
+    # Before rundir removal, so that can't reach the real rootfs
+    target = Path(rundir_path) / IDMAP_ROOTFS
+    # Not ismount(), which misses binds within the same filesystem
+    try:
+        umount(target)
+    except OSError as e:
+        if e.errno in (errno.EINVAL, errno.ENOENT):
+            return False
+        raise
+    try:
+        target.rmdir()
+    except OSError:
+        pass
+    return True
+
+
+# Maps (uid, gid) as the kernel would, unmapped to the overflow ID
+class IdShifter(object):
+
+    def __init__(self, uid_maps, gid_maps):
+        self._maps = {'uid': uid_maps, 'gid': gid_maps}
+        self._cache = {'uid': {}, 'gid': {}}
+
+    def __call__(self, uid, gid):
+        return self.shift('uid', uid), self.shift('gid', gid)
+
+    def shift(self, kind, id_):
+        cache = self._cache[kind]
+        try:
+            return cache[id_]
+        except KeyError:
+            pass
+        shifted = OVERFLOW_ID
+        for m in self._maps[kind]:
+            offset = id_ - m['containerID']
+            if 0 <= offset < m['size']:
+                shifted = m['hostID'] + offset
+                break
+        cache[id_] = shifted
+        return shifted
+
+def shifted_key(source, uid_maps, gid_maps):
+    # Unpacking a new rootfs gives it a new inode, invalidating copies
+    st = os.stat(source)
+    data = json.dumps([st.st_dev, st.st_ino, uid_maps, gid_maps])
+    return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+def shifted_rootfs(config, source, uid_maps, gid_maps):
+    # Made once per mapping and reused; other mappings' copies trashed
+    base = Path(config.data['storage']['base']) / SHIFTED_DIR
+    base.mkdir(mode=0o700, exist_ok=True)
+    key = shifted_key(source, uid_maps, gid_maps)
+    path = base / key
+
+    with FileLock(base / '.lock'):
+        if not path.exists():
+            tmp_path = base / f'{key}.tmp.{os.getpid()}'
+            if tmp_path.exists():
+                move_to_trash(tmp_path, trash_dir(config))
+            copy_tree(source, tmp_path, ids=IdShifter(uid_maps, gid_maps))
+            os.rename(tmp_path, path)
+        # Anything else (including partial copies by crashed processes,
+        # as copying holds the lock) is stale
+        for entry in os.listdir(base):
+            if entry not in (key, '.lock'):
+                move_to_trash(base / entry, trash_dir(config))
+    return path
+
+def prepare_rootfs(config, oci_spec, rundir):
+    # Idmapped mount in rundir if allowed, else a shifted copy; returns
+    # 'idmap', 'copy', or None if left as is (eg. rootless)
+    user = config.data['user']
+    if user.get('mapping', 'single') == 'single' or not probably_root():
+        return None
+    linux = oci_spec.get('linux', {})
+    uid_maps = linux.get('uidMappings')
+    gid_maps = linux.get('gidMappings')
+    if not uid_maps or not gid_maps:
+        return None
+    mode = user.get('shift', 'auto')
+    if mode not in SHIFT_MODES:
+        raise ValueError(f'Invalid shift mode: {mode!r}')
+
+    source = Path(config.data['storage']['base']) / 'rootfs'
+    if mode != 'copy' and rundir and get_host_info().idmapped_mounts:
+        target = Path(rundir.path) / IDMAP_ROOTFS
+        try:
+            release_rootfs(rundir.path)
+            mount_idmapped(source, target, uid_maps, gid_maps)
+        except OSError:
+            # Eg. filesystem without idmap support
+            if mode == 'idmap':
+                raise
+        else:
+            oci_spec['root']['path'] = str(target)
+            return 'idmap'
+    if mode == 'idmap':
+        raise OSError(errno.ENOSYS, 'Idmapped mounts not supported')
+
+    path = shifted_rootfs(config, source, uid_maps, gid_maps)
+    oci_spec['root']['path'] = str(path)
+    return 'copy'
@@ -0,0 +1,231 @@
+import os
+import stat
+import json
+import time
+import errno
+import queue
+import threading
+from pathlib import Path
+from urllib.parse import quote
+
+from darkwing.utils import FileLock, write_atomic, copy_fd
+from .trash import DEFAULT_WORKERS, remove_tree
+
+# Markers of seeded volumes, in each volume base dir
+SEEDED_DIR = '.seeded'
+SEEDED_LOCK = '.lock'
+
+# As many as the kernel follows resolving a path
+MAX_SYMLINKS = 40
+
+# Xattrs skipped (rather than failing the copy) if refused by either fs
+_XATTR_ERRNOS = (errno.ENOTSUP, errno.EOPNOTSUPP, errno.EPERM)
+
+def _copy_xattrs(src_path, dst_path):
+    try:
+        names = os.listxattr(src_path, follow_symlinks=False)
+    except OSError as e:
+        if e.errno in _XATTR_ERRNOS:
+            return
+        raise
+    for name in names:
+        try:
+            value = os.getxattr(src_path, name, follow_symlinks=False)
+            os.setxattr(dst_path, name, value, follow_symlinks=False)
+        except OSError as e:
+            # Eg. trusted.* when unprivileged, or raced away
+            if e.errno not in _XATTR_ERRNOS + (errno.ENODATA,):
+                raise
+
+_READ_FLAGS = os.O_RDONLY | os.O_NOFOLLOW | os.O_CLOEXEC
+_WRITE_FLAGS = (
+    os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW | os.O_CLOEXEC
+)
+
+
+def copy_tree(src, dst, ids=None, workers=None, reflink=True, root=True):
+    # Keeps links, special files, modes, times, xattrs (if allowed) and
+    # any ownership ids maps; files copied (reflinked if possible) by
+    # workers. With root=False, dst exists and keeps its own
+    if workers is None:
+        workers = DEFAULT_WORKERS
+    pending = queue.SimpleQueue()
+    errors = []
+    lock = threading.Lock()
+    # Hardlinked files' first copies, and further links to them
+    linked = {}
+    links = []
+    # Directory metadata set last, as filling them changes it
+    dirs = []
+
+    def apply(path, src_path, st, is_link=False):
+        if ids is not None:
+            uid, gid = ids(st.st_uid, st.st_gid)
+            os.chown(path, uid, gid, follow_symlinks=False)
+        # After chown, which clears setuid/setgid bits and capabilities
+        if not is_link:
+            os.chmod(path, stat.S_IMODE(st.st_mode))
+        _copy_xattrs(src_path, path)
+        os.utime(
+            path, ns=(st.st_atime_ns, st.st_mtime_ns),
+            follow_symlinks=not is_link,
+        )
+
+    def copy_file(src_path, dst_path, st):
+        src_fd = os.open(src_path, _READ_FLAGS)
+        try:
+            dst_fd = os.open(dst_path, _WRITE_FLAGS, 0o600)
+            try:
+                copy_fd(src_fd, dst_fd, reflink=reflink)
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+        apply(dst_path, src_path, st)
+
+    def work():
+        while True:
+            job = pending.get()
+            if job is None:
+                return
+            if errors:
+                # Just draining the queue
+                continue
+            try:
+                copy_file(*job)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+
+    def walk(src_dir, dst_dir):
+        with os.scandir(src_dir) as it:
+            entries = list(it)
+        for entry in entries:
+            if errors:
+                return
+            st = entry.stat(follow_symlinks=False)
+            target = os.path.join(dst_dir, entry.name)
+            mode = st.st_mode
+            if stat.S_ISDIR(mode):
+                os.mkdir(target, 0o700)
+                walk(entry.path, target)
+                dirs.append((target, entry.path, st))
+                continue
+            if st.st_nlink > 1:
+                key = (st.st_dev, st.st_ino)
+                if key in linked:
+                    links.append((linked[key], target))
+                    continue
+                linked[key] = target
+            if stat.S_ISREG(mode):
+                pending.put((entry.path, target, st))
+            elif stat.S_ISLNK(mode):
+                os.symlink(os.readlink(entry.path), target)
+                apply(target, entry.path, st, is_link=True)
+            else:
+                try:
+                    os.mknod(target, mode, st.st_rdev)
+                except PermissionError:
+                    # Eg. device nodes, unless root
+                    linked.pop((st.st_dev, st.st_ino), None)
+                    continue
+                apply(target, entry.path, st)
+
+    if root:
+        os.mkdir(dst, 0o700)
+    threads = [
+        threading.Thread(name=f'copy-{n}', target=work, daemon=True)
+        for n in range(max(1, workers))
+    ]
+    for t in threads:
+        t.start()
+    try:
+        walk(str(src), str(dst))
+    finally:
+        for t in threads:
+            pending.put(None)
+        for t in threads:
+            t.join()
+    if errors:
+        raise errors[0]
+
+    for existing, target in links:
+        os.link(existing, target, follow_symlinks=False)
+    # Deepest first
+    for dir_path, src_path, st in dirs:
+        apply(dir_path, src_path, st)
+    if root:
+        apply(dst, src, os.stat(src, follow_symlinks=False))
+
+def rootfs_path(rootfs, path):
+    # Following symlinks without escaping rootfs; need not exist
+    rootfs = Path(rootfs)
+    parts = [ p for p in reversed(Path(path).parts) if p not in ('/', '.') ]
+    resolved = []
+    follows = 0
+    while parts:
+        part = parts.pop()
+        if part == '..':
+            if resolved:
+                resolved.pop()
+            continue
+        current = rootfs.joinpath(*resolved, part)
+        try:
+            is_link = stat.S_ISLNK(os.lstat(current).st_mode)
+        except (FileNotFoundError, NotADirectoryError):
+            is_link = False
+        if not is_link:
+            resolved.append(part)
+            continue
+        follows += 1
+        if follows > MAX_SYMLINKS:
+            raise OSError(errno.ELOOP, os.strerror(errno.ELOOP), str(path))
+        link = os.readlink(current)
+        if link.startswith('/'):
+            resolved = []
+        parts.extend(
+            p for p in reversed(link.split('/')) if p not in ('', '.')
+        )
+    return rootfs.joinpath(*resolved)
+
+def seed_marker(base, volume_path):
+    # One flat dir per volume base, so markers never show in volumes
+    name = quote(str(Path(volume_path).relative_to(base)), safe='')
+    return Path(base) / SEEDED_DIR / name
+
+def _is_empty(path):
+    with os.scandir(path) as it:
+        return next(it, None) is None
+
+def seed_volume(volume_path, marker_path, rootfs, target, ids=None,
+                workers=None):
+    # Once only, recorded at marker_path; volumes with data are just
+    # marked. Returns True if anything was copied
+    marker_path = Path(marker_path)
+    if marker_path.exists():
+        return False
+    marker_path.parent.mkdir(mode=0o750, exist_ok=True)
+
+    with FileLock(marker_path.parent / SEEDED_LOCK):
+        # Another container may have seeded it meanwhile
+        if marker_path.exists():
+            return False
+        source = rootfs_path(rootfs, target)
+        copied = source.is_dir() and _is_empty(volume_path)
+        if copied:
+            try:
+                copy_tree(
+                    source, volume_path, ids=ids, workers=workers,
+                    root=False,
+                )
+            except BaseException:
+                # Leave empty, so seeding is tried again next time
+                for name in os.listdir(volume_path):
+                    remove_tree(Path(volume_path) / name)
+                raise
+        write_atomic(marker_path, json.dumps({
+            'target': target,
+            'copied': copied,
+            'seeded_at': time.time(),
+        }), mode=0o640)
+    return copied
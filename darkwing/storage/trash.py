@@ -0,0 +1,238 @@
+import os
+import sys
+import stat
+import time
+import queue
+import errno
+import threading
+import traceback
+import itertools
+from pathlib import Path
+
+from darkwing.utils import FileLock
+
+TRASH_DIR = '.trash'
+TRASH_LOCK = '.lock'
+
+# Worker threads per tree removal
+DEFAULT_WORKERS = min(8, os.cpu_count() or 1)
+
+_DIR_FLAGS = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC
+
+_names = itertools.count()
+
+def trash_dir(config):
+    # Storage table's 'trash', else '.trash' alongside the storage dir
+    # (shared by the context, on the same fs)
+    storage = config.data['storage']
+    if storage.get('trash'):
+        return Path(storage['trash'])
+    return Path(storage['base']).parent / TRASH_DIR
+
+def _unlink_entries(path, dirs):
+    # Unlinks all non-directories in path relative to its fd,
+    # returning its subdirectories
+    try:
+        fd = os.open(path, _DIR_FLAGS)
+    except FileNotFoundError:
+        return []
+    except PermissionError:
+        # Eg. rootless unpack leaving read-only dirs; we own it though
+        os.chmod(path, stat.S_IRWXU, follow_symlinks=False)
+        fd = os.open(path, _DIR_FLAGS)
+
+    subdirs = []
+    try:
+        if not os.stat(fd).st_mode & stat.S_IWUSR:
+            os.fchmod(fd, stat.S_IRWXU)
+        with os.scandir(fd) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                if is_dir:
+                    subdirs.append(path / entry.name)
+                    continue
+                try:
+                    os.unlink(entry.name, dir_fd=fd)
+                except FileNotFoundError:
+                    pass
+    finally:
+        os.close(fd)
+    dirs.extend(subdirs)
+    return subdirs
+
+def remove_tree(path, workers=None):
+    # Like shutil.rmtree(), scanning and unlinking with worker threads
+    path = Path(path)
+    if workers is None:
+        workers = DEFAULT_WORKERS
+    try:
+        if not stat.S_ISDIR(os.lstat(path).st_mode):
+            os.unlink(path)
+            return
+    except FileNotFoundError:
+        return
+
+    dirs = [path]
+    pending = queue.Queue()
+    errors = []
+
+    def work():
+        while True:
+            dir_path = pending.get()
+            try:
+                if dir_path is None:
+                    return
+                for subdir in _unlink_entries(dir_path, dirs):
+                    pending.put(subdir)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                pending.task_done()
+
+    pending.put(path)
+    threads = [
+        threading.Thread(name=f'trash-rm-{n}', target=work, daemon=True)
+        for n in range(max(1, workers))
+    ]
+    for t in threads:
+        t.start()
+    # Queue only empties once no worker can add any more subdirs
+    pending.join()
+    for t in threads:
+        pending.put(None)
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+    dirs.sort(key=lambda p: len(p.parts), reverse=True)
+    for dir_path in dirs:
+        try:
+            os.rmdir(dir_path)
+        except FileNotFoundError:
+            pass
+
+def move_to_trash(path, trash_path, reap=True):
+    # Returns new path (None if missing); removes in place if trash is
+    # on another fs
+    path = Path(path)
+    trash_path = Path(trash_path)
+    trash_path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    # Unique across processes and repeated calls
+    name = f'{path.name}.{time.time_ns()}.{os.getpid()}.{next(_names)}'
+    target = trash_path / name
+    try:
+        os.rename(path, target)
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        remove_tree(path)
+        return None
+
+    if reap:
+        get_reaper(trash_path).wake()
+    return target
+
+
+# Empties a trash dir in the background, crash leftovers included;
+# one process at a time per dir, under its lock file
+class TrashReaper(object):
+
+    def __init__(self, path, workers=None):
+        self.path = Path(path)
+        self.workers = workers
+        self.removed = 0
+        self._lock = FileLock(self.path / TRASH_LOCK, mode=0o600)
+        self._wakeup = threading.Event()
+        self._idle = threading.Event()
+        self._thread = None
+        self._recovered = False
+        self._start_lock = threading.Lock()
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} path={str(self.path)!r} "
+            f"removed={self.removed}>"
+        )
+
+    def _entries(self):
+        try:
+            with os.scandir(self.path) as it:
+                return [
+                    Path(entry.path) for entry in it
+                    if entry.name != TRASH_LOCK
+                ]
+        except FileNotFoundError:
+            return []
+
+    def _reap(self):
+        for entry in self._entries():
+            try:
+                remove_tree(entry, workers=self.workers)
+                self.removed += 1
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                # Waits out any other process's pass, in case it
+                # finished scanning before our entries arrived
+                with self._lock:
+                    self._reap()
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+            # Set only once nothing more has been queued meanwhile
+            with self._start_lock:
+                if not self._wakeup.is_set():
+                    self._idle.set()
+
+    def wake(self):
+        with self._start_lock:
+            self._idle.clear()
+            self._wakeup.set()
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    name='trash-reaper', target=self._run, daemon=True,
+                )
+                self._thread.start()
+        return self
+
+    def recover(self):
+        # First time only; anything trashed since wakes it anyway
+        with self._start_lock:
+            if self._recovered:
+                return self
+            self._recovered = True
+        return self.wake()
+
+    def wait(self, timeout=None):
+        # False on timeout; leftovers at exit go on a later run
+        if self._thread is None:
+            return True
+        return self._idle.wait(timeout)
+
+_reapers = {}
+_reapers_lock = threading.Lock()
+
+def get_reaper(trash_path):
+    # One per trash dir per process
+    trash_path = Path(os.path.realpath(trash_path))
+    with _reapers_lock:
+        reaper = _reapers.get(trash_path)
+        if reaper is None:
+            reaper = _reapers[trash_path] = TrashReaper(trash_path)
+    return reaper
+
+def recover_trash(trash_path):
+    # Once per process, not on every unpack
+    if os.path.isdir(trash_path):
+        return get_reaper(trash_path).recover()
+    return None
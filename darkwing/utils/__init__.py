@@ -1,5 +1,11 @@
-from .files import ensure_dirs, ensure_files, get_runtime_path
-from .process import simple_command, compute_returncode
+from .files import (
+    ensure_paths, ensure_dirs, ensure_files, write_atomic, get_runtime_path,
+    copy_fd,
+)
+from .process import simple_command, compute_returncode, parse_signal
 from .syscalls import set_subreaper
 from .ttys import output_isatty, resize_tty, send_tty_eof
 from .users import probably_root, user_ids
+from .units import parse_size
+from .locks import FileLock, is_locked
+from .host import HostInfo, get_host_info
@@ -0,0 +1,109 @@
+import os
+import threading
+from pathlib import Path
+
+# Parsed env files, keyed by path, validated against stat() results
+_env_cache = {}
+_env_lock = threading.Lock()
+
+_ESCAPES = {
+    'n': '\n',
+    'r': '\r',
+    't': '\t',
+    '"': '"',
+    '\\': '\\',
+    '$': '$',
+}
+
+def _unescape(value):
+    out = []
+    chars = iter(value)
+    for c in chars:
+        if c == '\\':
+            nxt = next(chars, '')
+            out.append(_ESCAPES.get(nxt, '\\' + nxt))
+        else:
+            out.append(c)
+    return ''.join(out)
+
+def _closing_quote(value, quote):
+    # Index of value's closing quote, or -1; in double-quoted values,
+    # escape pairs are skipped whole, so '\\"' ends the value
+    if quote == "'":
+        return value.find(quote, 1)
+    pos = 1
+    while pos < len(value):
+        c = value[pos]
+        if c == '\\':
+            pos += 2
+            continue
+        if c == quote:
+            return pos
+        pos += 1
+    return -1
+
+def parse_env(text, source='<string>'):
+    # Dotenv-style: 'export ' prefix, single (literal) or double
+    # (escaped) quotes, trailing comments; later duplicates win
+    env_vars = {}
+
+    for lineno, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('export '):
+            line = line[7:].lstrip()
+
+        name, sep, value = line.partition('=')
+        name = name.strip()
+        if not sep or not name or any(c.isspace() for c in name):
+            raise ValueError(f'Invalid env line {lineno} in {source}')
+
+        value = value.strip()
+        if value[:1] in ('"', "'"):
+            quote = value[0]
+            end = _closing_quote(value, quote)
+            if end < 0:
+                raise ValueError(
+                    f'Unterminated quote on env line {lineno} in {source}'
+                )
+            # Nothing but a comment may follow the closing quote
+            rest = value[end + 1:].strip()
+            if rest and not rest.startswith('#'):
+                raise ValueError(
+                    f'Unexpected text after quote on env line {lineno} '
+                    f'in {source}'
+                )
+            value = value[1:end]
+            if quote == '"':
+                value = _unescape(value)
+        else:
+            # Unquoted, so strip any trailing comment
+            value, _, _ = value.partition(' #')
+            value = value.rstrip()
+
+        env_vars[name] = value
+
+    return env_vars
+
+def read_env_file(path):
+    # Cached until mtime/size/inode changes, so callers mustn't modify
+    path = Path(path)
+    st = os.stat(path)
+    key = (st.st_mtime_ns, st.st_size, st.st_ino, st.st_dev)
+
+    with _env_lock:
+        cached = _env_cache.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    env_vars = parse_env(path.read_text(), source=str(path))
+
+    with _env_lock:
+        _env_cache[path] = (key, env_vars)
+
+    return env_vars
+
+def clear_env_cache():
+    with _env_lock:
+        _env_cache.clear()
@@ -1,47 +1,183 @@
 import os
+import errno
+import fcntl
+import threading
 from pathlib import Path
 
-def ensure_dirs(dirs, uid=None, gid=None):
-    do_chown = uid is not None or gid is not None
-    if do_chown:
-        # Leave unchanged if not given
-        if uid is None:
-            uid = -1
-        if gid is None:
-            gid = -1
+_DIR_FLAGS = os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC
+_FILE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW | os.O_CLOEXEC
+_TEMP_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW | os.O_CLOEXEC
+
+# ioctl() to share a file's extents (reflink), eg. on btrfs or xfs
+FICLONE = 0x40049409
+
+# Errors meaning a copy method isn't usable here, so try the next
+_FALLBACK_ERRNOS = (
+    errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY,
+)
+_COPY_CHUNK = 1 << 20
+
+def _chown_ids(uid, gid):
+    if uid is None and gid is None:
+        return None
+    # Leave unchanged if not given
+    return (-1 if uid is None else uid, -1 if gid is None else gid)
+
+# Open parent dir fds, so each is resolved once per batch
+class _DirFds(object):
+
+    def __init__(self):
+        self._fds = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, dir_path):
+        try:
+            return self._fds[dir_path]
+        except KeyError:
+            pass
+        try:
+            fd = os.open(dir_path, _DIR_FLAGS)
+        except FileNotFoundError:
+            # Missing intermediate dirs get default mode/ownership,
+            # same as mkdir(parents=True) would give them
+            os.makedirs(dir_path, exist_ok=True)
+            fd = os.open(dir_path, _DIR_FLAGS)
+        self._fds[dir_path] = fd
+        return fd
+
+    def close(self):
+        while self._fds:
+            _, fd = self._fds.popitem()
+            os.close(fd)
 
-    created = []
+def _make_dir(fds, path, mode, ids):
+    parent_fd = fds.get(path.parent)
+    try:
+        os.mkdir(path.name, mode, dir_fd=parent_fd)
+    except FileExistsError:
+        return False
+    if ids:
+        os.chown(
+            path.name, *ids, dir_fd=parent_fd, follow_symlinks=False
+        )
+    return True
 
-    for dir_path, dir_mode in dirs:
-        dir_path = Path(dir_path)
-        if not dir_path.exists():
-            dir_path.mkdir(mode=dir_mode, parents=True)
-            if do_chown:
-                os.chown(dir_path, uid, gid)
-            created.append(dir_path)
+def _make_file(fds, path, mode, ids):
+    parent_fd = fds.get(path.parent)
+    try:
+        fd = os.open(path.name, _FILE_FLAGS, mode, dir_fd=parent_fd)
+    except FileExistsError:
+        return False
+    try:
+        if ids:
+            os.fchown(fd, *ids)
+    finally:
+        os.close(fd)
+    return True
 
+def ensure_paths(dirs=(), files=(), uid=None, gid=None):
+    # Batched ensure_dirs()/ensure_files(), relative to shared parent fds;
+    # dirs first, so files may go in new ones
+    ids = _chown_ids(uid, gid)
+    created_dirs = []
+    created_files = []
+
+    with _DirFds() as fds:
+        for dir_path, dir_mode in dirs:
+            dir_path = Path(dir_path)
+            if _make_dir(fds, dir_path, dir_mode, ids):
+                created_dirs.append(dir_path)
+
+        for file_path, file_mode in files:
+            file_path = Path(file_path)
+            if _make_file(fds, file_path, file_mode, ids):
+                created_files.append(file_path)
+
+    return created_dirs, created_files
+
+def ensure_dirs(dirs, uid=None, gid=None):
+    created, _ = ensure_paths(dirs=dirs, uid=uid, gid=gid)
     return created
 
 def ensure_files(files, uid=None, gid=None):
-    do_chown = uid is not None or gid is not None
-    if do_chown:
-        # Leave unchanged if not given
-        if uid is None:
-            uid = -1
-        if gid is None:
-            gid = -1
+    _, created = ensure_paths(files=files, uid=uid, gid=gid)
+    return created
 
-    created = []
+def write_atomic(path, data, mode=0o644):
+    # Temp file renamed into place, keeping any existing mode
+    path = Path(path)
+    if isinstance(data, str):
+        data = data.encode()
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        pass
 
-    for file_path, file_mode in files:
-        file_path = Path(file_path)
-        if not file_path.exists():
-            file_path.touch(mode=file_mode, exist_ok=False)
-            if do_chown:
-                os.chown(file_path, uid, gid)
-            created.append(file_path)
+    # Unique per thread too, so concurrent writers can't share it
+    tmp_path = path.with_name(
+        f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp'
+    )
+    fd = os.open(tmp_path, _TEMP_FLAGS, mode)
+    try:
+        try:
+            os.fchmod(fd, mode)
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            tmp_path.unlink()
+        except FileNotFoundError:
+            pass
+        raise
 
-    return created
+    return path
+
+def copy_fd(src_fd, dst_fd, reflink=False):
+    # In-kernel where possible: reflink (if asked), copy_file_range(),
+    # sendfile(), then read()/write(); returns bytes copied
+    if reflink:
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            return os.fstat(dst_fd).st_size
+        except OSError as e:
+            if e.errno not in _FALLBACK_ERRNOS:
+                raise
+
+    copied = 0
+    for name in ('copy_file_range', 'sendfile'):
+        func = getattr(os, name, None)
+        if func is None:
+            continue
+        try:
+            while True:
+                if name == 'sendfile':
+                    count = func(dst_fd, src_fd, None, _COPY_CHUNK)
+                else:
+                    count = func(src_fd, dst_fd, _COPY_CHUNK)
+                if not count:
+                    return copied
+                copied += count
+        except OSError as e:
+            if copied or e.errno not in _FALLBACK_ERRNOS:
+                raise
+    while True:
+        chunk = os.read(src_fd, _COPY_CHUNK)
+        if not chunk:
+            return copied
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(dst_fd, view):]
+        copied += len(chunk)
 
 def get_runtime_path(uid=None):
     # Give priority to XDG_RUNTIME_DIR
@@ -0,0 +1,210 @@
+import os
+import re
+import json
+import shutil
+import subprocess
+from pathlib import Path
+
+from .files import get_runtime_path, write_atomic
+from .users import probably_root
+from .syscalls import SYS_mount_setattr, syscall_available
+
+HOST_CACHE = 'host.json'
+
+# Bump when probes change, to ignore older caches
+CACHE_VERSION = 1
+
+TOOLS = ('runc', 'umoci')
+
+_version_re = re.compile(r'version\s+v?(\S+)')
+
+
+# Tools are {name: {'path', 'version'}} or None if not found;
+# cgroup is 'v2', 'hybrid', 'v1' or None
+class HostInfo(object):
+
+    FIELDS = (
+        'boot_id', 'kernel', 'euid', 'root', 'userns', 'tools', 'cgroup',
+        'cgroup_controllers', 'overlay', 'idmapped_mounts', 'pidfd',
+        'splice', 'copy_file_range',
+    )
+
+    def __init__(self, **fields):
+        for name in self.FIELDS:
+            setattr(self, name, fields.get(name))
+
+    def __repr__(self):
+        tools = ' '.join(
+            f'{name}={(tool or {}).get("version")!r}'
+            for name, tool in (self.tools or {}).items()
+        )
+        return (
+            f"<{self.__class__.__name__} kernel={self.kernel!r} "
+            f"root={self.root} cgroup={self.cgroup!r} {tools}>"
+        )
+
+    @property
+    def rootless(self):
+        return not self.root
+
+    def has_tool(self, name):
+        return bool((self.tools or {}).get(name))
+
+    def tool_version(self, name):
+        return ((self.tools or {}).get(name) or {}).get('version')
+
+    def as_dict(self):
+        return { name: getattr(self, name) for name in self.FIELDS }
+
+def _read_text(path, default=None):
+    try:
+        return Path(path).read_text().strip()
+    except OSError:
+        return default
+
+def _in_userns():
+    try:
+        own = os.readlink('/proc/self/ns/user')
+        init = os.readlink('/proc/1/ns/user')
+    except OSError:
+        # Can't see PID 1's namespace, so not in it
+        return True
+    return own != init
+
+def _tool_fingerprints():
+    # Cheap (no exec) check that cached tool probes are still valid
+    prints = {}
+    for name in TOOLS:
+        path = shutil.which(name)
+        if path:
+            try:
+                st = os.stat(path)
+            except OSError:
+                path = None
+            else:
+                prints[name] = [path, st.st_mtime_ns, st.st_size]
+                continue
+        prints[name] = None
+    return prints
+
+def _probe_tool(path):
+    if not path:
+        return None
+    try:
+        proc = subprocess.run(
+            [path, '--version'], stdin=subprocess.DEVNULL,
+            capture_output=True, timeout=5,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    match = _version_re.search(proc.stdout.decode(errors='replace'))
+    return {'path': path, 'version': match.group(1) if match else None}
+
+def _probe_cgroup():
+    base = Path('/sys/fs/cgroup')
+    if (base / 'cgroup.controllers').exists():
+        controllers = _read_text(base / 'cgroup.controllers', '').split()
+        return 'v2', controllers
+    if (base / 'unified' / 'cgroup.controllers').exists():
+        return 'hybrid', sorted(os.listdir(base))
+    try:
+        controllers = sorted(
+            name for name in os.listdir(base)
+            if (base / name).is_dir() and name != 'unified'
+        )
+    except FileNotFoundError:
+        return None, []
+    return ('v1' if controllers else None), controllers
+
+def _probe_filesystems():
+    data = _read_text('/proc/filesystems', '')
+    return { line.split()[-1] for line in data.splitlines() if line.strip() }
+
+def _probe_pidfd():
+    if not hasattr(os, 'pidfd_open'):
+        return False
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except OSError:
+        return False
+    return True
+
+def probe_host(fingerprints=None):
+    # Runs each tool's --version once
+    if fingerprints is None:
+        fingerprints = _tool_fingerprints()
+    cgroup, controllers = _probe_cgroup()
+    return HostInfo(
+        boot_id=_read_text('/proc/sys/kernel/random/boot_id'),
+        kernel=os.uname().release,
+        euid=os.geteuid(),
+        root=probably_root(),
+        userns=_in_userns(),
+        tools={
+            name: _probe_tool(fp[0] if fp else None)
+            for name, fp in fingerprints.items()
+        },
+        cgroup=cgroup,
+        cgroup_controllers=controllers,
+        overlay='overlay' in _probe_filesystems(),
+        idmapped_mounts=syscall_available(SYS_mount_setattr),
+        pidfd=_probe_pidfd(),
+        splice=hasattr(os, 'splice'),
+        copy_file_range=hasattr(os, 'copy_file_range'),
+    )
+
+def _cache_key(fingerprints):
+    return {
+        'version': CACHE_VERSION,
+        'boot_id': _read_text('/proc/sys/kernel/random/boot_id'),
+        'euid': os.geteuid(),
+        'path': os.environ.get('PATH', ''),
+        'tools': fingerprints,
+    }
+
+def _load_cache(path, key):
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cached, dict) or cached.get('key') != key:
+        return None
+    return HostInfo(**cached.get('info', {}))
+
+def _save_cache(path, key, info):
+    try:
+        path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        write_atomic(
+            path, json.dumps({'key': key, 'info': info.as_dict()}),
+            mode=0o600,
+        )
+    except OSError:
+        # Cache is only an optimization
+        pass
+
+_host_info = None
+
+def get_host_info(refresh=False, cache_path=None):
+    # Probed once per process, cached in the runtime dir until reboot
+    # (boot id) or runc/umoci change
+    global _host_info
+    if _host_info is not None and not refresh:
+        return _host_info
+
+    if cache_path is None:
+        cache_path = get_runtime_path() / HOST_CACHE
+    cache_path = Path(cache_path)
+    fingerprints = _tool_fingerprints()
+    key = _cache_key(fingerprints)
+
+    info = None if refresh else _load_cache(cache_path, key)
+    if info is None:
+        info = probe_host(fingerprints)
+        _save_cache(cache_path, key, info)
+    _host_info = info
+    return info
+
+def set_host_info(info):
+    global _host_info
+    _host_info = info
@@ -0,0 +1,161 @@
+import os
+import time
+import fcntl
+from pathlib import Path
+
+_LOCK_FLAGS = os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW | os.O_CLOEXEC
+
+
+# Advisory flock() held through an open fd, so never stale after a
+# crash; separate FileLocks on one path conflict, forked children
+# share their parent's
+class FileLock(object):
+
+    # Polling interval bounds for blocking acquire()
+    MIN_POLL = 0.001
+    MAX_POLL = 0.1
+
+    def __init__(self, path, mode=0o640):
+        self.path = Path(path)
+        self.mode = mode
+        self.shared = None
+        self._fd = None
+
+    def __repr__(self):
+        state = 'unlocked'
+        if self._fd is not None:
+            state = 'shared' if self.shared else 'exclusive'
+        return (
+            f"<{self.__class__.__name__} path={str(self.path)!r} {state}>"
+        )
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    @property
+    def locked(self):
+        return self._fd is not None
+
+    def fileno(self):
+        return self._fd
+
+    def _try_lock(self, fd, shared):
+        op = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(fd, op | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def _open_locked(self, shared):
+        # Loops in case path is unlinked or replaced between our open()
+        # and flock(), which would leave us locking an orphaned inode
+        while True:
+            fd = os.open(self.path, _LOCK_FLAGS, self.mode)
+            try:
+                if not self._try_lock(fd, shared):
+                    os.close(fd)
+                    return None
+                try:
+                    st = os.stat(self.path, follow_symlinks=False)
+                except FileNotFoundError:
+                    st = None
+                fd_st = os.fstat(fd)
+                if st and (st.st_dev, st.st_ino) == (
+                    fd_st.st_dev, fd_st.st_ino
+                ):
+                    return fd
+            except BaseException:
+                os.close(fd)
+                raise
+            os.close(fd)
+
+    def _write_owner(self):
+        os.ftruncate(self._fd, 0)
+        os.pwrite(self._fd, str(os.getpid()).encode(), 0)
+
+    def acquire(self, shared=False, blocking=True, timeout=None):
+        # Converting a held lock between modes is not atomic (see flock(2))
+        if self._fd is not None:
+            if self.shared == shared:
+                return True
+            if not self._try_lock(self._fd, shared):
+                return False
+            self.shared = shared
+            if not shared:
+                self._write_owner()
+            return True
+
+        deadline = None
+        if blocking and timeout is not None:
+            deadline = time.monotonic() + timeout
+        delay = self.MIN_POLL
+        while True:
+            fd = self._open_locked(shared)
+            if fd is not None:
+                break
+            if not blocking:
+                return False
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                delay = min(delay, remaining)
+            # Polled rather than a blocking flock(), which would
+            # otherwise hang on an orphaned inode (see _open_locked())
+            time.sleep(delay)
+            delay = min(delay * 2, self.MAX_POLL)
+
+        self._fd = fd
+        self.shared = shared
+        if not shared:
+            self._write_owner()
+        return True
+
+    def owner(self):
+        # Pid of the last exclusive holder, for error messages only
+        try:
+            data = self.path.read_text()
+        except FileNotFoundError:
+            return None
+        return int(data) if data.strip().isdigit() else None
+
+    def release(self, unlink=False):
+        # Also drops it for forked children; unlink only if exclusive
+        if self._fd is None:
+            return
+        try:
+            if unlink and not self.shared:
+                try:
+                    self.path.unlink()
+                except FileNotFoundError:
+                    pass
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            self.close()
+
+    def close(self):
+        # Without unlocking, so forked children keep the lock
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self.shared = None
+
+def is_locked(path):
+    # Exclusively, by anyone (us included); never creates path
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_CLOEXEC)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    finally:
+        # Also drops our shared lock, if we got it
+        os.close(fd)
+    return False
@@ -1,5 +1,6 @@
 import os
 import sys
+import signal
 import subprocess
 
 def simple_command(args, write_output=True, exit_on_failure=False, **kwargs):
@@ -27,3 +28,17 @@ def compute_returncode(status):
         returncode = os.WSTOPSIG(status)
 
     return returncode
+
+def parse_signal(value):
+    # Number or name, with or without 'SIG' prefix
+    if isinstance(value, int):
+        return signal.Signals(value)
+    name = str(value).strip().upper()
+    if name.isdigit():
+        return signal.Signals(int(name))
+    if not name.startswith('SIG'):
+        name = f'SIG{name}'
+    try:
+        return signal.Signals[name]
+    except KeyError:
+        raise ValueError(f'Invalid signal: {value!r}') from None
@@ -0,0 +1,129 @@
+import os
+import cProfile
+import threading
+import tracemalloc
+from pathlib import Path
+from contextlib import contextmanager
+
+# Comma-separated profile kinds: 'cpu' (cProfile), 'mem' (tracemalloc)
+PROFILE_ENV = 'DARKWING_PROFILE'
+# Comma-separated phases to profile (default all): run, unpack, config
+PROFILE_PHASES_ENV = 'DARKWING_PROFILE_PHASES'
+
+PHASES = ('run', 'unpack', 'config')
+
+def _split(value):
+    return { v.strip() for v in (value or '').split(',') if v.strip() }
+
+
+# Opt-in cProfile/tracemalloc around selected phases, held until
+# dump() (so phases before the rundir exists are kept); nested
+# phases fall under the outermost
+class Profiler(object):
+
+    def __init__(self, cpu=False, memory=False, phases=None,
+                 trace_frames=16):
+        self.cpu = bool(cpu)
+        self.memory = bool(memory)
+        self.phases = set(phases) if phases else set(PHASES)
+        self.trace_frames = trace_frames
+        self._results = []
+        self._active = None
+        self._dumped = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        kinds = [k for k, on in (('cpu', self.cpu), ('mem', self.memory)) if on]
+        return (
+            f"<{self.__class__.__name__} kinds={','.join(kinds) or 'none'} "
+            f"phases={','.join(sorted(self.phases))}>"
+        )
+
+    @property
+    def enabled(self):
+        return self.cpu or self.memory
+
+    @classmethod
+    def from_env(cls, environ=None):
+        if environ is None:
+            environ = os.environ
+        kinds = _split(environ.get(PROFILE_ENV))
+        if 'all' in kinds:
+            kinds.update(('cpu', 'mem'))
+        return cls(
+            cpu='cpu' in kinds,
+            memory='mem' in kinds,
+            phases=_split(environ.get(PROFILE_PHASES_ENV)) or None,
+        )
+
+    @contextmanager
+    def phase(self, name):
+        with self._lock:
+            # Only one profile at a time (cProfile can't nest)
+            wanted = (
+                self.enabled and name in self.phases and
+                self._active is None
+            )
+            if wanted:
+                self._active = name
+
+        if not wanted:
+            yield
+            return
+
+        prof = None
+        started_trace = False
+        try:
+            if self.memory and not tracemalloc.is_tracing():
+                tracemalloc.start(self.trace_frames)
+                started_trace = True
+            if self.cpu:
+                prof = cProfile.Profile()
+                prof.enable()
+            yield
+        finally:
+            if prof:
+                prof.disable()
+                self._results.append((name, 'pstats', prof))
+            if self.memory and tracemalloc.is_tracing():
+                snapshot = tracemalloc.take_snapshot()
+                self._results.append((name, 'tracemalloc', snapshot))
+                if started_trace:
+                    tracemalloc.stop()
+            with self._lock:
+                self._active = None
+
+    def dump(self, out_dir):
+        with self._lock:
+            results, self._results = self._results, []
+            first = self._dumped
+            self._dumped += len(results)
+        if not results:
+            return []
+
+        out_dir = Path(out_dir)
+        pid = os.getpid()
+        paths = []
+        for n, (name, kind, data) in enumerate(results, first):
+            path = out_dir / f'profile-{name}-{pid}-{n}.{kind}'
+            if kind == 'pstats':
+                data.dump_stats(path)
+            else:
+                data.dump(path)
+            paths.append(path)
+
+        return paths
+
+
+_default_profiler = None
+
+def get_profiler():
+    # From $DARKWING_PROFILE and $DARKWING_PROFILE_PHASES (off by default)
+    global _default_profiler
+    if _default_profiler is None:
+        _default_profiler = Profiler.from_env()
+    return _default_profiler
+
+def set_profiler(profiler):
+    global _default_profiler
+    _default_profiler = profiler
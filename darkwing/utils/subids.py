@@ -0,0 +1,265 @@
+import os
+import pwd
+import grp
+import json
+import bisect
+import threading
+from pathlib import Path
+
+from .files import write_atomic
+from .locks import FileLock
+
+SUBUID_FILE = '/etc/subuid'
+SUBGID_FILE = '/etc/subgid'
+
+# Per-context allocation table for 'isolated' mappings
+ALLOC_FILE = '.subids.json'
+
+# Default number of IDs mapped into each container
+DEFAULT_MAP_SIZE = 65536
+
+MAPPING_MODES = ('single', 'subids', 'isolated')
+
+
+# Parsed /etc/subuid or /etc/subgid: each owner's merged ranges, plus
+# a sorted index of all ranges for owner_of() lookups
+class SubidIndex(object):
+
+    def __init__(self, path, text=''):
+        self.path = Path(path)
+        self._ranges = {}
+        self._starts = []
+        self._index = []
+        self._parse(text)
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} path={str(self.path)!r} "
+            f"owners={len(self._ranges)} ranges={len(self._index)}>"
+        )
+
+    def _parse(self, text):
+        for line in text.splitlines():
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                owner, start, count = line.split(':')
+                start, count = int(start), int(count)
+            except ValueError:
+                continue
+            if count > 0:
+                self._ranges.setdefault(owner, []).append((start, count))
+
+        for owner, ranges in self._ranges.items():
+            self._ranges[owner] = _merge(ranges)
+            for start, count in self._ranges[owner]:
+                self._index.append((start, start + count, owner))
+        self._index.sort()
+        self._starts = [ start for start, _, _ in self._index ]
+
+    def ranges(self, *owners):
+        # Owners by name or ID, as either may appear in the file
+        found = []
+        for owner in owners:
+            found.extend(self._ranges.get(str(owner), ()))
+        return _merge(found)
+
+    def owner_of(self, id_):
+        pos = bisect.bisect_right(self._starts, id_) - 1
+        if pos >= 0:
+            start, end, owner = self._index[pos]
+            if start <= id_ < end:
+                return owner
+        return None
+
+def _merge(ranges):
+    merged = []
+    for start, count in sorted(ranges):
+        if merged and start <= merged[-1][0] + merged[-1][1]:
+            prev_start, prev_count = merged[-1]
+            end = max(prev_start + prev_count, start + count)
+            merged[-1] = (prev_start, end - prev_start)
+        else:
+            merged.append((start, count))
+    return merged
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_subid_index(path):
+    # Reparsed only when mtime or size changes; missing file is empty
+    path = Path(path)
+    try:
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+    except FileNotFoundError:
+        stamp = None
+    with _indexes_lock:
+        cached = _indexes.get(path)
+        if cached and cached[0] == stamp:
+            return cached[1]
+    text = path.read_text() if stamp else ''
+    index = SubidIndex(path, text)
+    with _indexes_lock:
+        _indexes[path] = (stamp, index)
+    return index
+
+def owner_ranges(kind, host_id):
+    # Looked up by both name and number
+    if kind == 'uid':
+        path, lookup = SUBUID_FILE, pwd.getpwuid
+    else:
+        path, lookup = SUBGID_FILE, grp.getgrgid
+    owners = [host_id]
+    try:
+        entry = lookup(host_id)
+        owners.append(entry[0])
+    except KeyError:
+        pass
+    return get_subid_index(path).ranges(*owners)
+
+def take_ids(ranges, size):
+    taken = []
+    for start, count in ranges:
+        if size <= 0:
+            break
+        count = min(count, size)
+        taken.append((start, count))
+        size -= count
+    return taken
+
+def build_id_maps(container_id, host_id, ranges, size=None):
+    # container_id to host_id, the rest of 0..size-1 to ranges in order
+    # (split around container_id); size defaults to all of ranges + 1
+    if size is None:
+        size = sum(count for _, count in ranges) + 1
+    maps = [{'containerID': container_id, 'hostID': host_id, 'size': 1}]
+    next_id = 0
+    remaining = size - 1
+    for start, count in ranges:
+        while count > 0 and remaining > 0:
+            if next_id == container_id:
+                next_id += 1
+            chunk = min(count, remaining)
+            # Don't run over container_id
+            if next_id < container_id:
+                chunk = min(chunk, container_id - next_id)
+            maps.append(
+                {'containerID': next_id, 'hostID': start, 'size': chunk}
+            )
+            next_id += chunk
+            start += chunk
+            count -= chunk
+            remaining -= chunk
+    maps.sort(key=lambda m: m['containerID'])
+    return maps
+
+
+# Non-overlapping first-fit blocks of subordinate IDs per container,
+# in a JSON table shared under a FileLock
+class SubidAllocator(object):
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = FileLock(self.path.with_name(self.path.name + '.lock'))
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} path={str(self.path)!r}>"
+
+    def _load(self):
+        try:
+            return json.loads(self.path.read_text())
+        except FileNotFoundError:
+            return {}
+
+    def _save(self, table):
+        write_atomic(
+            self.path, json.dumps(table, separators=(',', ':')), mode=0o640
+        )
+
+    def allocate(self, kind, name, ranges, size):
+        with self._lock:
+            table = self._load()
+            allocs = table.setdefault(kind, {})
+            if name in allocs:
+                block = [ tuple(r) for r in allocs[name] ]
+                if sum(count for _, count in block) == size:
+                    return block
+
+            used = sorted(
+                tuple(r) for other, block in allocs.items()
+                if other != name for r in block
+            )
+            block = take_ids(_subtract(ranges, used), size)
+            if sum(count for _, count in block) < size:
+                raise ValueError(
+                    f'Not enough free subordinate {kind}s for {name!r}'
+                )
+            allocs[name] = [ list(r) for r in block ]
+            self._save(table)
+            return block
+
+    def release(self, name):
+        with self._lock:
+            table = self._load()
+            changed = False
+            for allocs in table.values():
+                if allocs.pop(name, None) is not None:
+                    changed = True
+            if changed:
+                self._save(table)
+            return changed
+
+def _subtract(ranges, used):
+    # Ranges minus used (both sorted), as free (start, count) ranges
+    free = []
+    starts = [ start for start, _ in used ]
+    for start, count in ranges:
+        end = start + count
+        pos = max(0, bisect.bisect_right(starts, start) - 1)
+        for used_start, used_count in used[pos:]:
+            if used_start >= end:
+                break
+            used_end = used_start + used_count
+            if used_end <= start:
+                continue
+            if used_start > start:
+                free.append((start, used_start - start))
+            start = max(start, used_end)
+        if start < end:
+            free.append((start, end - start))
+    return free
+
+def container_id_maps(config, ouid, ogid):
+    # (uidMappings, gidMappings), or None for 'single' mapping
+    user = config.data['user']
+    mode = user.get('mapping', 'single')
+    if mode not in MAPPING_MODES:
+        raise ValueError(f'Invalid user mapping mode: {mode!r}')
+    if mode == 'single':
+        return None
+    size = int(user.get('map_size', DEFAULT_MAP_SIZE))
+
+    allocator = None
+    if mode == 'isolated':
+        base = Path(config.data['storage']['base']).parent
+        allocator = SubidAllocator(base / ALLOC_FILE)
+
+    maps = []
+    for kind, container_id, host_id in (
+        ('uid', user['uid'], ouid), ('gid', user['gid'], ogid)
+    ):
+        ranges = owner_ranges(kind, host_id)
+        if allocator:
+            ranges = allocator.allocate(kind, config.name, ranges, size - 1)
+        else:
+            ranges = take_ids(ranges, size - 1)
+        maps.append(build_id_maps(container_id, host_id, ranges))
+    return tuple(maps)
+
+def release_container_ids(config_name, containers_base):
+    path = Path(containers_base) / ALLOC_FILE
+    if not path.exists():
+        return False
+    return SubidAllocator(path).release(config_name)
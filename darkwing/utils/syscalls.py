@@ -9,6 +9,78 @@ PR_SET_PDEATHSIG = 1
 PR_SET_NAME = 15
 PR_SET_CHILD_SUBREAPER = 36
 
+# Same numbers on all architectures (added after syscall unification)
+SYS_open_tree = 428
+SYS_move_mount = 429
+SYS_mount_setattr = 442
+
+CLONE_NEWUSER = 0x10000000
+AT_FDCWD = -100
+AT_EMPTY_PATH = 0x1000
+AT_RECURSIVE = 0x8000
+OPEN_TREE_CLONE = 1
+MOVE_MOUNT_F_EMPTY_PATH = 0x4
+MOUNT_ATTR_IDMAP = 0x100000
+MNT_DETACH = 2
+MS_NOSUID = 0x2
+MS_NODEV = 0x4
+MS_NOEXEC = 0x8
+
+
+class _MountAttr(ctypes.Structure):
+    _fields_ = [
+        ('attr_set', ctypes.c_uint64),
+        ('attr_clr', ctypes.c_uint64),
+        ('propagation', ctypes.c_uint64),
+        ('userns_fd', ctypes.c_uint64),
+    ]
+
+def _check(ret, *args):
+    if ret == -1:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), *args)
+    return ret
+
+def _path_arg(path):
+    return os.fsencode(path) if path is not None else None
+
+def open_tree(path, flags, dirfd=AT_FDCWD):
+    flags |= os.O_CLOEXEC
+    return _check(
+        _libc.syscall(SYS_open_tree, dirfd, _path_arg(path), flags), path
+    )
+
+def mount_setattr_idmap(fd, userns_fd, recursive=True):
+    attr = _MountAttr(attr_set=MOUNT_ATTR_IDMAP, userns_fd=userns_fd)
+    flags = AT_EMPTY_PATH | (AT_RECURSIVE if recursive else 0)
+    _check(_libc.syscall(
+        SYS_mount_setattr, fd, b'', flags,
+        ctypes.byref(attr), ctypes.c_size_t(ctypes.sizeof(attr)),
+    ))
+
+def move_mount(fd, target):
+    _check(_libc.syscall(
+        SYS_move_mount, fd, b'', AT_FDCWD, _path_arg(target),
+        MOVE_MOUNT_F_EMPTY_PATH,
+    ), target)
+
+def mount(source, target, fstype, flags=0, data=None):
+    _check(_libc.mount(
+        _path_arg(source), _path_arg(target), fstype.encode(),
+        ctypes.c_ulong(flags), data.encode() if data else None,
+    ), target)
+
+def umount(path, flags=MNT_DETACH):
+    _check(_libc.umount2(_path_arg(path), flags), path)
+
+def unshare(flags):
+    _check(_libc.unshare(flags))
+
+def syscall_available(number):
+    # Called with invalid arguments, so only ENOSYS means missing
+    ret = _libc.syscall(number, -1, None, 0, None, 0)
+    return not (ret == -1 and ctypes.get_errno() == errno.ENOSYS)
+
 def set_subreaper(target=True):
     arg2 = 1 if target else 0
     _libc.prctl(PR_SET_CHILD_SUBREAPER, arg2, 0, 0, 0)
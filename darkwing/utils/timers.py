@@ -0,0 +1,113 @@
+import math
+import time
+import threading
+
+
+class Timer(object):
+
+    __slots__ = ('expiry', 'deadline', 'callback', 'args', 'cancelled')
+
+    def __init__(self, expiry, deadline, callback, args):
+        self.expiry = expiry
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} deadline={self.deadline:.3f} "
+            f"callback={self.callback!r} cancelled={self.cancelled}>"
+        )
+
+
+# Hashed timing wheel, so schedule()/cancel() are O(1) (from any
+# thread); callbacks run from advance(), in its caller's thread
+class TimerWheel(object):
+
+    def __init__(self, tick=0.05, slots=256, clock=time.monotonic):
+        self.tick = tick
+        self.slots = slots
+        self.clock = clock
+        self._wheel = [ [] for _ in range(slots) ]
+        self._current = self._tick_of(clock())
+        self._pending = 0
+        self._next = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} pending={self._pending}>"
+
+    def __len__(self):
+        return self._pending
+
+    def _tick_of(self, when):
+        return math.ceil(when / self.tick)
+
+    def schedule(self, delay, callback, *args):
+        deadline = self.clock() + max(0, delay)
+        with self._lock:
+            # Never into a slot advance() has already passed
+            expiry = max(self._tick_of(deadline), self._current + 1)
+            timer = Timer(expiry, deadline, callback, args)
+            self._wheel[expiry % self.slots].append(timer)
+            self._pending += 1
+            if self._next is None or expiry < self._next:
+                self._next = expiry
+        return timer
+
+    def cancel(self, timer):
+        # Left in its slot, and dropped when that slot next comes round
+        with self._lock:
+            if timer and not timer.cancelled:
+                timer.cancelled = True
+                self._pending -= 1
+
+    def next_timeout(self):
+        # Seconds until next timer (0 if overdue), or None if none pending
+        with self._lock:
+            if not self._pending or self._next is None:
+                return None
+            return max(0.0, self._next * self.tick - self.clock())
+
+    def advance(self):
+        # Returns number of callbacks run
+        now = self._tick_of(self.clock())
+        due = []
+        with self._lock:
+            if now <= self._current:
+                return 0
+            # Once round the wheel covers every slot
+            ticks = range(self._current + 1, now + 1)
+            if len(ticks) > self.slots:
+                ticks = range(now - self.slots + 1, now + 1)
+            for tick in ticks:
+                slot = self._wheel[tick % self.slots]
+                if not slot:
+                    continue
+                keep = []
+                for timer in slot:
+                    if timer.cancelled:
+                        continue
+                    if timer.expiry <= now:
+                        timer.cancelled = True
+                        self._pending -= 1
+                        due.append(timer)
+                    else:
+                        keep.append(timer)
+                slot[:] = keep
+            self._current = now
+
+            # Find next expiry (only rescans slots on an actual expiry)
+            if self._next is not None and self._next <= now:
+                self._next = min(
+                    (
+                        t.expiry for slot in self._wheel for t in slot
+                        if not t.cancelled
+                    ),
+                    default=None,
+                )
+
+        for timer in sorted(due, key=lambda t: t.deadline):
+            timer.callback(*timer.args)
+        return len(due)
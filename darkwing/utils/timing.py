@@ -0,0 +1,163 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Env var naming a JSON-lines file for phase records ('-' for stderr)
+TIMINGS_ENV = 'DARKWING_TIMINGS'
+
+
+# Power-of-two buckets of ns durations: n holds [2**(n-1), 2**n)
+class Histogram(object):
+
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    NUM_BUCKETS = 64
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * self.NUM_BUCKETS
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} count={self.count} "
+            f"mean={self.mean}>"
+        )
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.buckets[min(value.bit_length(), self.NUM_BUCKETS - 1)] += 1
+
+    @property
+    def mean(self):
+        return self.total // self.count if self.count else None
+
+    def percentile(self, pct):
+        # Upper bound of bucket containing the given percentile
+        if not self.count:
+            return None
+        target = max(1, -(-self.count * pct // 100))
+        seen = 0
+        for n, num in enumerate(self.buckets):
+            seen += num
+            if seen >= target:
+                return min(1 << n, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total_ns': self.total,
+            'min_ns': self.min,
+            'mean_ns': self.mean,
+            'p50_ns': self.percentile(50),
+            'p90_ns': self.percentile(90),
+            'p99_ns': self.percentile(99),
+            'max_ns': self.max,
+        }
+
+
+# Per-phase histograms of monotonic durations, each also written to
+# any sink as a JSON line
+class PhaseTimer(object):
+
+    def __init__(self, sink=None):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._sink = None
+        self._close_sink = False
+        if sink == '-':
+            self._sink = sys.stderr
+        elif isinstance(sink, (str, bytes, os.PathLike)):
+            self._sink = open(sink, 'a', buffering=1)
+            self._close_sink = True
+        elif sink is not None:
+            self._sink = sink
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} phases={len(self._histograms)}>"
+
+    @contextmanager
+    def phase(self, name, **fields):
+        ok = False
+        start = time.monotonic_ns()
+        try:
+            yield
+            ok = True
+        finally:
+            self.record(name, start, time.monotonic_ns() - start, ok, fields)
+
+    def record(self, name, start_ns, duration_ns, ok=True, fields=None):
+        with self._lock:
+            hist = self._histograms.get(name)
+            if hist is None:
+                hist = self._histograms[name] = Histogram()
+            hist.add(duration_ns)
+
+            if self._sink:
+                rec = {
+                    'phase': name,
+                    'start_ns': start_ns,
+                    'duration_ns': duration_ns,
+                    'ok': ok,
+                    'pid': os.getpid(),
+                }
+                if fields:
+                    rec.update(fields)
+                self._emit(rec)
+
+    def emit(self, record):
+        # Arbitrary structured record to sink
+        with self._lock:
+            self._emit(record)
+
+    def _emit(self, record):
+        if not self._sink:
+            return
+        try:
+            self._sink.write(json.dumps(record, separators=(',', ':')) + '\n')
+            self._sink.flush()
+        except (OSError, ValueError):
+            # Never let instrumentation break the lifecycle
+            pass
+
+    def histogram(self, name):
+        with self._lock:
+            return self._histograms.get(name)
+
+    def summary(self):
+        with self._lock:
+            return {
+                name: hist.summary()
+                for name, hist in self._histograms.items()
+            }
+
+    def close(self):
+        with self._lock:
+            if self._close_sink and self._sink:
+                self._sink.close()
+            self._sink = None
+
+
+_default_timer = None
+
+def get_timer():
+    # Sink from $DARKWING_TIMINGS, if set
+    global _default_timer
+    if _default_timer is None:
+        _default_timer = PhaseTimer(sink=os.environ.get(TIMINGS_ENV) or None)
+    return _default_timer
+
+def set_timer(timer):
+    global _default_timer
+    _default_timer = timer
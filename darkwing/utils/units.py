@@ -0,0 +1,27 @@
+_SIZE_SUFFIXES = {
+    '': 1,
+    'b': 1,
+    'k': 1 << 10,
+    'm': 1 << 20,
+    'g': 1 << 30,
+    't': 1 << 40,
+}
+
+def parse_size(value):
+    # Int, or string with optional binary suffix (eg '512M', '64KiB')
+    if isinstance(value, int):
+        return value
+
+    text = str(value).strip().lower()
+    for unit in ('ib', 'b'):
+        if text.endswith(unit) and text[:-len(unit)][-1:].isalpha():
+            text = text[:-len(unit)]
+            break
+    num, suffix = text, ''
+    if text[-1:].isalpha():
+        num, suffix = text[:-1], text[-1]
+
+    try:
+        return int(float(num) * _SIZE_SUFFIXES[suffix])
+    except (KeyError, ValueError):
+        raise ValueError(f'Invalid size: {value!r}') from None
@@ -4,6 +4,9 @@ import grp
 from pathlib import Path
 from getpass import getuser
 
+# Cached per euid, saving the /proc readlinks on every call
+_root_cache = {}
+
 def probably_root():
     '''
     Checks if current process is root, or functionally
@@ -12,6 +15,14 @@ def probably_root():
     euid = os.geteuid()
     if euid != 0:
         return False
+    try:
+        return _root_cache[euid]
+    except KeyError:
+        pass
+    _root_cache[euid] = result = _check_root_ns()
+    return result
+
+def _check_root_ns():
     # Now we have to check if we're in a user namespace
     # other than that of PID 1
     pid = os.getpid()